@@ -1,4 +1,4 @@
-.PHONY: docker.build docker.pkg
+.PHONY: docker.build docker.build.shard docker.pkg
 
 SHARD=0
 SHARDS=1
@@ -10,6 +10,8 @@ all_images:=$(patsubst docker/build/%/Dockerfile,%,$(dockerfiles))
 images:=$(if $(TRAVIS_COMMIT_RANGE),$(shell git diff --name-only $(TRAVIS_COMMIT_RANGE) | python util/parsefiles.py),$(all_images))
 # Only use images that actually contain a Dockerfile
 images:=$(shell echo "$(all_images) $(images)" | tr " " "\n" | sort | uniq -d)
+# The images that shard $(SHARD) of $(SHARDS) builds, balanced by the weights in util/parsefiles_config.yml
+shard_images=$(shell echo $(images) | python util/parsefiles.py --shards $(SHARDS) --shard $(SHARD))
 
 docker_build=docker.build.
 docker_pkg=docker.pkg.
@@ -29,6 +31,7 @@ docker.help:
 	@echo '        $(docker_push)$$container    push $$container to dockerhub '
 	@echo ''
 	@echo '        docker.build          build all defined docker containers (based on dockerhub base images)'
+	@echo '        docker.build.shard    build the containers of shard $$SHARD out of $$SHARDS'
 	@echo '        docker.pkg            package all defined docker containers (using local base images)'
 	@echo '        docker.push           push all defined docker containers'
 	@echo ''
@@ -49,6 +52,8 @@ docker.clean:
 	rm -rf .build
 
 docker.build: $(foreach image,$(images),$(docker_build)$(image))
+docker.build.shard:
+	@$(MAKE) docker.build images="$(shard_images)"
 docker.pkg: $(foreach image,$(images),$(docker_pkg)$(image))
 docker.push: $(foreach image,$(images),$(docker_push)$(image))
 
@@ -66,21 +71,10 @@ $(docker_push)%: $(docker_pkg)%
 	docker push edxops/$*:latest
 
 
-.build/%/Dockerfile.d: docker/build/%/Dockerfile Makefile
+.build/%/Dockerfile.d: docker/build/%/Dockerfile Makefile util/dockerfile_dag.py
 	@mkdir -p .build/$*
-	$(eval BASE_IMAGE_TAG=$(shell grep "^\s*ARG BASE_IMAGE_TAG" $< | sed -E "s/ARG BASE_IMAGE_TAG=//"))
-	@# I have no idea why the final sed is eating the first character of the substitution...
-	$(eval FROM=$(shell grep "^\s*FROM" docker/build/ecommerce/Dockerfile  | sed -E "s/FROM //" | sed -E "s/:/@/g" | sed -E 's/\$\{BASE_IMAGE_TAG\}/ $(BASE_IMAGE_TAG)/'))
-	$(eval EDXOPS_FROM=$(shell echo "$(FROM)" | sed -E "s#edxops/([^@]+)(@.*)?#\1#"))
-	@echo "Base Image Tag: $(BASE_IMAGE_TAG)"
-	@echo $(FROM)
-	@echo $(EDXOPS_FROM)
-	@echo "$(docker_build)$*: $(docker_pull)$(FROM)" > $@
-	@if [ "$(EDXOPS_FROM)" != "$(FROM)" ]; then \
-	echo "$(docker_pkg)$*: $(docker_pkg)$(EDXOPS_FROM:@%=)" >> $@; \
-	else \
-	echo "$(docker_pkg)$*: $(docker_pull)$(FROM)" >> $@; \
-	fi
+	python util/dockerfile_dag.py --make-deps $< > $@
+	@cat $@
 
 .build/%/Dockerfile.pkg: docker/build/%/Dockerfile Makefile
 	@mkdir -p .build/$*
@@ -19,7 +19,9 @@ you need to define:
 
 For more details, see: http://docs.pythonboto.org/en/latest/boto_config_tut.html
 
-When run against a specific host, this script returns the following variables:
+When run against a specific host, this script returns the following variables
+(they are also included for every host in the _meta block of --list, so
+Ansible does not need to call the script once per host):
  - ec2_ami_launch_index
  - ec2_architecture
  - ec2_association
@@ -111,12 +113,22 @@ Security groups are comma-separated in 'ec2_security_group_ids' and
 import sys
 import os
 import argparse
+import calendar
+import fcntl
+import functools
+import hashlib
+import marshal
 import re
-from time import time
-import boto
-from boto import ec2
-from boto import rds
-from boto import route53
+import socket
+import socketserver
+import sqlite3
+import subprocess
+import tempfile
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from time import gmtime, sleep, strftime, strptime, time
 import six.moves.configparser
 import traceback
 import six
@@ -127,9 +139,429 @@ except ImportError:
     import simplejson as json
 
 
+def import_boto():
+    ''' Imports boto, which takes longer than everything the daemon client
+    needs to answer Ansible '''
+
+    global boto, ec2, rds, route53
+    import boto
+    from boto import ec2
+    from boto import rds
+    from boto import route53
+
+
+def build_arg_parser():
+    ''' Command line argument processing '''
+
+    parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on EC2')
+    parser.add_argument('--tags-only', action='store_true', default=False,
+                       help='only return tags (default: False)')
+    parser.add_argument('--list', action='store_true', default=True,
+                       help='List instances (default: True)')
+    parser.add_argument('--host', action='store',
+                       help='Get all the variables about a specific instance')
+    parser.add_argument('--pretty', action='store_true', default=False,
+                       help='Pretty format (default: False)')
+    parser.add_argument('--refresh-cache', action='store_true', default=False,
+                       help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+    parser.add_argument('--background-refresh', action='store_true', default=False,
+                       help=argparse.SUPPRESS)
+    parser.add_argument('--daemon', action='store_true', default=False,
+                       help='Keep the inventory in memory and serve it on the daemon socket')
+
+    default_inifile = os.environ.get("ANSIBLE_EC2_INI", os.path.dirname(os.path.realpath(__file__))+'/ec2.ini')
+
+    parser.add_argument('--inifile', dest='inifile', help='Path to init script to use', default=default_inifile)
+    parser.add_argument(
+        '--cache-path',
+        help='Override the cache path set in ini file',
+        required=False)
+    return parser
+
+
+def read_config(args):
+    ''' Reads the ec2.ini file '''
+
+    config = six.moves.configparser.SafeConfigParser()
+    config.read(args.inifile)
+    return config
+
+
+def get_cache_path(args, config):
+    ''' Returns the directory of the cache files '''
+
+    if 'EC2_CACHE_PATH' in os.environ:
+        return os.environ['EC2_CACHE_PATH']
+    elif args.cache_path:
+        return args.cache_path
+    else:
+        return config.get('ec2', 'cache_path')
+
+
+def get_cache_prefix():
+    ''' Returns the prefix of the cache files, which depends on the AWS
+    profile in use '''
+
+    if 'AWS_PROFILE' in os.environ:
+        return "{}-".format(os.environ.get('AWS_PROFILE'))
+    return ""
+
+
+def get_daemon_socket(args, config):
+    ''' Returns the path of the Unix socket the daemon listens on '''
+
+    if config.has_option('ec2', 'daemon_socket'):
+        return config.get('ec2', 'daemon_socket')
+    return get_cache_path(args, config) + f"/{get_cache_prefix()}ansible-ec2.sock"
+
+
+def query_daemon(args, config):
+    ''' Asks a running daemon for the inventory, or for the variables of
+    args.host. Returns None if there is no daemon to ask, so that the caller
+    builds the inventory itself. '''
+
+    if args.daemon or args.refresh_cache or args.background_refresh or args.tags_only:
+        return None
+
+    socket_path = get_daemon_socket(args, config)
+    if not os.path.exists(socket_path):
+        return None
+
+    if args.host:
+        request = 'host %s\n' % args.host
+    else:
+        request = 'list\n'
+
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.settimeout(DAEMON_TIMEOUT)
+        client.connect(socket_path)
+        client.sendall(request.encode('utf-8'))
+        client.shutdown(socket.SHUT_WR)
+
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    except (OSError, socket.timeout):
+        return None
+    finally:
+        client.close()
+
+    if not chunks:
+        return None
+
+    response = b''.join(chunks).decode('utf-8')
+    if args.pretty:
+        return json.dumps(json.loads(response), sort_keys=True, indent=2)
+    return response
+
+
+class InventoryRequestHandler(socketserver.StreamRequestHandler):
+    ''' Answers a "list" or "host <name>" request of the daemon client '''
+
+    def handle(self):
+        request = self.rfile.readline().decode('utf-8').strip()
+        self.wfile.write(self.server.inventory.daemon_response(request).encode('utf-8'))
+
+
+def write_file(filename, contents):
+    ''' Writes contents to a temporary file and renames it over filename,
+    so that readers never see a partially written cache '''
+
+    with atomic_replace(filename) as tmp_filename:
+        with open(tmp_filename, 'wb' if isinstance(contents, bytes) else 'w') as cache:
+            cache.write(contents)
+
+
+@contextmanager
+def atomic_replace(filename):
+    ''' Yields the path of a temporary file next to filename, and renames it
+    over filename once the block is done '''
+
+    fd, tmp_filename = tempfile.mkstemp(dir=os.path.dirname(filename),
+                                        prefix='.' + os.path.basename(filename))
+    os.close(fd)
+    try:
+        yield tmp_filename
+        os.rename(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
+
+
+def format_launch_time(timestamp):
+    ''' Formats a Unix timestamp like the launch times of the EC2 API '''
+
+    return strftime('%Y-%m-%dT%H:%M:%S.000Z', gmtime(timestamp))
+
+
+def parse_launch_time(launch_time):
+    ''' Returns the Unix timestamp of an EC2 launch time, to the second '''
+
+    return calendar.timegm(strptime(launch_time[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def json_compact(data):
+    ''' Dumps data as JSON without any whitespace '''
+
+    return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+
+class JsonInventoryCache:
+    ''' Stores the inventory and the index as two JSON files. The inventory
+    file is already what --list prints, so it is never parsed for --list. '''
+
+    extension = ''
+
+    def __init__(self, cache_path, prefix):
+        self.path = cache_path + f"/{prefix}ansible-ec2.cache" + self.extension
+        self.index_path = cache_path + f"/{prefix}ansible-ec2.index" + self.extension
+        self.files = [self.path, self.index_path]
+
+    def dumps(self, data):
+        return json_compact(data)
+
+    def loads(self, contents):
+        return json.loads(contents)
+
+    def read(self, filename):
+        with open(filename) as cache:
+            return cache.read()
+
+    def write(self, inventory, index):
+        write_file(self.path, self.dumps(inventory))
+        write_file(self.index_path, self.dumps(index))
+
+    def read_inventory(self):
+        return self.loads(self.read(self.path))
+
+    def read_index(self):
+        return self.loads(self.read(self.index_path))
+
+    def read_hostvars(self, host):
+        return self.read_inventory()['_meta']['hostvars'].get(host, {})
+
+    def inventory_json(self):
+        return self.read(self.path)
+
+
+class MarshalInventoryCache(JsonInventoryCache):
+    ''' Stores the inventory and the index in the binary marshal format,
+    which loads several times faster than JSON for --host and incremental
+    refreshes. --list is served from a JSON copy of the inventory, written
+    alongside. The marshal format may change between Python versions, so the
+    file names carry the version that wrote them, and a cache written by
+    another interpreter is never read. '''
+
+    extension = '.py%d%d.marshal' % sys.version_info[:2]
+
+    def __init__(self, cache_path, prefix):
+        super().__init__(cache_path, prefix)
+        self.json_path = cache_path + f"/{prefix}ansible-ec2.cache.marshal.json"
+        self.files = [self.json_path, self.path, self.index_path]
+
+    def dumps(self, data):
+        return marshal.dumps(data)
+
+    def loads(self, contents):
+        return marshal.loads(contents)
+
+    def read(self, filename):
+        with open(filename, 'rb') as cache:
+            return cache.read()
+
+    def write(self, inventory, index):
+        super().write(inventory, index)
+        write_file(self.json_path, json_compact(inventory))
+
+    def inventory_json(self):
+        with open(self.json_path) as cache:
+            return cache.read()
+
+
+class SqliteInventoryCache:
+    ''' Stores the groups, the host variables and the index as tables of a
+    SQLite database, so that --host only reads the row of one host. Rows hold
+    JSON fragments that are stitched together without being parsed for
+    --list. '''
+
+    def __init__(self, cache_path, prefix):
+        self.path = cache_path + f"/{prefix}ansible-ec2.cache.sqlite"
+        self.files = [self.path]
+
+    def write(self, inventory, index):
+        with atomic_replace(self.path) as tmp_filename:
+            conn = sqlite3.connect(tmp_filename)
+            try:
+                conn.execute('CREATE TABLE groups (name TEXT PRIMARY KEY, hosts TEXT)')
+                conn.execute('CREATE TABLE hostvars (host TEXT PRIMARY KEY, vars TEXT)')
+                conn.execute('CREATE TABLE idx (host TEXT PRIMARY KEY, region TEXT, instance_id TEXT)')
+                conn.executemany('INSERT INTO groups VALUES (?, ?)', (
+                    (name, json_compact(hosts)) for name, hosts in inventory.items() if name != '_meta'))
+                conn.executemany('INSERT INTO hostvars VALUES (?, ?)', (
+                    (host, json_compact(host_vars)) for host, host_vars in inventory['_meta']['hostvars'].items()))
+                conn.executemany('INSERT INTO idx VALUES (?, ?, ?)', (
+                    (host, region, instance_id) for host, (region, instance_id) in index.items()))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def query(self, sql, *params):
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql, params).fetchall()
+        finally:
+            conn.close()
+
+    def read_inventory(self):
+        inventory = dict((name, json.loads(hosts)) for name, hosts in self.query('SELECT name, hosts FROM groups'))
+        inventory['_meta'] = {'hostvars': dict(
+            (host, json.loads(host_vars)) for host, host_vars in self.query('SELECT host, vars FROM hostvars'))}
+        return inventory
+
+    def read_index(self):
+        return dict((host, [region, instance_id])
+                    for host, region, instance_id in self.query('SELECT host, region, instance_id FROM idx'))
+
+    def read_hostvars(self, host):
+        rows = self.query('SELECT vars FROM hostvars WHERE host = ?', host)
+        return json.loads(rows[0][0]) if rows else {}
+
+    def inventory_json(self):
+        hostvars = ','.join('%s:%s' % (json.dumps(host), host_vars)
+                            for host, host_vars in self.query('SELECT host, vars FROM hostvars ORDER BY host'))
+        groups = [(name, hosts) for name, hosts in self.query('SELECT name, hosts FROM groups')]
+        groups.append(('_meta', '{"hostvars":{%s}}' % hostvars))
+
+        return '{%s}' % ','.join('%s:%s' % (json.dumps(name), hosts) for name, hosts in sorted(groups))
+
+
+class CompactInventory:
+    ''' Inventory groups for very large fleets. Every host name is stored
+    once and given an integer ID, and groups are arrays of those IDs rather
+    than lists repeating the names. The usual dict of group name to host names
+    is only materialized by to_dict(), when the inventory gets serialized. '''
+
+    def __init__(self):
+        # Host ID to host name, None for removed hosts
+        self.hosts = []
+        # Host name to host ID
+        self.host_ids = {}
+        # Group name to array of host IDs
+        self.groups = {}
+        # Host name to host variables
+        self.hostvars = {}
+
+    @classmethod
+    def from_dict(cls, data):
+        inventory = cls()
+        for key, hosts in data.items():
+            if key != '_meta':
+                for host in hosts:
+                    inventory.push(key, host)
+        inventory.hostvars = data['_meta']['hostvars']
+        return inventory
+
+    def is_empty(self):
+        return not self.groups and not self.hostvars
+
+    def host_id(self, host):
+        if host not in self.host_ids:
+            self.host_ids[host] = len(self.hosts)
+            self.hosts.append(host)
+        return self.host_ids[host]
+
+    def push(self, group, host):
+        if group not in self.groups:
+            self.groups[group] = array('I')
+        self.groups[group].append(self.host_id(host))
+
+    def keep_first(self, group, host):
+        if group not in self.groups:
+            self.groups[group] = array('I', [self.host_id(host)])
+
+    def remove_hosts(self, hosts):
+        ''' Removes hosts from every group they are in, dropping the groups
+        that end up empty. Every group is scanned once, however many hosts are
+        removed. '''
+
+        removed = set()
+        for host in hosts:
+            self.hostvars.pop(host, None)
+            if host in self.host_ids:
+                host_id = self.host_ids.pop(host)
+                self.hosts[host_id] = None
+                removed.add(host_id)
+
+        if not removed:
+            return
+
+        for group in list(self.groups):
+            host_ids = self.groups[group]
+            if removed.isdisjoint(host_ids):
+                continue
+            host_ids = array('I', [host_id for host_id in host_ids if host_id not in removed])
+            if host_ids:
+                self.groups[group] = host_ids
+            else:
+                del self.groups[group]
+
+    def sort_groups(self, key):
+        ''' Sorts the hosts of every group by key, a function of the host
+        name '''
+
+        keys = [None if host is None else key(host) for host in self.hosts]
+        for group, host_ids in self.groups.items():
+            self.groups[group] = array('I', sorted(host_ids, key=keys.__getitem__))
+
+    def to_dict(self):
+        hosts = self.hosts
+        data = dict((group, [hosts[host_id] for host_id in host_ids])
+                    for group, host_ids in self.groups.items())
+        data['_meta'] = {'hostvars': self.hostvars}
+        return data
+
+
+@functools.lru_cache(maxsize=65536)
+def to_safe(word):
+    ''' Converts 'bad' characters in a string to underscores so they can be
+    used as Ansible groups. Memoized, since the same group names and variable
+    names come up for every host. '''
+
+    return UNSAFE_CHARACTERS.sub("_", word)
+
+
+UNSAFE_CHARACTERS = re.compile(r"[^A-Za-z0-9\-]")
+
+
+GROUP_BY_OPTIONS = [
+    'instance_id',
+    'region',
+    'availability_zone',
+    'instance_type',
+    'key_pair',
+    'security_group',
+    'tag',
+    'first_in_tag',
+    'route53',
+    'rds_engine',
+    'rds_parameter_group',
+]
+
+
+CACHE_FORMATS = {
+    'json': JsonInventoryCache,
+    'marshal': MarshalInventoryCache,
+    'sqlite': SqliteInventoryCache,
+}
+
+
 class Ec2Inventory:
     def _empty_inventory(self):
-        return {"_meta": {"hostvars": {}}}
+        return CompactInventory()
 
     def __init__(self):
         ''' Main execution path '''
@@ -141,51 +573,135 @@ class Ec2Inventory:
         # Index of hostname (address) to instance ID
         self.index = {}
 
+        # Per-region instances in the inventory, used by incremental refreshes
+        self.state = {}
+
         # Read settings and parse CLI arguments
+        import_boto()
         self.parse_cli_args()
         self.read_settings()
 
+        if self.args.daemon:
+            self.run_daemon()
+            return
+
         # Cache
-        if self.args.refresh_cache:
-            self.do_api_calls_update_cache()
-        elif not self.is_cache_valid():
-            self.do_api_calls_update_cache()
+        if self.args.refresh_cache or not self.is_cache_valid():
+            self.update_cache()
+
         # Data to print
         if self.args.host:
             data_to_print = self.get_host_info()
 
         elif self.args.list:
             # Display list of instances for inventory
-            if len(self.inventory) == 0:
+            if self.inventory.is_empty():
                 data_to_print = self.get_inventory_from_cache()
             else:
-                data_to_print = self.json_format_dict(self.inventory, True)
+                data_to_print = self.json_format_dict(self.inventory.to_dict(), self.args.pretty)
         print(data_to_print)
 
 
     def is_cache_valid(self):
         ''' Determines if the cache files have expired, or if it is still valid '''
 
-        if self.args.tags_only:
-            to_check = self.cache_path_tags
-        else:
-            to_check = self.cache_path_cache
-
-        if os.path.isfile(to_check):
-            mod_time = os.path.getmtime(to_check)
+        if self.cache_exists():
+            mod_time = os.path.getmtime(self.cache_files()[0])
             current_time = time()
             if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_index):
-                    return True
+                return True
 
         return False
 
 
+    def cache_files(self):
+        ''' Returns the cache files that have to exist for the cache to be
+        used, the one holding the inventory first '''
+
+        if self.args.tags_only:
+            return [self.cache_path_tags]
+        return self.cache.files
+
+
+    def cache_exists(self):
+        ''' Determines if a previous copy of the cache files exists, no matter
+        how old it is '''
+
+        return all(os.path.isfile(filename) for filename in self.cache_files())
+
+
+    def update_cache(self):
+        ''' Refreshes the cache files, making sure that only one process at a
+        time makes the API calls. The other processes wait for the refresh to
+        finish if there is no cache yet, and serve the previous copy otherwise.
+        In stale-while-revalidate mode the previous copy is served right away
+        and the refresh happens in a detached background process. '''
+
+        has_cache = self.cache_exists()
+
+        if self.args.background_refresh:
+            # Spawned by another run: give up if a refresh is already going on
+            with self.cache_lock(blocking=False) as locked:
+                if locked:
+                    self.do_api_calls_update_cache()
+            return
+
+        if has_cache and not self.args.refresh_cache and self.cache_stale_while_revalidate:
+            self.spawn_background_refresh()
+            return
+
+        with self.cache_lock(blocking=self.args.refresh_cache or not has_cache) as locked:
+            if not locked:
+                # Somebody else is refreshing, serve the previous copy
+                return
+
+            if not self.args.refresh_cache and self.is_cache_valid():
+                # Refreshed by another process while we were waiting
+                return
+
+            self.do_api_calls_update_cache()
+
+
+    @contextmanager
+    def cache_lock(self, blocking=True):
+        ''' Holds an advisory lock on the cache files. Yields True once the
+        lock is held, or False if blocking is False and another process holds
+        it '''
+
+        with open(self.cache_path_lock, 'a') as lock_file:
+            flags = fcntl.LOCK_EX
+            if not blocking:
+                flags |= fcntl.LOCK_NB
+
+            try:
+                fcntl.flock(lock_file, flags)
+            except OSError:
+                yield False
+                return
+
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+    def spawn_background_refresh(self):
+        ''' Starts a detached copy of this script that refreshes the cache '''
+
+        command = [sys.executable, os.path.realpath(__file__), '--background-refresh',
+                   '--inifile', self.args.inifile, '--cache-path', self.cache_path]
+        if self.args.tags_only:
+            command.append('--tags-only')
+
+        with open(os.devnull, 'w') as devnull:
+            subprocess.Popen(command, stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, start_new_session=True)
+
+
     def read_settings(self):
         ''' Reads the settings from the ec2.ini file '''
 
-        config = six.moves.configparser.SafeConfigParser()
-        config.read(self.args.inifile)
+        config = read_config(self.args)
 
         # is eucalyptus?
         self.eucalyptus_host = None
@@ -213,94 +729,375 @@ class Ec2Inventory:
         self.destination_variable = config.get('ec2', 'destination_variable')
         self.vpc_destination_variable = config.get('ec2', 'vpc_destination_variable')
 
+        # Filters pushed down to the EC2 API, as a dict of filter name to the
+        # list of accepted values
+        self.instance_filters = {}
+        if config.has_option('ec2', 'instance_filters'):
+            for instance_filter in config.get('ec2', 'instance_filters').split(','):
+                if instance_filter.strip():
+                    name, _, value = instance_filter.partition('=')
+                    self.instance_filters.setdefault(name.strip(), []).append(value.strip())
+
+        # Groups to create
+        self.group_by = set(GROUP_BY_OPTIONS)
+        if config.has_option('ec2', 'group_by') and config.get('ec2', 'group_by').strip():
+            self.group_by = set(option.strip() for option in config.get('ec2', 'group_by').split(','))
+            if not self.group_by.issubset(GROUP_BY_OPTIONS):
+                print("group_by must be a list of: %s" % ', '.join(GROUP_BY_OPTIONS))
+                sys.exit(1)
+            if 'first_in_tag' in self.group_by:
+                # first_in_ groups are elected from the tag groups
+                self.group_by.add('tag')
+        self.group_by_tag_keys = None
+        if config.has_option('ec2', 'group_by_tag_keys') and config.get('ec2', 'group_by_tag_keys').strip():
+            self.group_by_tag_keys = set(key.strip() for key in config.get('ec2', 'group_by_tag_keys').split(','))
+
         # Route53
         self.route53_enabled = config.getboolean('ec2', 'route53')
         self.route53_excluded_zones = []
         if config.has_option('ec2', 'route53_excluded_zones'):
             self.route53_excluded_zones.extend(
-                config.get('ec2', 'route53_excluded_zones', '').split(','))
+                config.get('ec2', 'route53_excluded_zones').split(','))
+        self.route53_cache_max_age = 3600
+        if config.has_option('ec2', 'route53_cache_max_age'):
+            self.route53_cache_max_age = config.getint('ec2', 'route53_cache_max_age')
 
         # Cache related
-        if 'EC2_CACHE_PATH' in os.environ:
-            cache_path = os.environ['EC2_CACHE_PATH']
-        elif self.args.cache_path:
-            cache_path = self.args.cache_path
-        else:
-            cache_path = config.get('ec2', 'cache_path')
+        cache_path = get_cache_path(self.args, config)
         if not os.path.exists(cache_path):
             os.makedirs(cache_path)
+        self.cache_path = cache_path
 
-        if 'AWS_PROFILE' in os.environ:
-            aws_profile = "{}-".format(os.environ.get('AWS_PROFILE'))
-        else:
-            aws_profile = ""
+        aws_profile = get_cache_prefix()
+
+        cache_format = 'json'
+        if config.has_option('ec2', 'cache_format'):
+            cache_format = config.get('ec2', 'cache_format')
+        if cache_format not in CACHE_FORMATS:
+            print("cache_format must be one of: %s" % ', '.join(sorted(CACHE_FORMATS)))
+            sys.exit(1)
+        self.cache = CACHE_FORMATS[cache_format](cache_path, aws_profile)
 
-        self.cache_path_cache = cache_path + f"/{aws_profile}ansible-ec2.cache"
         self.cache_path_tags = cache_path + f"/{aws_profile}ansible-ec2.tags.cache"
-        self.cache_path_index = cache_path + f"/{aws_profile}ansible-ec2.index"
+        self.cache_path_lock = cache_path + f"/{aws_profile}ansible-ec2.lock"
+        self.cache_path_state = cache_path + f"/{aws_profile}ansible-ec2.state"
+        self.cache_path_route53 = cache_path + f"/{aws_profile}ansible-ec2.route53"
         self.cache_max_age = config.getint('ec2', 'cache_max_age')
 
+        self.cache_stale_while_revalidate = False
+        if config.has_option('ec2', 'cache_stale_while_revalidate'):
+            self.cache_stale_while_revalidate = config.getboolean('ec2', 'cache_stale_while_revalidate')
+
+        # Incremental refresh
+        self.incremental_refresh = False
+        if config.has_option('ec2', 'incremental_refresh'):
+            self.incremental_refresh = config.getboolean('ec2', 'incremental_refresh')
+        self.full_refresh_interval = 3600
+        if config.has_option('ec2', 'full_refresh_interval'):
+            self.full_refresh_interval = config.getint('ec2', 'full_refresh_interval')
+
+        # Concurrency: number of region/service API calls made at the same time
+        self.max_workers = 10
+        if config.has_option('ec2', 'max_workers'):
+            self.max_workers = config.getint('ec2', 'max_workers')
+
+        # Daemon
+        self.daemon_socket = get_daemon_socket(self.args, config)
+
     def parse_cli_args(self):
         ''' Command line argument processing '''
 
-        parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on EC2')
-        parser.add_argument('--tags-only', action='store_true', default=False,
-                           help='only return tags (default: False)')
-        parser.add_argument('--list', action='store_true', default=True,
-                           help='List instances (default: True)')
-        parser.add_argument('--host', action='store',
-                           help='Get all the variables about a specific instance')
-        parser.add_argument('--refresh-cache', action='store_true', default=True,
-                           help='Force refresh of cache by making API requests to EC2 (default: False - use cache files)')
+        self.args = build_arg_parser().parse_args()
+
+
+    def run_daemon(self):
+        ''' Keeps the inventory in memory and serves it on a Unix socket to
+        thin copies of this script, refreshing it every cache_max_age seconds.
+        The cache files are kept up to date as well, for when the daemon is
+        not running. '''
+
+        self.refresh_daemon_inventory()
+
+        refresher = threading.Thread(target=self.refresh_daemon_inventory_forever)
+        refresher.daemon = True
+        refresher.start()
+
+        if os.path.exists(self.daemon_socket):
+            os.remove(self.daemon_socket)
 
-        default_inifile = os.environ.get("ANSIBLE_EC2_INI", os.path.dirname(os.path.realpath(__file__))+'/ec2.ini')
+        server = socketserver.ThreadingUnixStreamServer(self.daemon_socket, InventoryRequestHandler)
+        server.daemon_threads = True
+        server.inventory = self
+        os.chmod(self.daemon_socket, 0o600)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.daemon_socket)
+
+
+    def refresh_daemon_inventory(self):
+        ''' Rebuilds the inventory, and swaps in the responses of the daemon
+        once it is complete '''
+
+        self.inventory = self._empty_inventory()
+        self.index = {}
+        with self.cache_lock():
+            self.do_api_calls_update_cache()
 
-        parser.add_argument('--inifile', dest='inifile', help='Path to init script to use', default=default_inifile)
-        parser.add_argument(
-            '--cache-path',
-            help='Override the cache path set in ini file',
-            required=False)
-        self.args = parser.parse_args()
+        # Replaced in one go, so requests never see a half built inventory
+        self.daemon_data = (json_compact(self.inventory.to_dict()), self.inventory.hostvars)
+
+
+    def refresh_daemon_inventory_forever(self):
+        while True:
+            sleep(self.cache_max_age)
+            try:
+                self.refresh_daemon_inventory()
+            except Exception:
+                # Keep serving the previous inventory
+                traceback.print_exc()
+
+
+    def daemon_response(self, request):
+        ''' Returns the JSON answering a request of the daemon client '''
+
+        inventory_json, hostvars = self.daemon_data
+        if request.startswith('host '):
+            return json_compact(hostvars.get(request[len('host '):], {}))
+        return inventory_json
 
 
     def do_api_calls_update_cache(self):
         ''' Do API calls to each region, and save data in cache files '''
 
-        if self.route53_enabled:
-            self.get_route53_records()
+        refresh_time = time()
 
-        for region in self.regions:
-            self.get_instances_by_region(region)
-            self.get_rds_instances_by_region(region)
+        if self.can_refresh_incrementally():
+            self.do_api_calls_patch_cache(refresh_time)
+        else:
+            self.state = {
+                'version': STATE_VERSION,
+                'settings': self.inventory_settings_hash(),
+                'last_full_refresh': refresh_time,
+                'regions': {},
+            }
+
+            for region, service, instances in self.fetch_all_regions():
+                if service == 'ec2':
+                    for instance in instances:
+                        self.add_instance(instance, region)
+                else:
+                    for instance in instances:
+                        self.add_rds_instance(instance, region)
+                self.record_known_instances(region, service, instances, refresh_time)
+
+        self.sort_groups()
+        self.update_first_in_groups()
 
         if self.args.tags_only:
-            self.write_to_cache(self.inventory, self.cache_path_tags)
+            self.write_to_cache(self.inventory.to_dict(), self.cache_path_tags)
         else:
-            self.write_to_cache(self.inventory, self.cache_path_cache)
-
-        self.write_to_cache(self.index, self.cache_path_index)
+            self.cache.write(self.inventory.to_dict(), self.index)
+            self.write_to_cache(self.state, self.cache_path_state)
+
+    def can_refresh_incrementally(self):
+        ''' Determines if the cache can be patched with the changes since the
+        last refresh instead of being rebuilt from scratch '''
+
+        if not self.incremental_refresh or self.args.tags_only:
+            return False
+
+        if not (self.cache_exists() and os.path.isfile(self.cache_path_state)):
+            return False
+
+        with open(self.cache_path_state) as cache:
+            state = json.load(cache)
+
+        if state.get('version') != STATE_VERSION or sorted(state.get('regions', {})) != sorted(self.regions):
+            return False
+
+        # The cache was built with other settings in ec2.ini
+        if state.get('settings') != self.inventory_settings_hash():
+            return False
+
+        if state['last_full_refresh'] + self.full_refresh_interval <= time():
+            return False
+
+        self.state = state
+        return True
+
+    def inventory_settings_hash(self):
+        ''' Returns a hash of the settings from ec2.ini that shape the
+        inventory, which is kept in the state file so that an incremental
+        refresh never patches a cache built with other settings '''
+
+        settings = {
+            'regions': self.regions,
+            'eucalyptus_host': self.eucalyptus_host,
+            'destination_variable': self.destination_variable,
+            'vpc_destination_variable': self.vpc_destination_variable,
+            'instance_filters': self.instance_filters,
+            'group_by': sorted(self.group_by),
+            'group_by_tag_keys': None if self.group_by_tag_keys is None else sorted(self.group_by_tag_keys),
+            'route53': self.route53_enabled,
+            'route53_excluded_zones': sorted(self.route53_excluded_zones),
+        }
+        return hashlib.sha1(json_compact(settings).encode('utf-8')).hexdigest()
+
+    def do_api_calls_patch_cache(self, refresh_time):
+        ''' Loads the cache and patches it with the EC2 instances launched,
+        started again, stopped or terminated since the last refresh, as
+        returned by fetch_instance_changes_by_region '''
+
+        self.inventory = CompactInventory.from_dict(self.cache.read_inventory())
+        self.load_index_from_cache()
+        hosts = dict((tuple(location), dest) for dest, location in self.index.items())
+
+        results = self.fetch_all_regions(incremental=True)
+
+        # Every host to remove is collected first, so that the groups are
+        # only rebuilt once
+        removed = []
+        for region, service, changes in results:
+            mark = self.state['regions'][region]
+
+            if service == 'ec2':
+                launched, stopped = changes
+                known = mark['ec2_ids']
+
+                gone = set(instance.id for instance in stopped)
+                # Started again since the last refresh, with a new launch time
+                gone.update(instance.id for instance in launched
+                            if known.get(instance.id, instance.launch_time) != instance.launch_time)
+
+                for instance_id in gone:
+                    known.pop(instance_id, None)
+                    if (region, instance_id) in hosts:
+                        removed.append(hosts[(region, instance_id)])
+            else:
+                # There are few RDS instances, so they are always fetched again
+                for instance_id in mark['rds_ids']:
+                    if (region, instance_id) in hosts:
+                        removed.append(hosts[(region, instance_id)])
+
+        self.remove_hosts(removed)
+
+        for region, service, changes in results:
+            if service == 'ec2':
+                launched, stopped = changes
+                known = self.state['regions'][region]['ec2_ids']
+
+                # Instances launched in the overlap window that are already in
+                # the inventory are skipped
+                added = [instance for instance in launched if instance.id not in known]
+                for instance in added:
+                    self.add_instance(instance, region)
+                self.record_known_instances(region, service, added, refresh_time, pending=launched)
+            else:
+                for instance in changes:
+                    self.add_rds_instance(instance, region)
+                self.record_known_instances(region, service, changes, refresh_time)
+
+    def record_known_instances(self, region, service, instances, refresh_time, pending=None):
+        ''' Records the instances of a region that were added to the
+        inventory, with the launch time of the EC2 ones (which changes when
+        they are started again), and the region's launch time high-water
+        mark. The mark is the time of the refresh, or the launch time of the
+        earliest instance still pending, so that it is picked up once it
+        runs. '''
+
+        mark = self.state['regions'].setdefault(region, {'ec2_ids': {}, 'rds_ids': [], 'launch_time': None})
+        indexed = set(tuple(location) for location in self.index.values())
+        known = [instance for instance in instances if (region, instance.id) in indexed]
+
+        if service == 'ec2':
+            mark['ec2_ids'].update((instance.id, instance.launch_time) for instance in known)
+            mark['launch_time'] = min([format_launch_time(refresh_time)] + [
+                instance.launch_time for instance in (instances if pending is None else pending)
+                if instance.state == 'pending'])
+        else:
+            mark['rds_ids'] = sorted(instance.id for instance in known)
+
+    def sort_groups(self):
+        ''' Puts the hosts of every group in region order, then instance ID
+        order. The API returns reservations in no particular order, and an
+        incremental refresh only gets the instances that changed, so this is
+        what keeps both kinds of refresh in agreement. '''
+
+        regions = dict((region, position) for position, region in enumerate(self.regions))
+        index = self.index
+        self.inventory.sort_groups(
+            lambda host: (regions.get(index[host][0], len(regions)), index[host][1]) if host in index else (-1, host))
+
+    def fetch_all_regions(self, incremental=False):
+        ''' Makes the EC2 and RDS API calls for every region (and the Route53
+        calls if enabled) concurrently. Returns a list of (region, service,
+        instances) tuples in the order of self.regions, so that merging the
+        results into the inventory is deterministic. If incremental is True,
+        the EC2 result is the (launched, stopped) pair of lists returned by
+        fetch_instance_changes_by_region '''
+
+        fetchers = {
+            'ec2': self.fetch_instances_by_region,
+            'rds': self.fetch_rds_instances_by_region,
+        }
+        if incremental:
+            fetchers['ec2'] = self.fetch_instance_changes_by_region
+        tasks = [(region, service) for region in self.regions for service in ('ec2', 'rds')]
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            if self.route53_enabled:
+                route53_future = executor.submit(self.get_route53_records)
+
+            futures = [executor.submit(fetchers[service], region) for region, service in tasks]
+            results = [(region, service, future.result())
+                       for (region, service), future in zip(tasks, futures)]
+
+            # Route53 records are needed by add_instance, so wait for them
+            # before any result gets merged
+            if self.route53_enabled:
+                route53_future.result()
+
+        return results
 
     def get_instances_by_region(self, region):
         ''' Makes an AWS EC2 API call to the list of instances in a particular
-        region '''
+        region and adds them to the inventory '''
 
-        try:
-            if self.eucalyptus:
-                conn = boto.connect_euca(host=self.eucalyptus_host)
-                conn.APIVersion = '2010-08-31'
-            else:
-                conn = ec2.connect_to_region(region)
+        for instance in self.fetch_instances_by_region(region):
+            self.add_instance(instance, region)
 
-            # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-            if conn is None:
-                print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-                sys.exit(1)
+    def get_connection(self, region):
+        ''' Connects to the EC2 API of a particular region '''
+
+        if self.eucalyptus:
+            conn = boto.connect_euca(host=self.eucalyptus_host)
+            conn.APIVersion = '2010-08-31'
+        else:
+            conn = ec2.connect_to_region(region)
+
+        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
+        if conn is None:
+            print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
+            sys.exit(1)
+
+        return conn
+
+    def fetch_instances_by_region(self, region, filters=None):
+        ''' Makes an AWS EC2 API call to the list of instances in a particular
+        region and returns them sorted by reservation and instance ID. The
+        instance_filters from ec2.ini are sent along, unless filters sets
+        the same names. '''
 
-            reservations = conn.get_all_instances()
+        try:
+            conn = self.get_connection(region)
+
+            instances = []
+            reservations = conn.get_all_instances(filters=dict(self.instance_filters, **(filters or {})) or None)
             for reservation in reservations:
-                instances = sorted(reservation.instances, key=lambda x: x.id)
-                for instance in instances:
-                    self.add_instance(instance, region)
+                instances.extend(sorted(reservation.instances, key=lambda x: x.id))
+            return instances
 
         except boto.exception.BotoServerError as e:
             if  not self.eucalyptus:
@@ -308,40 +1105,56 @@ class Ec2Inventory:
             print(e)
             sys.exit(1)
 
+    def fetch_instance_changes_by_region(self, region):
+        ''' Makes AWS EC2 API calls for the instances of a particular region
+        that were launched (or started again) since its high-water mark, less
+        INCREMENTAL_OVERLAP seconds, and for the ones that are no longer
+        running. Returns both lists. '''
+
+        mark = self.state['regions'][region]['launch_time']
+        since = format_launch_time(parse_launch_time(mark) - INCREMENTAL_OVERLAP)
+
+        # launch-time only supports wildcards, so ask for every day since the
+        # high-water mark and drop the older instances afterwards
+        days = []
+        day = parse_launch_time(since[:10] + 'T00:00:00')
+        while day <= time() + 86400:
+            days.append(format_launch_time(day)[:10] + '*')
+            day += 86400
+
+        launched = self.fetch_instances_by_region(region, filters={
+            'instance-state-name': ['pending', 'running'],
+            'launch-time': days,
+        })
+        launched = [instance for instance in launched if instance.launch_time >= since]
+
+        stopped = self.fetch_instances_by_region(region, filters={
+            'instance-state-name': ['shutting-down', 'terminated', 'stopping', 'stopped'],
+        })
+
+        return launched, stopped
+
     def get_rds_instances_by_region(self, region):
         ''' Makes an AWS API call to the list of RDS instances in a particular
-        region '''
+        region and adds them to the inventory '''
+
+        for instance in self.fetch_rds_instances_by_region(region):
+            self.add_rds_instance(instance, region)
+
+    def fetch_rds_instances_by_region(self, region):
+        ''' Makes an AWS API call to the list of RDS instances in a particular
+        region and returns them '''
 
         try:
             conn = rds.connect_to_region(region)
             if conn:
-                instances = conn.get_all_dbinstances()
-                for instance in instances:
-                    self.add_rds_instance(instance, region)
+                return conn.get_all_dbinstances()
+            return []
         except boto.exception.BotoServerError as e:
             print("Looks like AWS RDS is down: ")
             print(e)
             sys.exit(1)
 
-    def get_instance(self, region, instance_id):
-        ''' Gets details about a specific instance '''
-        if self.eucalyptus:
-            conn = boto.connect_euca(self.eucalyptus_host)
-            conn.APIVersion = '2010-08-31'
-        else:
-            conn = ec2.connect_to_region(region)
-
-        # connect_to_region will fail "silently" by returning None if the region name is wrong or not supported
-        if conn is None:
-            print("region name: %s likely not supported, or AWS is down.  connection to region failed." % region)
-            sys.exit(1)
-
-        reservations = conn.get_all_instances([instance_id])
-        for reservation in reservations:
-            for instance in reservation.instances:
-                return instance
-
-
     def add_instance(self, instance, region):
         ''' Adds an instance to the inventory and index, as long as it is
         addressable '''
@@ -363,40 +1176,52 @@ class Ec2Inventory:
         # Add to index
         self.index[dest] = [region, instance.id]
 
+        # Host variables, served from the _meta block
+        self.inventory.hostvars[dest] = self.get_host_info_dict_from_instance(instance)
+
         # Inventory: Group by instance ID (always a group of 1)
-        self.inventory[instance.id] = [dest]
+        if 'instance_id' in self.group_by:
+            self.push(self.inventory, instance.id, dest)
 
         # Inventory: Group by region
-        self.push(self.inventory, region, dest)
+        if 'region' in self.group_by:
+            self.push(self.inventory, region, dest)
 
         # Inventory: Group by availability zone
-        self.push(self.inventory, instance.placement, dest)
+        if 'availability_zone' in self.group_by:
+            self.push(self.inventory, instance.placement, dest)
 
         # Inventory: Group by instance type
-        self.push(self.inventory, self.to_safe('type_' + instance.instance_type), dest)
+        if 'instance_type' in self.group_by:
+            self.push(self.inventory, self.to_safe('type_' + instance.instance_type), dest)
 
         # Inventory: Group by key pair
-        if instance.key_name:
+        if 'key_pair' in self.group_by and instance.key_name:
             self.push(self.inventory, self.to_safe('key_' + instance.key_name), dest)
 
         # Inventory: Group by security group
-        try:
-            for group in instance.groups:
-                key = self.to_safe("security_group_" + group.name)
-                self.push(self.inventory, key, dest)
-        except AttributeError:
-            print('Package boto seems a bit older.')
-            print('Please upgrade boto >= 2.3.0.')
-            sys.exit(1)
+        if 'security_group' in self.group_by:
+            try:
+                for group in instance.groups:
+                    key = self.to_safe("security_group_" + group.name)
+                    self.push(self.inventory, key, dest)
+            except AttributeError:
+                print('Package boto seems a bit older.')
+                print('Please upgrade boto >= 2.3.0.')
+                sys.exit(1)
 
         # Inventory: Group by tag keys
-        for k, v in instance.tags.items():
-            key = self.to_safe("tag_" + k + "=" + v)
-            self.push(self.inventory, key, dest)
-            self.keep_first(self.inventory, 'first_in_' + key, dest)
+        if 'tag' in self.group_by:
+            for k, v in instance.tags.items():
+                if self.group_by_tag_keys is not None and k not in self.group_by_tag_keys:
+                    continue
+                key = self.to_safe("tag_" + k + "=" + v)
+                self.push(self.inventory, key, dest)
+                if 'first_in_tag' in self.group_by:
+                    self.keep_first(self.inventory, 'first_in_' + key, dest)
 
         # Inventory: Group by Route53 domain names if enabled
-        if self.route53_enabled:
+        if self.route53_enabled and 'route53' in self.group_by:
             route53_names = self.get_instance_route53_names(instance)
             for name in route53_names:
                 self.push(self.inventory, name, dest)
@@ -424,38 +1249,50 @@ class Ec2Inventory:
         # Add to index
         self.index[dest] = [region, instance.id]
 
+        # Host variables, served from the _meta block
+        self.inventory.hostvars[dest] = self.get_host_info_dict_from_instance(instance)
+
         # Inventory: Group by instance ID (always a group of 1)
-        self.inventory[instance.id] = [dest]
+        if 'instance_id' in self.group_by:
+            self.push(self.inventory, instance.id, dest)
 
         # Inventory: Group by region
-        self.push(self.inventory, region, dest)
+        if 'region' in self.group_by:
+            self.push(self.inventory, region, dest)
 
         # Inventory: Group by availability zone
-        self.push(self.inventory, instance.availability_zone, dest)
+        if 'availability_zone' in self.group_by:
+            self.push(self.inventory, instance.availability_zone, dest)
 
         # Inventory: Group by instance type
-        self.push(self.inventory, self.to_safe('type_' + instance.instance_class), dest)
+        if 'instance_type' in self.group_by:
+            self.push(self.inventory, self.to_safe('type_' + instance.instance_class), dest)
 
         # Inventory: Group by security group
-        try:
-            if instance.security_group:
-                key = self.to_safe("security_group_" + instance.security_group.name)
-                self.push(self.inventory, key, dest)
-        except AttributeError:
-            print('Package boto seems a bit older.')
-            print('Please upgrade boto >= 2.3.0.')
-            sys.exit(1)
+        if 'security_group' in self.group_by:
+            try:
+                if instance.security_group:
+                    key = self.to_safe("security_group_" + instance.security_group.name)
+                    self.push(self.inventory, key, dest)
+            except AttributeError:
+                print('Package boto seems a bit older.')
+                print('Please upgrade boto >= 2.3.0.')
+                sys.exit(1)
 
         # Inventory: Group by engine
-        self.push(self.inventory, self.to_safe("rds_" + instance.engine), dest)
+        if 'rds_engine' in self.group_by:
+            self.push(self.inventory, self.to_safe("rds_" + instance.engine), dest)
 
         # Inventory: Group by parameter group
-        self.push(self.inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
+        if 'rds_parameter_group' in self.group_by:
+            self.push(self.inventory, self.to_safe("rds_parameter_group_" + instance.parameter_group.name), dest)
 
 
     def get_route53_records(self):
         ''' Get and store the map of resource records to domain names that
-        point to them. '''
+        point to them. Zones are kept in a persistent index and only fetched
+        again when their record count changed, or when they are older than
+        route53_cache_max_age. '''
 
         r53_conn = route53.Route53Connection()
         all_zones = r53_conn.get_zones()
@@ -463,20 +1300,71 @@ class Ec2Inventory:
         route53_zones = [ zone for zone in all_zones if zone.name[:-1]
                           not in self.route53_excluded_zones ]
 
-        self.route53_records = {}
+        cached_zones = {}
+        if os.path.isfile(self.cache_path_route53):
+            with open(self.cache_path_route53) as cache:
+                cached_zones = json.load(cache)
 
+        zones = {}
+        stale_zones = []
         for zone in route53_zones:
-            rrsets = r53_conn.get_all_rrsets(zone.id)
+            cached_zone = cached_zones.get(zone.id)
+            if (cached_zone and cached_zone['count'] == str(zone.resourcerecordsetcount) and
+                    cached_zone['updated'] + self.route53_cache_max_age > time()):
+                zones[zone.id] = cached_zone
+            else:
+                stale_zones.append(zone)
+
+        with ThreadPoolExecutor(max_workers=max(1, self.max_workers)) as executor:
+            for zone, records in zip(stale_zones, executor.map(self.get_route53_zone_records, stale_zones)):
+                zones[zone.id] = records
+
+        if stale_zones or sorted(zones) != sorted(cached_zones):
+            write_file(self.cache_path_route53, json_compact(zones))
+
+        self.route53_records = {}
+
+        for zone_id in sorted(zones):
+            names = zones[zone_id]['names']
+            for resource, name_ids in zones[zone_id]['records'].items():
+                self.route53_records.setdefault(resource, set())
+                self.route53_records[resource].update(names[i] for i in name_ids)
+
+
+    def get_route53_zone_records(self, zone):
+        ''' Get the resource records of a hosted zone, in the compact form
+        stored in the Route53 index: a table of the record names, and the map
+        of each resource record to the positions of the names pointing to it '''
+
+        # Connections are not shared between threads
+        r53_conn = route53.Route53Connection()
+        rrsets = r53_conn.get_all_rrsets(zone.id)
+
+        names = []
+        name_ids = {}
+        records = {}
+
+        for record_set in rrsets:
+            record_name = record_set.name
 
-            for record_set in rrsets:
-                record_name = record_set.name
+            if record_name.endswith('.'):
+                record_name = record_name[:-1]
 
-                if record_name.endswith('.'):
-                    record_name = record_name[:-1]
+            if record_name not in name_ids:
+                name_ids[record_name] = len(names)
+                names.append(record_name)
 
-                for resource in record_set.resource_records:
-                    self.route53_records.setdefault(resource, set())
-                    self.route53_records[resource].add(record_name)
+            for resource in record_set.resource_records:
+                records.setdefault(resource, [])
+                if name_ids[record_name] not in records[resource]:
+                    records[resource].append(name_ids[record_name])
+
+        return {
+            'count': str(zone.resourcerecordsetcount),
+            'updated': time(),
+            'names': names,
+            'records': records,
+        }
 
 
     def get_instance_route53_names(self, instance):
@@ -502,22 +1390,22 @@ class Ec2Inventory:
 
 
     def get_host_info(self):
-        ''' Get variables about a specific host '''
+        ''' Get variables about a specific host. They were computed when the
+        inventory was built, so this does not make any API call. '''
+
+        if self.inventory.is_empty():
+            # Only read the variables of this host from the cache
+            instance_vars = self.cache.read_hostvars(self.args.host)
+        else:
+            # The host might not exist anymore
+            instance_vars = self.inventory.hostvars.get(self.args.host, {})
 
-        if len(self.index) == 0:
-            # Need to load index from cache
-            self.load_index_from_cache()
+        return self.json_format_dict(instance_vars, self.args.pretty)
 
-        if not self.args.host in self.index:
-            # try updating the cache
-            self.do_api_calls_update_cache()
-            if not self.args.host in self.index:
-                # host migh not exist anymore
-                return self.json_format_dict({}, True)
 
-        (region, instance_id) = self.index[self.args.host]
+    def get_host_info_dict_from_instance(self, instance):
+        ''' Get variables about an EC2 or RDS instance '''
 
-        instance = self.get_instance(region, instance_id)
         instance_vars = {}
         for key in vars(instance):
             value = getattr(instance, key)
@@ -550,39 +1438,55 @@ class Ec2Inventory:
                 #print type(value)
                 #print value
 
-        return self.json_format_dict(instance_vars, True)
+        return instance_vars
 
 
     def push(self, my_dict, key, element):
         ''' Pushed an element onto an array that may not have been defined in
         the dict '''
 
-        if key in my_dict:
-            my_dict[key].append(element);
-        else:
-            my_dict[key] = [element]
+        my_dict.push(key, element)
 
     def keep_first(self, my_dict, key, element):
-        if key not in my_dict:
-            my_dict[key] = [element]
+        my_dict.keep_first(key, element)
+
+    def remove_hosts(self, dests):
+        ''' Removes hosts from the index and from every group they are in,
+        dropping the groups that end up empty '''
+
+        for dest in dests:
+            self.index.pop(dest, None)
+        self.inventory.remove_hosts(dests)
+
+    def update_first_in_groups(self):
+        ''' Makes every first_in_ group point at the first host of the tag
+        group it belongs to, after hosts were removed from the inventory '''
+
+        groups = self.inventory.groups
+        for key in list(groups):
+            if key.startswith('tag_') and 'first_in_tag' in self.group_by:
+                groups['first_in_' + key] = groups[key][:1]
+            elif key.startswith('first_in_') and key[len('first_in_'):] not in groups:
+                del groups[key]
 
     def get_inventory_from_cache(self):
         ''' Reads the inventory from the cache file and returns it as a JSON
         object '''
         if self.args.tags_only:
-            cache = open(self.cache_path_tags)
+            with open(self.cache_path_tags) as cache:
+                json_inventory = cache.read()
         else:
-            cache = open(self.cache_path_cache)
-        json_inventory = cache.read()
+            json_inventory = self.cache.inventory_json()
+
+        if self.args.pretty:
+            return json.dumps(json.loads(json_inventory), sort_keys=True, indent=2)
         return json_inventory
 
 
     def load_index_from_cache(self):
         ''' Reads the index from the cache file sets self.index '''
 
-        cache = open(self.cache_path_index)
-        json_index = cache.read()
-        self.index = json.loads(json_index)
+        self.index = self.cache.read_index()
 
 
     def write_to_cache(self, data, filename):
@@ -590,17 +1494,15 @@ class Ec2Inventory:
             Writes data in JSON format to a file
             '''
 
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        json_data = self.json_format_dict(data)
+        write_file(filename, json_data)
 
 
     def to_safe(self, word):
         ''' Converts 'bad' characters in a string to underscores so they can be
         used as Ansible groups '''
 
-        return re.sub(r"[^A-Za-z0-9\-]", "_", word)
+        return to_safe(word)
 
 
     def json_format_dict(self, data, pretty=False):
@@ -611,15 +1513,34 @@ class Ec2Inventory:
         if pretty:
             return json.dumps(data, sort_keys=True, indent=2)
         else:
-            return json.dumps(data)
+            return json_compact(data)
 
 
 # Run the script
 RETRIES = 3
 
-for _ in range(RETRIES):
-    try:
-        Ec2Inventory()
-        break
-    except Exception:
-        traceback.print_exc()
+# Bump whenever the contents of the state file change, so that the next
+# refresh is a full one
+STATE_VERSION = 4
+
+# Seconds before the launch time high-water mark of a region from which an
+# incremental refresh asks for launched instances again. It covers instances
+# launched in the same second as the previous refresh, and clock skew.
+INCREMENTAL_OVERLAP = 600
+
+# Seconds the client waits for the daemon before building the inventory itself
+DAEMON_TIMEOUT = 10
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    data_from_daemon = query_daemon(args, read_config(args))
+
+    if data_from_daemon is not None:
+        print(data_from_daemon)
+    else:
+        for _ in range(RETRIES):
+            try:
+                Ec2Inventory()
+                break
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,169 @@
+"""
+Config Encode action
+
+Encodes a data structure with one of the Config Encoder filters on the
+controller and writes it into a file on the remote host. The content is only
+transferred when its checksum differs from the checksum of the remote file.
+
+Example:
+
+    - name: Configure Grafana
+      config_encode:
+        encoder: ini
+        data: "{{ grafana_config }}"
+        options:
+          delimiter: "="
+        dest: /etc/grafana/grafana.ini
+        owner: grafana
+        mode: "0640"
+
+All other arguments (``owner``, ``mode``, ``backup``, ``validate``, ...) are
+passed to the ``copy`` module.
+"""
+
+from ansible import constants as C
+from ansible.errors import AnsibleAction, AnsibleActionFail
+from ansible.module_utils._text import to_bytes, to_text
+from ansible.module_utils.parsing.convert_bool import boolean
+from ansible.plugins.action import ActionBase
+from ansible.utils.hashing import checksum_s
+import importlib.util
+import os
+import shutil
+import tempfile
+
+
+# Arguments of the action which are not passed to the copy module
+ENCODE_ARGS = ('encoder', 'data', 'options')
+
+# Arguments of the copy module which don't change the content of the file
+CONTENT_ARGS = ('dest', 'follow', 'force', 'backup', 'validate', 'decrypt')
+
+
+def _load_filters():
+    """Return the Config Encoder filters of this role.
+
+    The Ansible filter loader can't return a single plugin by its name, so
+    the module is loaded directly from the filter_plugins directory.
+    """
+
+    path = os.path.join(
+        os.path.dirname(os.path.realpath(__file__)), '..', 'filter_plugins',
+        'config_encoders.py')
+    spec = importlib.util.spec_from_file_location('config_encoders', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module.FilterModule().filters()
+
+
+_filters = None
+
+
+def _get_encoder(name):
+    """Return the encoder filter of the given name (e.g. json)."""
+
+    global _filters
+
+    if _filters is None:
+        _filters = _load_filters()
+
+    return _filters.get('encode_%s' % name)
+
+
+class ActionModule(ActionBase):
+
+    TRANSFERS_FILES = True
+
+    def run(self, tmp=None, task_vars=None):
+        """Encode the data and copy it to the remote host if it changed."""
+
+        if task_vars is None:
+            task_vars = dict()
+
+        result = super(ActionModule, self).run(tmp, task_vars)
+        del tmp  # tmp no longer has any effect
+
+        try:
+            name = self._task.args.get('encoder')
+            data = self._task.args.get('data')
+            options = self._task.args.get('options') or {}
+            dest = self._task.args.get('dest')
+            follow = boolean(
+                self._task.args.get('follow', False), strict=False)
+
+            if name is None or dest is None:
+                raise AnsibleActionFail("encoder and dest are required")
+
+            if 'data' not in self._task.args:
+                raise AnsibleActionFail("data is required")
+
+            if not isinstance(options, dict):
+                raise AnsibleActionFail("options must be a dictionary")
+
+            encoder = _get_encoder(name)
+
+            if encoder is None:
+                raise AnsibleActionFail("Unknown encoder: %s" % name)
+
+            try:
+                content = encoder(data, **options)
+            except Exception as e:
+                raise AnsibleActionFail(
+                    "%s: %s" % (type(e).__name__, to_text(e)))
+
+            dest_stat = self._execute_remote_stat(
+                dest, all_vars=task_vars, follow=follow, checksum=True)
+
+            if dest_stat['exists'] and dest_stat['isdir']:
+                raise AnsibleActionFail("dest must be a file: %s" % dest)
+
+            # Without any file attributes to enforce, there is nothing left
+            # to do on the remote host when the content is the same
+            if (
+                    dest_stat['exists'] and
+                    dest_stat.get('checksum') == checksum_s(content) and
+                    set(self._task.args) <= set(ENCODE_ARGS + CONTENT_ARGS)):
+                result.update(dict(
+                    changed=False, dest=dest, checksum=dest_stat['checksum']))
+
+                return result
+
+            new_task = self._task.copy()
+
+            for remove in ENCODE_ARGS:
+                new_task.args.pop(remove, None)
+
+            local_tempdir = tempfile.mkdtemp(dir=C.DEFAULT_LOCAL_TMP)
+
+            try:
+                result_file = os.path.join(
+                    local_tempdir, os.path.basename(dest))
+
+                b_result_file = to_bytes(
+                    result_file, errors='surrogate_or_strict')
+
+                with open(b_result_file, 'wb') as f:
+                    f.write(to_bytes(content, errors='surrogate_or_strict'))
+
+                new_task.args.update(dict(src=result_file, dest=dest))
+
+                copy_action = self._shared_loader_obj.action_loader.get(
+                    'ansible.legacy.copy',
+                    task=new_task,
+                    connection=self._connection,
+                    play_context=self._play_context,
+                    loader=self._loader,
+                    templar=self._templar,
+                    shared_loader_obj=self._shared_loader_obj)
+                result.update(copy_action.run(task_vars=task_vars))
+            finally:
+                shutil.rmtree(
+                    to_bytes(local_tempdir, errors='surrogate_or_strict'))
+
+        except AnsibleAction as e:
+            result.update(e.result)
+        finally:
+            self._remove_tmp_path(self._connection._shell.tmpdir)
+
+        return result
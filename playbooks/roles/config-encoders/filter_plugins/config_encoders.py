@@ -22,11 +22,33 @@ More information: https://github.com/jtyr/ansible-config_encoder_filters
 """
 
 from ansible import errors
-from copy import copy
+from collections import OrderedDict, namedtuple
+from copy import copy, deepcopy
+from json.encoder import encode_basestring
+import ast
+import functools
+import hashlib
+import os
 import re
 import six
 
 
+# Environment variable with the number of encoded outputs the filters keep in
+# memory for reuse (0 disables the cache)
+CACHE_SIZE_ENV = 'CONFIG_ENCODERS_CACHE_SIZE'
+CACHE_SIZE_DEFAULT = 128
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# Specially decorated variable used by template_replace, e.g. {[{ item['key'] }]}
+TEMPLATE_VARIABLE = re.compile(r'\{\[\{\s*(\w+)([^}\s]+|)\s*\}\]\}')
+# One step of the path to the value of the decorated variable: .attr, [0] or ['key']
+TEMPLATE_ACCESSOR = re.compile(
+    r'''\.(\w+)|\[(-?\d+|'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")\]''')
+# Number of compiled template variables template_replace keeps
+TEMPLATE_CACHE_SIZE = 64
+
+
 def _str_is_bool(data):
     """Verify if data is boolean."""
 
@@ -64,7 +86,7 @@ def _is_num(data):
     but that requires Python v2.6+.
     """
 
-    return isinstance(data, int) or isinstance(data, float)
+    return isinstance(data, (int, float))
 
 
 def _escape(data, quote='"', format=None):
@@ -90,33 +112,108 @@ def _escape(data, quote='"', format=None):
         return data
 
 
+def _render(encoder, data, args=(), **options):
+    """Run an encoder on data and return its output as a string.
+
+    The private encoders are generators which append the output to the list
+    they are given. Instead of calling themselves for nested data, they
+    yield an (encoder, data, args) tuple with it, which is encoded here
+    before the encoder that yielded it is resumed, using an explicit stack
+    of the running encoders. That way, deeply nested data doesn't hit the
+    recursion limit, the options which are the same for the whole data
+    structure are passed around as one dict and the output is joined only
+    once. The args are the parameters which change from one level to
+    another.
+    """
+
+    out = []
+    stack = [encoder(out, options, data, *args)]
+
+    while stack:
+        for child_encoder, child_data, child_args in stack[-1]:
+            stack.append(child_encoder(out, options, child_data, *child_args))
+            break
+        else:
+            stack.pop()
+
+    return "".join(out)
+
+
 def encode_apache(
         data, convert_bools=False, convert_nums=False, indent="  ", level=0,
         quote_all_nums=False, quote_all_strings=False, block_type='sections'):
     """Convert Python data structure to Apache format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_apache,
+        data,
+        (level, block_type),
+        convert_bools=convert_bools,
+        convert_nums=convert_nums,
+        indent=indent,
+        quote_all_nums=quote_all_nums,
+        quote_all_strings=quote_all_strings)
+
+
+def _apache_value(options, data):
+    """Return the Apache format of a value which is not a list, or None."""
+
+    if isinstance(data, list):
+        return None
+
+    if (
+            isinstance(data, bool) or
+            options['convert_bools'] and _str_is_bool(data)):
+        # Value is a boolean
+
+        return str(data).lower()
+
+    elif (
+            _is_num(data) or
+            (options['convert_nums'] and _str_is_num(data))):
+        # Value is a number
+        if options['quote_all_nums']:
+            return '"%s"' % data
+        else:
+            return str(data)
+
+    elif isinstance(data, str):
+        # Value is a string
+        if (
+                options['quote_all_strings'] or
+                " " in data or
+                "\t" in data or
+                "\n" in data or
+                "\r" in data or
+                data == ""):
+
+            return '"%s"' % _escape(data)
+        else:
+            return data
+
+    return ""
+
+
+def _encode_apache(out, options, data, level, block_type):
+    """Append data in Apache format to out, yielding the nested data."""
+
+    indent = options['indent']
 
     if block_type == 'sections':
-        for c in data['content']:
+        last_content = len(data['content']) - 1
+
+        for ci, c in enumerate(data['content']):
             # First check if this section has options
             if 'options' in c:
-                rv += encode_apache(
-                    c['options'],
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    quote_all_nums=quote_all_nums,
-                    quote_all_strings=quote_all_strings,
-                    block_type='options')
+                yield (_encode_apache, c['options'], (level+1, 'options'))
 
             is_empty = False
 
             # Check if this section has some sub-sections
             if 'sections' in c:
-                for s in c['sections']:
+                last_section = len(c['sections']) - 1
+
+                for si, s in enumerate(c['sections']):
                     # Check for empty sub-sections
                     for i in s['content']:
                         if (
@@ -125,108 +222,65 @@ def encode_apache(
                             is_empty = True
 
                     if is_empty:
-                        rv += "%s<%s " % (indent * level, s['name'])
+                        out.append("%s<%s " % (indent * level, s['name']))
 
                         if 'operator' in s:
-                            rv += "%s " % s['operator']
+                            out.append("%s " % s['operator'])
 
                         if 'param' in s:
-                            rv += encode_apache(
-                                s['param'],
-                                convert_bools=convert_bools,
-                                convert_nums=convert_nums,
-                                indent=indent,
-                                level=level+1,
-                                quote_all_nums=quote_all_nums,
-                                quote_all_strings=quote_all_strings,
-                                block_type='value')
-
-                        rv += ">\n"
-                        rv += encode_apache(
-                            s,
-                            convert_bools=convert_bools,
-                            convert_nums=convert_nums,
-                            indent=indent,
-                            level=level+1,
-                            quote_all_nums=quote_all_nums,
-                            quote_all_strings=quote_all_strings,
-                            block_type='sections')
-                        rv += "%s</%s>\n" % (indent * level, s['name'])
+                            yield (
+                                _encode_apache, s['param'], (level+1, 'value'))
+
+                        out.append(">\n")
+                        yield (_encode_apache, s, (level+1, 'sections'))
+                        out.append("%s</%s>\n" % (indent * level, s['name']))
 
                         # If not last item of the loop
-                        if c['sections'][-1] != s:
-                            rv += "\n"
+                        if si != last_section:
+                            out.append("\n")
 
             if (
-                    data['content'][-1] != c and (
+                    ci != last_content and (
                         'options' in c and len(c['options']) > 0 or (
                             'sections' in c and
                             len(c['sections']) > 0 and
                             is_empty))):
-                rv += "\n"
+                out.append("\n")
 
     elif block_type == 'options':
         for o in data:
             for key, val in sorted(o.items()):
-                rv += "%s%s " % (indent * (level-1), key)
-                rv += encode_apache(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    quote_all_nums=quote_all_nums,
-                    quote_all_strings=quote_all_strings,
-                    block_type='value')
-                rv += "\n"
+                out.append("%s%s " % (indent * (level-1), key))
 
-    elif block_type == 'value':
-        if isinstance(data, bool) or convert_bools and _str_is_bool(data):
-            # Value is a boolean
+                value = _apache_value(options, val)
 
-            rv += str(data).lower()
+                if value is None:
+                    yield (_encode_apache, val, (level+1, 'value'))
+                else:
+                    out.append(value)
 
-        elif (
-                _is_num(data) or
-                (convert_nums and _str_is_num(data))):
-            # Value is a number
-            if quote_all_nums:
-                rv += '"%s"' % data
-            else:
-                rv += str(data)
+                out.append("\n")
 
-        elif isinstance(data, str):
-            # Value is a string
-            if (
-                    quote_all_strings or
-                    " " in data or
-                    "\t" in data or
-                    "\n" in data or
-                    "\r" in data or
-                    data == ""):
-
-                rv += '"%s"' % _escape(data)
-            else:
-                rv += data
+    elif block_type == 'value':
+        value = _apache_value(options, data)
 
-        elif isinstance(data, list):
+        if value is not None:
+            out.append(value)
+        else:
             # Value is a list
-            for v in data:
-                rv += encode_apache(
-                    v,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    quote_all_nums=quote_all_nums,
-                    quote_all_strings=quote_all_strings,
-                    block_type='value')
+            last = len(data) - 1
 
-                # If not last item of the loop
-                if data[-1] != v:
-                    rv += " "
+            for i, v in enumerate(data):
+                value = _apache_value(options, v)
 
-    return rv
+                if value is None:
+                    yield (_encode_apache, v, (level+1, 'value'))
+                else:
+                    out.append(value)
+
+                # If not last item of the loop
+                if i != last:
+                    out.append(" ")
 
 
 def encode_erlang(
@@ -234,37 +288,31 @@ def encode_erlang(
         convert_nums=False, indent="  ", level=0):
     """Convert Python data structure to Erlang format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_erlang,
+        data,
+        (level, atom_value_indicator),
+        convert_bools=convert_bools,
+        convert_nums=convert_nums,
+        indent=indent)
 
-    if isinstance(data, dict):
-        # It's a dict
 
-        rv += "\n"
-
-        for key, val in sorted(data.items()):
-            rv += "%s{%s," % (indent*level, key)
-
-            if not isinstance(val, dict):
-                rv += " "
+def _erlang_value(options, data, atom_value_indicator):
+    """Return the Erlang format of a value which is not a dict or a list, or
+    None."""
 
-            rv += encode_erlang(
-                val,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                indent=indent,
-                level=level+1)
+    if isinstance(data, (dict, list)):
+        return None
 
-            rv += "}"
-    elif (
+    if (
             data == "null" or
             _is_num(data) or
             isinstance(data, bool) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
+            (options['convert_nums'] and _str_is_num(data)) or
+            (options['convert_bools'] and _str_is_bool(data))):
         # It's null, number or boolean
 
-        rv += str(data).lower()
+        return str(data).lower()
 
     elif isinstance(data, str):
         # It's a string
@@ -276,50 +324,87 @@ def encode_erlang(
                 data[0:atom_len] == atom_value_indicator):
 
             # Atom configuration value
-            rv += data[atom_len:]
+            return data[atom_len:]
         else:
-            rv += '"%s"' % _escape(data)
+            return '"%s"' % _escape(data)
+
+    return None
+
+
+def _encode_erlang(out, options, data, level, atom_value_indicator):
+    """Append data in Erlang format to out, yielding the nested data.
+
+    Nested values are encoded with the default atom value indicator.
+    """
+
+    indent = options['indent']
+
+    if isinstance(data, dict):
+        # It's a dict
+
+        out.append("\n")
 
+        for key, val in sorted(data.items()):
+            out.append("%s{%s," % (indent*level, key))
+
+            if not isinstance(val, dict):
+                out.append(" ")
+
+            value = _erlang_value(options, val, ":")
+
+            if value is None:
+                yield (_encode_erlang, val, (level+1, ":"))
+            else:
+                out.append(value)
+
+            out.append("}")
+
+        return
+
+    value = _erlang_value(options, data, atom_value_indicator)
+
+    if value is not None:
+        out.append(value)
     else:
         # It's a list
 
-        rv += "["
+        out.append("[")
+
+        last = len(data) - 1
 
-        for val in data:
+        for i, val in enumerate(data):
             if (
                     isinstance(val, str) or
                     _is_num(val)):
-                rv += "\n%s" % (indent*level)
+                out.append("\n%s" % (indent*level))
 
-            rv += encode_erlang(
-                val,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                indent=indent,
-                level=level+1)
+            value = _erlang_value(options, val, ":")
 
-            if data[-1] == val:
+            if value is None:
+                yield (_encode_erlang, val, (level+1, ":"))
+            else:
+                out.append(value)
+
+            if i == last:
                 # Last item of the loop
-                rv += "\n"
+                out.append("\n")
             else:
-                rv += ","
+                out.append(",")
 
         if len(data) > 0:
-            rv += "%s]" % (indent * (level-1))
+            out.append("%s]" % (indent * (level-1)))
         else:
-            rv += "]"
+            out.append("]")
 
         if level == 0:
-            rv += ".\n"
-
-    return rv
+            out.append(".\n")
 
 
 def encode_haproxy(data, indent="  "):
     """Convert Python data structure to HAProxy format."""
 
     # Return value
-    rv = ""
+    rv = []
     # Indicates first loop
     first = True
     # Indicates whether the previous section was a comment
@@ -332,21 +417,21 @@ def encode_haproxy(data, indent="  "):
             prev_comment = False
         else:
             # Print empty line between sections
-            rv += "\n"
+            rv.append("\n")
 
         if isinstance(section, dict):
             # It's a section
-            rv += "%s\n" % list(section.keys())[0]
+            rv.append("%s\n" % list(section.keys())[0])
 
             # Process all parameters of the section
             for param in list(section.values())[0]:
-                rv += "%s%s\n" % (indent, param)
+                rv.append("%s%s\n" % (indent, param))
         else:
             # It's a comment of a parameter
-            rv += "%s\n" % section
+            rv.append("%s\n" % section)
             prev_comment = True
 
-    return rv
+    return "".join(rv)
 
 
 def encode_ini(
@@ -354,12 +439,30 @@ def encode_ini(
         ucase_prop=False):
     """Convert Python data structure to INI format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_ini,
+        data,
+        (comment,),
+        delimiter=delimiter,
+        quote=quote,
+        section_is_comment=section_is_comment,
+        ucase_prop=ucase_prop)
+
+
+def _encode_ini(out, options, data, comment):
+    """Append data in INI format to out, yielding the nested sections.
+
+    Nested sections are commented with the default comment.
+    """
+
+    delimiter = options['delimiter']
+    quote = options['quote']
+    # Where the output of this section starts
+    start = len(out)
 
     # First process all standalone properties
     for prop, val in sorted(data.items()):
-        if ucase_prop:
+        if options['ucase_prop']:
             prop = prop.upper()
 
         vals = []
@@ -371,114 +474,145 @@ def encode_ini(
 
         for item in vals:
             if item is not None:
-                rv += "%s%s%s%s%s\n" % (
-                    prop, delimiter, quote, _escape(item, quote), quote)
+                out.append("%s%s%s%s%s\n" % (
+                    prop, delimiter, quote, _escape(item, quote), quote))
 
     # Then process all sections
     for section, props in sorted(data.items()):
         if isinstance(props, dict):
-            if rv != "":
-                rv += "\n"
+            if len(out) > start:
+                out.append("\n")
 
-            if section_is_comment:
-                rv += "%s %s\n" % (comment, section)
+            if options['section_is_comment']:
+                out.append("%s %s\n" % (comment, section))
             else:
-                rv += "[%s]\n" % (section)
+                out.append("[%s]\n" % (section))
 
             # Let process all section options as standalone properties
-            rv += encode_ini(
-                props,
-                delimiter=delimiter,
-                quote=quote,
-                section_is_comment=section_is_comment,
-                ucase_prop=ucase_prop)
-
-    return rv
+            yield (_encode_ini, props, ("#",))
 
 
 def encode_json(
         data, convert_bools=False, convert_nums=False, indent="  ", level=0):
     """Convert Python data structure to JSON format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_json,
+        data,
+        (level,),
+        convert_bools=convert_bools,
+        convert_nums=convert_nums,
+        indent=indent)
+
+
+def _json_value(options, data):
+    """Return the JSON format of a value which is not a dict or a list, or
+    None."""
+
+    if isinstance(data, (dict, list)):
+        return None
+
+    if (
+            data == "null" or
+            _is_num(data) or
+            (options['convert_nums'] and _str_is_num(data)) or
+            (options['convert_bools'] and _str_is_bool(data))):
+        # It's a number, null or boolean
+
+        return str(data).lower()
+
+    elif isinstance(data, str):
+        # It's a string
+
+        # The C string encoder of the json module escapes the same
+        # characters, except the other control characters which it
+        # escapes as \u00XX
+        rv = encode_basestring(data)
+
+        if "\\u00" in rv:
+            rv = '"%s"' % _escape(_escape(data), format='control')
+
+        return rv
+
+    return None
+
+
+def _encode_json(out, options, data, level):
+    """Append data in JSON format to out, yielding the nested data."""
+
+    indent = options['indent']
 
     if isinstance(data, dict):
         # It's a dict
 
-        rv += "{"
+        out.append("{")
 
         if len(data) > 0:
-            rv += "\n"
+            out.append("\n")
 
         items = sorted(data.items())
+        last = len(items) - 1
+
+        for i, (key, val) in enumerate(items):
+            out.append('%s"%s": ' % (indent * (level+1), key))
 
-        for key, val in items:
-            rv += '%s"%s": ' % (indent * (level+1), key)
-            rv += encode_json(
-                val,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                indent=indent,
-                level=level+1)
+            value = _json_value(options, val)
+
+            if value is None:
+                yield (_encode_json, val, (level+1,))
+            else:
+                out.append(value)
 
             # Last item of the loop
-            if items[-1] == (key, val):
-                rv += "\n"
+            if i == last:
+                out.append("\n")
             else:
-                rv += ",\n"
+                out.append(",\n")
 
         if len(data) > 0:
-            rv += "%s}" % (indent * level)
+            out.append("%s}" % (indent * level))
         else:
-            rv += "}"
+            out.append("}")
 
         if level == 0:
-            rv += "\n"
+            out.append("\n")
 
-    elif (
-            data == "null" or
-            _is_num(data) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's a number, null or boolean
+        return
 
-        rv += str(data).lower()
-
-    elif isinstance(data, str):
-        # It's a string
-
-        rv += '"%s"' % _escape(_escape(data), format='control')
+    value = _json_value(options, data)
 
+    if value is not None:
+        out.append(value)
     else:
         # It's a list
 
-        rv += "["
+        out.append("[")
 
         if len(data) > 0:
-            rv += "\n"
+            out.append("\n")
+
+        last = len(data) - 1
 
-        for val in data:
-            rv += indent * (level+1)
-            rv += encode_json(
-                val,
-                convert_bools=convert_bools,
-                convert_nums=convert_nums,
-                indent=indent,
-                level=level+1)
+        for i, val in enumerate(data):
+            out.append(indent * (level+1))
+
+            value = _json_value(options, val)
+
+            if value is None:
+                yield (_encode_json, val, (level+1,))
+            else:
+                out.append(value)
 
             # Last item of the loop
-            if data[-1] == val:
-                rv += "\n"
+            if i == last:
+                out.append("\n")
             else:
-                rv += ",\n"
+                out.append(",\n")
 
         if len(data) > 0:
-            rv += "%s]" % (indent * level)
+            out.append("%s]" % (indent * level))
         else:
-            rv += "]"
-
-    return rv
+            out.append("]")
 
 
 def encode_logstash(
@@ -486,125 +620,162 @@ def encode_logstash(
         prevtype="", section_prefix=":"):
     """Convert Python data structure to Logstash format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_logstash,
+        data,
+        (level, prevtype, section_prefix),
+        convert_bools=convert_bools,
+        convert_nums=convert_nums,
+        indent=indent)
+
+
+def _logstash_value(options, data):
+    """Return the Logstash format of a value which is not a dict or a list,
+    or None."""
+
+    if isinstance(data, (dict, list)):
+        return None
+
+    if (
+            _is_num(data) or
+            isinstance(data, bool) or
+            (options['convert_nums'] and _str_is_num(data)) or
+            (options['convert_bools'] and _str_is_bool(data))):
+        # It's number or boolean
+
+        return str(data).lower()
+
+    elif isinstance(data, str):
+        # It's a string
+
+        return '"%s"' % _escape(data)
+
+    return None
+
+
+def _encode_logstash(out, options, data, level, prevtype, section_prefix):
+    """Append data in Logstash format to out, yielding the nested data.
+
+    Nested data is encoded with the default section prefix.
+    """
+
+    indent = options['indent']
 
     if isinstance(data, dict):
         # The item is a dict
 
         if prevtype in ('value', 'value_hash', 'array'):
-            rv += "{\n"
+            out.append("{\n")
 
         items = sorted(data.items())
+        last = len(items) - 1
 
-        for key, val in items:
+        for i, (key, val) in enumerate(items):
             if key[0] == section_prefix:
-                rv += "%s%s {\n" % (indent * level, key[1:])
-                rv += encode_logstash(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    prevtype='block')
+                out.append("%s%s {\n" % (indent * level, key[1:]))
+
+                value = _logstash_value(options, val)
+
+                if value is None:
+                    yield (_encode_logstash, val, (level+1, 'block', ":"))
+                else:
+                    out.append(value)
 
                 # Last item of the loop
-                if items[-1] == (key, val):
+                if i == last:
                     if (
                             isinstance(val, str) or
                             _is_num(val) or
                             isinstance(val, bool) or (
                                 isinstance(val, dict) and
                                 list(val.keys())[0][0] != section_prefix)):
-                        rv += "\n%s}\n" % (indent * level)
+                        out.append("\n%s}\n" % (indent * level))
                     else:
-                        rv += "%s}\n" % (indent * level)
+                        out.append("%s}\n" % (indent * level))
             else:
-                rv += indent * level
+                out.append(indent * level)
 
                 if prevtype == 'value_hash':
-                    rv += '"%s" => ' % key
+                    out.append('"%s" => ' % key)
                 else:
-                    rv += "%s => " % key
+                    out.append("%s => " % key)
 
-                rv += encode_logstash(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    prevtype=(
-                        'value_hash' if isinstance(val, dict) else 'value'))
+                value = _logstash_value(options, val)
+
+                if value is None:
+                    yield (_encode_logstash, val, (
+                        level+1,
+                        'value_hash' if isinstance(val, dict) else 'value',
+                        ":"))
+                else:
+                    out.append(value)
 
             if (
-                    items[-1] != (key, val) and (
+                    i != last and (
                         isinstance(val, str) or
                         _is_num(val) or
                         isinstance(val, bool))):
-                rv += "\n"
+                out.append("\n")
 
         if prevtype in ('value', 'value_hash', 'array'):
-            rv += "\n%s}" % (indent * (level-1))
+            out.append("\n%s}" % (indent * (level-1)))
 
             if prevtype in ('value', 'value_array'):
-                rv += "\n"
-
-    elif (
-            _is_num(data) or
-            isinstance(data, bool) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's number or boolean
-
-        rv += str(data).lower()
+                out.append("\n")
 
-    elif isinstance(data, str):
-        # It's a string
+        return
 
-        rv += '"%s"' % _escape(data)
+    value = _logstash_value(options, data)
 
+    if value is not None:
+        out.append(value)
     else:
         # It's a list
 
-        for val in data:
+        last = len(data) - 1
+
+        for i, val in enumerate(data):
             if isinstance(val, dict) and list(val.keys())[0][0] == section_prefix:
                 # Value is a block
 
-                rv += encode_logstash(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level,
-                    prevtype='block')
+                yield (_encode_logstash, val, (level, 'block', ":"))
             else:
                 # First item of the loop
-                if data[0] == val:
-                    rv += "[\n"
-
-                rv += indent * level
-                rv += encode_logstash(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    prevtype='array')
+                if i == 0:
+                    out.append("[\n")
 
-                # Last item of the loop
-                if data[-1] == val:
-                    rv += "\n%s]" % (indent * (level-1))
+                out.append(indent * level)
+
+                value = _logstash_value(options, val)
+
+                if value is None:
+                    yield (_encode_logstash, val, (level+1, 'array', ":"))
                 else:
-                    rv += ",\n"
+                    out.append(value)
 
-    return rv
+                # Last item of the loop
+                if i == last:
+                    out.append("\n%s]" % (indent * (level-1)))
+                else:
+                    out.append(",\n")
 
 
 def encode_nginx(data, indent="  ", level=0, block_semicolon=False):
     """Convert Python data structure to Nginx format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_nginx,
+        data,
+        (level, indent),
+        block_semicolon=block_semicolon)
+
+
+def _encode_nginx(out, options, data, level, indent):
+    """Append data in Nginx format to out, yielding the nested blocks.
+
+    Nested blocks are indented with the default indentation.
+    """
+
     # Indicates the item type [section|line]
     item_type = ""
 
@@ -612,45 +783,41 @@ def encode_nginx(data, indent="  ", level=0, block_semicolon=False):
         if isinstance(item, dict):
             # Section
             if item_type in ('section', 'line'):
-                rv += "\n"
+                out.append("\n")
 
-            rv += "%s%s {\n" % (level*indent, list(item.keys())[0])
-            rv += encode_nginx(
-                list(item.values())[0],
-                level=level+1,
-                block_semicolon=block_semicolon)
-            rv += "%s}%s\n" % (level*indent, ';' if block_semicolon else '')
+            out.append("%s%s {\n" % (level*indent, list(item.keys())[0]))
+            yield (_encode_nginx, list(item.values())[0], (level+1, "  "))
+            out.append("%s}%s\n" % (
+                level*indent, ';' if options['block_semicolon'] else ''))
 
             item_type = 'section'
 
         elif isinstance(item, str):
             # Normal line
             if item_type == 'section':
-                rv += "\n"
+                out.append("\n")
 
             item_type = 'line'
 
-            rv += "%s%s" % (level*indent, item)
+            out.append("%s%s" % (level*indent, item))
 
             # Do not finish comments with semicolon
             if item.startswith("# "):
-                rv += "\n"
+                out.append("\n")
             else:
-                rv += ";\n"
+                out.append(";\n")
 
         else:
             raise errors.AnsibleFilterError(
                 "Unexpected data type: %s" % (type(item)))
 
-    return rv
-
 
 def encode_pam(
         data, print_label=False, separate_types=True, separator="  "):
     """Convert Python data structure to PAM format."""
 
     # Return value
-    rv = ""
+    rv = []
     # Remember previous type to make newline between type blocks
     prev_type = None
 
@@ -658,46 +825,46 @@ def encode_pam(
         if separate_types:
             # Add extra newline to separate blocks of the same type
             if prev_type is not None and prev_type != rule['type']:
-                rv += "\n"
+                rv.append("\n")
 
             prev_type = rule['type']
 
         if print_label:
-            rv += "# %s\n" % label
+            rv.append("# %s\n" % label)
 
         if 'service' in rule:
-            rv += "%s%s" % (rule['service'], separator)
+            rv.append("%s%s" % (rule['service'], separator))
 
         if 'silent' in rule and rule['silent']:
-            rv += '-'
+            rv.append('-')
 
-        rv += "%s%s" % (rule['type'], separator)
+        rv.append("%s%s" % (rule['type'], separator))
 
         if isinstance(rule['control'], list):
-            rv += "[%s]%s" % (
+            rv.append("[%s]%s" % (
                 " ".join(
                     ["=".join(map(str, k)) for k in [list(x.items())[0] for x in rule['control']]]),
-                separator)
+                separator))
         else:
-            rv += "%s%s" % (rule['control'], separator)
+            rv.append("%s%s" % (rule['control'], separator))
 
-        rv += rule['path']
+        rv.append(rule['path'])
 
         if 'args' in rule and rule['args']:
-            rv += separator
+            rv.append(separator)
 
             for i, arg in enumerate(rule['args']):
                 if i > 0:
-                    rv += ' '
+                    rv.append(' ')
 
                 if isinstance(arg, dict):
-                    rv += "=".join(map(str, list(arg.items())[0]))
+                    rv.append("=".join(map(str, list(arg.items())[0])))
                 else:
-                    rv += arg
+                    rv.append(arg)
 
-        rv += "\n"
+        rv.append("\n")
 
-    return rv
+    return "".join(rv)
 
 
 def encode_toml(
@@ -705,8 +872,52 @@ def encode_toml(
         indent="  ", level=0, prevkey="", prevtype="", quote='"'):
     """Convert Python data structure to TOML format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_toml,
+        data,
+        (first, level, prevkey, prevtype, quote),
+        convert_bools=convert_bools,
+        convert_nums=convert_nums,
+        indent=indent)
+
+
+def _toml_value(options, data, prevtype, quote):
+    """Return the TOML format of a value which is not a dict or a list, or
+    None."""
+
+    if isinstance(data, (dict, list)):
+        return None
+
+    if (
+            _is_num(data) or
+            isinstance(data, bool) or
+            (options['convert_nums'] and _str_is_num(data)) or
+            (options['convert_bools'] and _str_is_bool(data))):
+        # It's number or boolean
+
+        rv = str(data).lower()
+
+    elif isinstance(data, str):
+        # It's a string
+
+        rv = "%s%s%s" % (quote, _escape(data, quote), quote)
+
+    else:
+        return None
+
+    if prevtype != 'list':
+        rv += "\n"
+
+    return rv
+
+
+def _encode_toml(out, options, data, first, level, prevkey, prevtype, quote):
+    """Append data in TOML format to out, yielding the nested data.
+
+    Nested data is encoded with the default quote.
+    """
+
+    indent = options['indent']
 
     if isinstance(data, dict):
         # It's a dict
@@ -722,15 +933,14 @@ def encode_toml(
                         not isinstance(val[0], dict))):
                 # The value is string, number, boolean or list
 
-                rv += "%s%s = " % (indent * level, key)
-                rv += encode_toml(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    first=first,
-                    indent=indent,
-                    level=level,
-                    prevkey=prevkey)
+                out.append("%s%s = " % (indent * level, key))
+
+                value = _toml_value(options, val, "", '"')
+
+                if value is None:
+                    yield (_encode_toml, val, (first, level, prevkey, "", '"'))
+                else:
+                    out.append(value)
 
                 first = False
 
@@ -740,7 +950,7 @@ def encode_toml(
                     isinstance(val, dict) or
                     isinstance(val, list) and isinstance(val[0], dict)):
 
-                # Values for the next recursive call
+                # Values for the nested data
                 tmp_prevkey = prevkey
                 tmp_level = level
 
@@ -758,9 +968,9 @@ def encode_toml(
                         tmp_prevkey = "%s.%s" % (prevkey, key)
 
                     if not first:
-                        rv += "\n"
+                        out.append("\n")
 
-                    rv += "%s[%s]\n" % (indent * tmp_level, tmp_prevkey)
+                    out.append("%s[%s]\n" % (indent * tmp_level, tmp_prevkey))
                 elif isinstance(val[0], dict):
                     # The val is a table
                     if re.match(r'^[a-zA-Z0-9_-]+$', key) is None:
@@ -773,82 +983,66 @@ def encode_toml(
 
                     tmp_level += 1
 
-                rv += encode_toml(
-                    val,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    first=first,
-                    indent=indent,
-                    level=tmp_level,
-                    prevkey=tmp_prevkey)
+                yield (_encode_toml, val, (
+                    first, tmp_level, tmp_prevkey, "", '"'))
 
                 first = False
 
-    elif (
-            _is_num(data) or
-            isinstance(data, bool) or
-            (convert_nums and _str_is_num(data)) or
-            (convert_bools and _str_is_bool(data))):
-        # It's number or boolean
-
-        rv += str(data).lower()
-
-        if prevtype != 'list':
-            rv += "\n"
-
-    elif isinstance(data, str):
-        # It's a string
+        return
 
-        rv += "%s%s%s" % (
-            quote, _escape(data, quote), quote)
+    value = _toml_value(options, data, prevtype, quote)
 
-        if prevtype != 'list':
-            rv += "\n"
+    if value is not None:
+        out.append(value)
+    elif isinstance(data[0], dict):
+        # It's a list of tables
 
+        for d in data:
+            out.append("\n%s[[%s]]\n" % (indent * level, prevkey))
+            yield (_encode_toml, d, (first, level, "", "", '"'))
     else:
         # It's a list
 
-        if isinstance(data[0], dict):
-            for d in data:
-                rv += "\n%s[[%s]]\n" % (indent * level, prevkey)
-                rv += encode_toml(
-                    d,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    first=first,
-                    indent=indent,
-                    level=level)
-        else:
-            rv += "["
-
-            for d in data:
-                rv += encode_toml(
-                    d,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    first=first,
-                    indent=indent,
-                    level=level,
-                    prevtype='list')
+        out.append("[")
 
-                # Last item of the loop
-                if data[-1] != d:
-                    rv += ", "
+        last = len(data) - 1
 
-            rv += "]"
+        for i, d in enumerate(data):
+            value = _toml_value(options, d, 'list', '"')
 
-            if prevtype != 'list':
-                rv += "\n"
+            if value is None:
+                yield (_encode_toml, d, (first, level, "", 'list', '"'))
+            else:
+                out.append(value)
 
-    return rv
+            # Last item of the loop
+            if i != last:
+                out.append(", ")
+
+        out.append("]")
+
+        if prevtype != 'list':
+            out.append("\n")
 
 
 def encode_xml(
         data, attribute_sign="^", escape_xml=True, indent="  ", level=0):
     """Convert Python data structure to XML format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_xml,
+        data,
+        (level,),
+        attribute_sign=attribute_sign,
+        escape_xml=escape_xml,
+        indent=indent)
+
+
+def _encode_xml(out, options, data, level):
+    """Append data in XML format to out, yielding the nested data."""
+
+    attribute_sign = options['attribute_sign']
+    indent = options['indent']
 
     if isinstance(data, list):
         # Pocess anything what's not attribute
@@ -857,12 +1051,7 @@ def encode_xml(
                     not (
                         isinstance(item, dict) and
                         list(item.keys())[0].startswith(attribute_sign))):
-                rv += encode_xml(
-                    item,
-                    attribute_sign=attribute_sign,
-                    indent=indent,
-                    level=level,
-                    escape_xml=escape_xml)
+                yield (_encode_xml, item, (level,))
     elif isinstance(data, dict):
         # It's eiher an attribute or an element
 
@@ -870,10 +1059,10 @@ def encode_xml(
 
         if key.startswith(attribute_sign):
             # Process attribute
-            rv += ' %s="%s"' % (key[1:], _escape(val))
+            out.append(' %s="%s"' % (key[1:], _escape(val)))
         else:
             # Process element
-            rv = '%s<%s' % (level*indent, key)
+            out.append('%s<%s' % (level*indent, key))
 
             # Check if there are any attributes
             if isinstance(val, list):
@@ -884,18 +1073,14 @@ def encode_xml(
                             isinstance(item, dict) and
                             list(item.keys())[0].startswith(attribute_sign)):
                         num_attrs += 1
-                        rv += encode_xml(
-                            item,
-                            attribute_sign=attribute_sign,
-                            indent=indent,
-                            level=level)
+                        yield (_encode_xml, item, (level,))
 
             if val == '' or (isinstance(val, list) and num_attrs == len(val)):
                 # Close the element as empty
-                rv += " />\n"
+                out.append(" />\n")
             else:
                 # Close the element as normal
-                rv += ">"
+                out.append(">")
 
                 # Check if the value is text
                 val_not_text = False
@@ -912,26 +1097,20 @@ def encode_xml(
                     val_not_text = True
 
                 if val_not_text:
-                    rv += "\n"
+                    out.append("\n")
 
                 # Process inner content of the element
-                rv += encode_xml(
-                    val,
-                    attribute_sign=attribute_sign,
-                    indent=indent,
-                    level=level+1,
-                    escape_xml=escape_xml)
+                yield (_encode_xml, val, (level+1,))
 
                 if val_not_text:
-                    rv += level*indent
+                    out.append(level*indent)
 
-                rv += "</%s>\n" % key
+                out.append("</%s>\n" % key)
     else:
         # It's a string
 
-        rv += "%s" % _escape(data, format=('xml' if escape_xml else None))
-
-    return rv
+        out.append("%s" % _escape(
+            data, format=('xml' if options['escape_xml'] else None)))
 
 
 def encode_yaml(
@@ -939,117 +1118,415 @@ def encode_yaml(
         quote='"', skip_indent=False):
     """Convert Python data structure to YAML format."""
 
-    # Return value
-    rv = ""
+    return _render(
+        _encode_yaml,
+        data,
+        (level, skip_indent),
+        convert_bools=convert_bools,
+        convert_nums=convert_nums,
+        indent=indent,
+        quote=quote)
+
+
+def _yaml_value(options, data):
+    """Return the YAML format of a value which is not a dict or a list, or
+    None."""
+
+    if isinstance(data, (dict, list)):
+        return None
+
+    if (
+            data == "null" or
+            isinstance(data, bool) or
+            (options['convert_bools'] and _str_is_bool(data))):
+        # It's a boolean
+
+        return "%s\n" % str(data).lower()
+
+    elif (
+            _is_num(data) or
+            (options['convert_nums'] and _str_is_num(data))):
+        # It's a number
+
+        return "%s\n" % str(data)
+
+    else:
+        # It's a string
+
+        quote = options['quote']
+
+        if quote == '"' and isinstance(data, str):
+            # Use the C string encoder of the json module if it didn't escape
+            # anything, otherwise it could have escaped control characters
+            rv = encode_basestring(data)
+
+            if len(rv) == len(data) + 2:
+                return "%s\n" % rv
+
+        return "%s%s%s\n" % (quote, _escape(data, quote), quote)
+
+
+def _encode_yaml(out, options, data, level, skip_indent):
+    """Append data in YAML format to out, yielding the nested data."""
+
+    indent = options['indent']
 
     if isinstance(data, dict):
         # It's a dictionary
 
         if len(list(data.keys())) == 0:
-            rv += "{}\n"
+            out.append("{}\n")
         else:
             for i, (key, val) in enumerate(sorted(data.items())):
                 # Skip indentation only for the first pair
-                rv += "%s%s:" % ("" if i == 0 and skip_indent else level*indent, key)
+                out.append("%s%s:" % ("" if i == 0 and skip_indent else level*indent, key))
 
                 if isinstance(val, dict) and len(list(val.keys())) == 0:
-                    rv += " {}\n"
+                    out.append(" {}\n")
                 else:
                     if (
                             isinstance(val, dict) or (
                                 isinstance(val, list) and
                                 len(val) != 0)):
-                        rv += "\n"
+                        out.append("\n")
                     else:
-                        rv += " "
+                        out.append(" ")
 
-                    rv += encode_yaml(
-                        val,
-                        convert_bools=convert_bools,
-                        convert_nums=convert_nums,
-                        indent=indent,
-                        level=level+1,
-                        quote=quote)
+                    value = _yaml_value(options, val)
+
+                    if value is None:
+                        yield (_encode_yaml, val, (level+1, False))
+                    else:
+                        out.append(value)
 
     elif isinstance(data, list):
         # It's a list
 
         if len(data) == 0:
-            rv += "[]\n"
+            out.append("[]\n")
         else:
             for item in data:
-                list_indent = "%s- " % (level*indent)
+                out.append("%s- " % (level*indent))
 
-                rv += "%s%s" % (list_indent, encode_yaml(
-                    item,
-                    convert_bools=convert_bools,
-                    convert_nums=convert_nums,
-                    indent=indent,
-                    level=level+1,
-                    quote=quote,
-                    skip_indent=True))
+                value = _yaml_value(options, item)
 
-    elif (
-            data == "null" or
-            isinstance(data, bool) or
-            (convert_bools and _str_is_bool(data))):
-        # It's a boolean
+                if value is None:
+                    yield (_encode_yaml, item, (level+1, True))
+                else:
+                    out.append(value)
 
-        rv += "%s\n" % str(data).lower()
+    else:
+        out.append(_yaml_value(options, data))
 
-    elif (
-            _is_num(data) or
-            (convert_nums and _str_is_num(data))):
-        # It's a number
 
-        rv += "%s\n" % str(data)
+class CompiledTemplate(object):
+    """Template variable analyzed once by compile_template, to be applied to
+    many replacement variables.
+
+    Only the strings containing the specially decorated variables and the
+    lists and dicts containing such strings are rebuilt when the template is
+    applied. Everything else is shared with the template variable.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self._root = _compile_node(data)
+
+    def apply(self, replacement):
+        """Replace the decorated variables with their value in replacement."""
+
+        if self._root is None:
+            return self.data
+
+        return _apply_node(self._root, self.data, replacement)
+
+
+def _compile_accessor(accessor):
+    """Parse the accessor following the variable name (e.g. ['key'].attr[0])
+    into a list of (is_attribute, name_or_key) steps.
+
+    Returns None if the accessor is not a chain of attributes and indexes.
+    """
+
+    steps = []
+    pos = 0
+
+    while pos < len(accessor):
+        m = TEMPLATE_ACCESSOR.match(accessor, pos)
+
+        if m is None:
+            return None
+
+        if m.group(1) is not None:
+            if m.group(1).startswith('_'):
+                # Do not expose private attributes
+                return None
+
+            steps.append((True, m.group(1)))
+        else:
+            try:
+                steps.append((False, ast.literal_eval(m.group(2))))
+            except (SyntaxError, ValueError):
+                return None
+
+        pos = m.end()
+
+    return steps
+
+
+def _compile_node(data):
+    """Return the compiled form of data, or None if there is nothing to
+    replace in it."""
+
+    if isinstance(data, list):
+        children = []
+
+        for i, val in enumerate(data):
+            node = _compile_node(val)
+
+            if node is not None:
+                children.append((i, node))
 
+        if children:
+            return ('list', children)
+    elif isinstance(data, dict):
+        children = []
+
+        for key, val in data.items():
+            node = _compile_node(val)
+
+            if node is not None:
+                children.append((key, node))
+
+        if children:
+            return ('dict', children)
+    elif isinstance(data, str):
+        parts = []
+        pos = 0
+
+        for m in TEMPLATE_VARIABLE.finditer(data):
+            parts.append(data[pos:m.start()])
+            parts.append(_compile_accessor(m.group(2)))
+            pos = m.end()
+
+        if parts:
+            parts.append(data[pos:])
+
+            return ('str', parts)
+
+    return None
+
+
+def _apply_node(node, data, replacement):
+    """Return the compiled data with the replacement applied."""
+
+    kind, children = node
+
+    if kind == 'str':
+        rv = []
+
+        for part in children:
+            if isinstance(part, str):
+                rv.append(part)
+            else:
+                rv.append(_resolve(part, replacement))
+
+        return "".join(rv)
+
+    if kind == 'list':
+        rv = list(data)
     else:
-        # It's a string
+        # Keep the type of the dict
+        rv = copy(data)
 
-        rv += "%s%s%s\n" % (quote, _escape(data, quote), quote)
+    for key, child in children:
+        rv[key] = _apply_node(child, data[key], replacement)
 
     return rv
 
 
-def __eval_replace(match):
-    """Evaluate the real value of the variable specified as a string."""
+def _resolve(steps, replacement):
+    """Return the value the accessor steps point to in replacement as a
+    string, or an empty string if there is no such value."""
+
+    if steps is None:
+        return ''
 
-    ret = '__item'
-    ret += ''.join(match.groups()[1:])
+    val = replacement
 
-    # Try to evaluate the value of the special string
     try:
-        ret = eval(ret)
+        for is_attribute, name in steps:
+            if is_attribute:
+                val = getattr(val, name)
+            else:
+                val = val[name]
     except Exception:
-        # Return empty string if something went wrong
-        ret = ''
+        return ''
+
+    return str(val)
+
 
-    return str(ret)
+def compile_template(data):
+    """Analyze the template variable for applying it with many replacements.
+
+    template_replace(data, item) is the same as
+    compile_template(data).apply(item).
+    """
+
+    return CompiledTemplate(data)
+
+
+# The templates compiled by template_replace, by the id of the template, with
+# a copy of the template as it was compiled
+_templates = OrderedDict()
 
 
 def template_replace(data, replacement):
     """Replace special template decorated variable with its real value."""
 
-    # Make the replacement variable visible for the __eval_replace function
-    global __item
-    __item = replacement
+    cached = _templates.pop(id(data), None)
+
+    # The id of a template which doesn't exist anymore can be reused, and a
+    # template can be changed in place, so only reuse the compiled variables
+    # if the template is still equal to its copy
+    if cached is not None and cached[0] == data:
+        root = cached[1]
+    else:
+        try:
+            copied = deepcopy(data)
+        except Exception:
+            return compile_template(data).apply(replacement)
+
+        root = _compile_node(data)
+        cached = (copied, root)
+
+        if len(_templates) >= TEMPLATE_CACHE_SIZE:
+            _templates.popitem(last=False)
+
+    _templates[id(data)] = cached
+
+    if root is None:
+        return data
+
+    return _apply_node(root, data, replacement)
+
+
+def _fingerprint(data):
+    """Return a digest of data which only equals the digest of another data
+    structure if all encoders produce the same output for both.
+
+    The type of every value is part of the digest as the encoders treat
+    e.g. 1, 1.0, True and "1" differently. Returns None if data contains a
+    value which is not a dict, list, tuple, string, number, bool or None.
+    """
+
+    tokens = []
+    stack = [data]
+
+    while stack:
+        item = stack.pop()
+
+        if isinstance(item, bool):
+            tokens.append("b%d" % item)
+        elif isinstance(item, six.integer_types):
+            tokens.append("i%d;" % item)
+        elif isinstance(item, float):
+            tokens.append("f%r;" % item)
+        elif isinstance(item, six.string_types):
+            tokens.append("s%d:%s" % (len(item), item))
+        elif item is None:
+            tokens.append("n")
+        elif isinstance(item, dict):
+            # Keep the order of the keys as some encoders use the first one
+            tokens.append("d%d:" % len(item))
+
+            for key, val in reversed(list(item.items())):
+                stack.append(val)
+                stack.append(key)
+        elif isinstance(item, (list, tuple)):
+            tokens.append(
+                "%s%d:" % ("l" if isinstance(item, list) else "t", len(item)))
+            stack.extend(reversed(item))
+        else:
+            return None
+
+    return hashlib.sha1(
+        "".join(tokens).encode('utf-8', 'surrogatepass')).hexdigest()
+
+
+class EncoderCache(object):
+    """Bounded LRU cache of the output of the encoders.
+
+    The output is keyed by the fingerprint of the data and of the options the
+    encoder was called with, so the same configuration templated for many
+    hosts is only encoded once per process.
+    """
+
+    def __init__(self, maxsize=CACHE_SIZE_DEFAULT):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._outputs = OrderedDict()
+
+    def wrap(self, encoder):
+        """Return the encoder with its output cached."""
+
+        @functools.wraps(encoder)
+        def cached_encoder(data, *args, **kwargs):
+            if self.maxsize <= 0:
+                return encoder(data, *args, **kwargs)
+
+            key = _fingerprint(
+                (encoder.__name__, data, args, sorted(kwargs.items())))
+
+            if key is None:
+                return encoder(data, *args, **kwargs)
+
+            if key in self._outputs:
+                self.hits += 1
+                rv = self._outputs.pop(key)
+            else:
+                self.misses += 1
+                rv = encoder(data, *args, **kwargs)
+
+                if len(self._outputs) >= self.maxsize:
+                    # Drop the least recently used output
+                    self._outputs.popitem(last=False)
+
+            self._outputs[key] = rv
+
+            return rv
+
+        return cached_encoder
+
+    def info(self):
+        """Return the hits, misses, maximum and current size of the cache."""
+
+        return CacheInfo(
+            self.hits, self.misses, self.maxsize, len(self._outputs))
+
+    def clear(self):
+        """Empty the cache and reset its statistics."""
+
+        self.hits = 0
+        self.misses = 0
+        self._outputs.clear()
+
+
+_cache = EncoderCache(
+    int(os.environ.get(CACHE_SIZE_ENV, CACHE_SIZE_DEFAULT)))
+
+
+def cache_info():
+    """Return the statistics of the cache of the encoder filters."""
+
+    return _cache.info()
 
-    # Clone the data to keep the original untouched
-    local_data = copy(data)
 
-    # Walk through the data structure and try to replace all special strings
-    if isinstance(local_data, list):
-        local_data = [template_replace(x, replacement) for x in local_data]
-    elif isinstance(local_data, dict):
-        for key, val in local_data.items():
-            local_data[key] = template_replace(val, replacement)
-    elif isinstance(local_data, str):
-        # Replace the special string by it's evaluated value
-        p = re.compile(r'\{\[\{\s*(\w+)([^}\s]+|)\s*\}\]\}')
-        local_data = p.sub(__eval_replace, local_data)
+def cache_clear():
+    """Empty the cache of the encoder filters."""
 
-    return local_data
+    _cache.clear()
 
 
 class FilterModule:
@@ -1059,16 +1536,16 @@ class FilterModule:
         """Expose filters to ansible."""
 
         return {
-            'encode_apache': encode_apache,
-            'encode_erlang': encode_erlang,
-            'encode_haproxy': encode_haproxy,
-            'encode_ini': encode_ini,
-            'encode_json': encode_json,
-            'encode_logstash': encode_logstash,
-            'encode_nginx': encode_nginx,
-            'encode_pam': encode_pam,
-            'encode_toml': encode_toml,
-            'encode_xml': encode_xml,
-            'encode_yaml': encode_yaml,
+            'encode_apache': _cache.wrap(encode_apache),
+            'encode_erlang': _cache.wrap(encode_erlang),
+            'encode_haproxy': _cache.wrap(encode_haproxy),
+            'encode_ini': _cache.wrap(encode_ini),
+            'encode_json': _cache.wrap(encode_json),
+            'encode_logstash': _cache.wrap(encode_logstash),
+            'encode_nginx': _cache.wrap(encode_nginx),
+            'encode_pam': _cache.wrap(encode_pam),
+            'encode_toml': _cache.wrap(encode_toml),
+            'encode_xml': _cache.wrap(encode_xml),
+            'encode_yaml': _cache.wrap(encode_yaml),
             'template_replace': template_replace,
         }
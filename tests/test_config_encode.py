@@ -0,0 +1,78 @@
+# Tests for the config_encode action in playbooks/roles/config-encoders
+#
+# How to run these tests:
+# python -m pytest tests/test_config_encode.py
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+from ansible.utils.hashing import checksum_s
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "playbooks", "roles",
+                                "config-encoders", "action_plugins"))
+
+import config_encode
+
+
+class TestConfigEncode(unittest.TestCase):
+    data = {"section": {"key": "value"}}
+    content = "[section]\nkey = value\n"
+
+    def run_action(self, remote_stat, **args):
+        task = mock.MagicMock(async_val=0)
+        task.args = dict(dict(encoder="ini", data=self.data, dest="/etc/app.ini"), **args)
+        task.copy.return_value.args = dict(task.args)
+        shared_loader_obj = mock.MagicMock()
+        copy_action = shared_loader_obj.action_loader.get.return_value
+        copied = {}
+
+        def copy_run(task_vars):
+            with open(task.copy.return_value.args["src"]) as f:
+                copied["content"] = f.read()
+            copied["args"] = dict(task.copy.return_value.args)
+            return dict(changed=True)
+
+        copy_action.run.side_effect = copy_run
+
+        action = config_encode.ActionModule(
+            task, mock.MagicMock(), mock.MagicMock(check_mode=False), mock.MagicMock(), mock.MagicMock(),
+            shared_loader_obj)
+
+        with mock.patch.object(action, "_execute_remote_stat", return_value=remote_stat):
+            result = action.run(task_vars={})
+
+        return result, copied
+
+    def test_unchanged_content_is_not_copied(self):
+        result, copied = self.run_action(dict(exists=True, isdir=False, checksum=checksum_s(self.content)))
+        self.assertFalse(result["changed"])
+        self.assertEqual(copied, {})
+
+    def test_changed_content_is_copied(self):
+        result, copied = self.run_action(dict(exists=True, isdir=False, checksum="0" * 40), mode="0644")
+        self.assertTrue(result["changed"])
+        self.assertEqual(copied["content"], self.content)
+        self.assertEqual(copied["args"]["dest"], "/etc/app.ini")
+        self.assertEqual(copied["args"]["mode"], "0644")
+        self.assertNotIn("data", copied["args"])
+
+    def test_file_attributes_are_enforced(self):
+        result, copied = self.run_action(
+            dict(exists=True, isdir=False, checksum=checksum_s(self.content)), owner="root")
+        self.assertEqual(copied["content"], self.content)
+
+    def test_missing_file_is_copied(self):
+        result, copied = self.run_action(dict(exists=False))
+        self.assertEqual(copied["content"], self.content)
+
+    def test_unknown_encoder(self):
+        result, copied = self.run_action(dict(exists=False), encoder="csv")
+        self.assertTrue(result["failed"])
+        self.assertIn("Unknown encoder", result["msg"])
+        self.assertEqual(copied, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
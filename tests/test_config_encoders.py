@@ -0,0 +1,168 @@
+# Tests for the config encoder filters in playbooks/roles/config-encoders
+#
+# How to run these tests:
+# python -m pytest tests/test_config_encoders.py
+
+import os
+import random
+import sys
+import unittest
+
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "playbooks", "roles",
+                                "config-encoders", "filter_plugins"))
+
+import config_encoders
+
+# Directory with the input and the expected output of the golden-file tests
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "config_encoders")
+
+
+class TestEncoders(unittest.TestCase):
+    def test_duplicate_list_items(self):
+        self.assertEqual(config_encoders.encode_json([1, 1]), "[\n  1,\n  1\n]")
+        self.assertEqual(config_encoders.encode_erlang(["a", "a"]), '[\n"a",\n"a"\n].\n')
+        self.assertEqual(config_encoders.encode_toml({"a": ["x", "x"]}), 'a = ["x", "x"]\n')
+
+
+class TestGoldenFiles(unittest.TestCase):
+    def test_output(self):
+        with open(os.path.join(GOLDEN_DIR, "cases.yml")) as f:
+            cases = yaml.safe_load(f)
+
+        for name, case in cases.items():
+            with self.subTest(case=name):
+                with open(os.path.join(GOLDEN_DIR, "%s.out" % name), newline="") as f:
+                    expected = f.read()
+
+                encoder = getattr(config_encoders, case["filter"])
+                self.assertEqual(encoder(case["data"], **case.get("options", {})), expected)
+
+
+class TestDeepNesting(unittest.TestCase):
+    depth = sys.getrecursionlimit() * 5
+
+    def test_lists(self):
+        data = 1
+        for _ in range(self.depth):
+            data = [data]
+        self.assertEqual(config_encoders.encode_json(data, indent=""), "[\n" * self.depth + "1" + "\n]" * self.depth)
+
+    def test_dicts(self):
+        data = {"k": 1}
+        for _ in range(self.depth):
+            data = {"k": data}
+        self.assertEqual(config_encoders.encode_yaml(data, indent=""), "k:\n" * self.depth + "k: 1\n")
+
+
+class TestStringEscaping(unittest.TestCase):
+    alphabet = [chr(i) for i in range(0x20)] + ['\\', '"', "'", 'u', '0', 'a', ' ', '\x7f', '\u00e9', '\u2028', '\ud800']
+
+    def random_strings(self, count=2000):
+        rng = random.Random(25)
+        for _ in range(count):
+            yield "".join(rng.choice(self.alphabet) for _ in range(rng.randint(0, 8)))
+
+    def test_json(self):
+        for data in self.random_strings():
+            expected = '"%s"' % config_encoders._escape(config_encoders._escape(data), format='control')
+            self.assertEqual(config_encoders.encode_json(data), expected, repr(data))
+            self.assertEqual(config_encoders.encode_json({"k": [data]}), '{\n  "k": [\n    %s\n  ]\n}\n' % expected)
+
+    def test_yaml(self):
+        for data in self.random_strings():
+            for quote in ('"', "'"):
+                expected = '%s%s%s\n' % (quote, config_encoders._escape(data, quote), quote)
+                self.assertEqual(config_encoders.encode_yaml(data, quote=quote), expected, repr(data))
+
+
+class TestTemplateReplace(unittest.TestCase):
+    template = [{"Job": [
+        "Name = Job-{[{ item['jobdefs'] }]}-{[{ item[\"host\"] }]}",
+        "Client = {[{item['host']}]}-fd",
+        "Ports = {[{ item['ports'][0] }]} {[{ item['ports'][-1] }]}",
+        "Missing = {[{ item['missing'] }]}{[{ item.__class__ }]}{[{ item['host']+'x' }]}",
+    ], "Static": ["Catalog = Default", {"Retention": "3 months"}]}]
+
+    def test_replace(self):
+        item = {"host": "myclient01", "jobdefs": "Default", "ports": [9101, 9102]}
+        self.assertEqual(config_encoders.template_replace(self.template, item), [{"Job": [
+            "Name = Job-Default-myclient01",
+            "Client = myclient01-fd",
+            "Ports = 9101 9102",
+            "Missing = ",
+        ], "Static": ["Catalog = Default", {"Retention": "3 months"}]}])
+        self.assertEqual(config_encoders.template_replace("{[{ item }]}/{[{ item.real }]}", 5), "5/5")
+
+    def test_untouched_data_is_shared(self):
+        compiled = config_encoders.compile_template(self.template)
+        first = compiled.apply({"host": "a"})
+        second = compiled.apply({"host": "b"})
+        self.assertIsNot(first[0]["Job"], second[0]["Job"])
+        self.assertIs(first[0]["Static"], self.template[0]["Static"])
+        self.assertIs(second[0]["Static"], self.template[0]["Static"])
+        self.assertEqual(self.template[0]["Job"][1], "Client = {[{item['host']}]}-fd")
+
+    def test_template_changed_in_place(self):
+        template = {"Client": "{[{ item['host'] }]}-fd", "Static": ["Catalog = Default"]}
+        self.assertEqual(config_encoders.template_replace(template, {"host": "a"}),
+                         {"Client": "a-fd", "Static": ["Catalog = Default"]})
+
+        template["Client"] = "{[{ item['host'] }]}-client"
+        template["Static"].append("Port = {[{ item['port'] }]}")
+        self.assertEqual(config_encoders.template_replace(template, {"host": "a", "port": 9102}),
+                         {"Client": "a-client", "Static": ["Catalog = Default", "Port = 9102"]})
+
+        del template["Client"]
+        template["Static"][1] = "Port = 9101"
+        result = config_encoders.template_replace(template, {"host": "a", "port": 9102})
+        self.assertEqual(result, {"Static": ["Catalog = Default", "Port = 9101"]})
+        self.assertIs(result, template)
+
+
+class TestEncoderCache(unittest.TestCase):
+    def setUp(self):
+        self.cache = config_encoders.EncoderCache(maxsize=2)
+        self.encode_yaml = self.cache.wrap(config_encoders.encode_yaml)
+
+    def test_hits_and_misses(self):
+        data = {"a": [1, {"b": "c"}]}
+        self.assertEqual(self.encode_yaml(data), config_encoders.encode_yaml(data))
+        self.assertEqual(self.encode_yaml({"a": [1, {"b": "c"}]}), config_encoders.encode_yaml(data))
+        self.assertEqual(self.encode_yaml(data, quote="'"), config_encoders.encode_yaml(data, quote="'"))
+        self.assertEqual(self.cache.info(), config_encoders.CacheInfo(hits=1, misses=2, maxsize=2, currsize=2))
+
+    def test_types_are_not_mixed_up(self):
+        for value in [1, 1.0, True, "1", [1], (1,)]:
+            self.assertEqual(self.encode_yaml({"a": value}), config_encoders.encode_yaml({"a": value}))
+        self.assertEqual(self.cache.info().hits, 0)
+
+    def test_least_recently_used_output_is_dropped(self):
+        self.encode_yaml({"a": 1})
+        self.encode_yaml({"b": 1})
+        self.encode_yaml({"a": 1})
+        self.encode_yaml({"c": 1})
+        self.encode_yaml({"a": 1})
+        self.assertEqual(self.cache.info(), config_encoders.CacheInfo(hits=2, misses=3, maxsize=2, currsize=2))
+
+    def test_disabled_and_uncacheable(self):
+        cache = config_encoders.EncoderCache(maxsize=0)
+        encode_yaml = cache.wrap(config_encoders.encode_yaml)
+        encode_yaml({"a": 1})
+        encode_yaml({"a": 1})
+        self.assertEqual(cache.info(), config_encoders.CacheInfo(hits=0, misses=0, maxsize=0, currsize=0))
+
+        self.encode_yaml({"a": object()})
+        self.assertEqual(self.cache.info().currsize, 0)
+
+    def test_filters_are_cached(self):
+        config_encoders.cache_clear()
+        filters = config_encoders.FilterModule().filters()
+        filters["encode_ini"]({"section": {"key": "value"}})
+        filters["encode_ini"]({"section": {"key": "value"}})
+        self.assertEqual(config_encoders.cache_info().hits, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,507 @@
+# Tests for the EC2 dynamic inventory script in playbooks/ec2.py, run against
+# the stand-in for the AWS APIs of util/ec2_inventory_benchmark.py
+#
+# How to run these tests:
+# python -m pytest tests/test_ec2_inventory.py
+
+import configparser
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "util"))
+
+import ec2_inventory_benchmark as benchmark
+
+REGIONS = ["us-east-1", "eu-west-1"]
+
+ec2_inventory = benchmark.load_ec2_script()
+
+
+class Ec2InventoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp()
+        self.fake = benchmark.FakeAWS(REGIONS, 60, latency=0)
+
+        # The cache path and prefix must come from the generated ec2.ini
+        environ = mock.patch.dict(os.environ)
+        environ.start()
+        self.addCleanup(environ.stop)
+        os.environ.pop("EC2_CACHE_PATH", None)
+        os.environ.pop("AWS_PROFILE", None)
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir)
+
+    def inifile(self, name, **options):
+        """Writes an ec2.ini using its own cache directory and the given options."""
+        inifile = os.path.join(self.workdir, name + ".ini")
+        benchmark.write_inifile(inifile, REGIONS, os.path.join(self.workdir, name))
+
+        config = configparser.ConfigParser()
+        config.read(inifile)
+        for option, value in options.items():
+            config.set("ec2", option, str(value))
+        with open(inifile, "w") as f:
+            config.write(f)
+
+        return inifile
+
+    def run_inventory(self, inifile, *argv):
+        return benchmark.run_inventory(ec2_inventory, self.fake, ["--inifile", inifile] + list(argv))
+
+
+class TestFakeAWS(unittest.TestCase):
+    def test_describe_instances_filters(self):
+        fake = benchmark.FakeAWS(REGIONS, 60, latency=0)
+        instances = fake.instances["eu-west-1"]
+        instances[4].launch_time = "2021-03-14T15:09:26.000Z"
+
+        def describe(filters):
+            return [instance.id for reservation in fake.describe_instances("eu-west-1", filters)
+                    for instance in reservation.instances]
+
+        self.assertEqual(describe({"launch-time": ["2021-03-14T*"]}), [instances[4].id])
+        self.assertEqual(describe({"launch-time": "2021-03-1?T15:09:26.000Z"}), [instances[4].id])
+        self.assertEqual(describe({"launch-time": ["2021-03-14"]}), [])
+        self.assertEqual(describe({"instance-state-name": ["running"], "tag:Name": ["service-?-1*"],
+                                   "vpc-id": ["vpc-0001"]}),
+                         [instance.id for instance in instances
+                          if instance.state == "running" and instance.vpc_id == "vpc-0001" and
+                          instance.tags["Name"].startswith("service-") and instance.tags["Name"][10] == "1"])
+
+        with self.assertRaises(ValueError):
+            describe({"instance-lifecycle": ["spot"]})
+
+
+class TestCompactInventory(unittest.TestCase):
+    def test_remove_hosts(self):
+        inventory = ec2_inventory.CompactInventory.from_dict({
+            "web": ["10.0.0.1", "10.0.0.2", "10.0.0.3"],
+            "db": ["10.0.0.4"],
+            "i-0002": ["10.0.0.2"],
+            "_meta": {"hostvars": dict(("10.0.0.%d" % n, {"n": n}) for n in range(1, 5))},
+        })
+        inventory.remove_hosts(["10.0.0.2", "10.0.0.4", "10.0.0.9"])
+        inventory.push("web", "10.0.0.2")
+
+        self.assertEqual(inventory.to_dict(), {
+            "web": ["10.0.0.1", "10.0.0.3", "10.0.0.2"],
+            "_meta": {"hostvars": {"10.0.0.1": {"n": 1}, "10.0.0.3": {"n": 3}}},
+        })
+
+
+class TestInventoryCaches(Ec2InventoryTestCase):
+    INVENTORY = {
+        "tag_Name_web": ["10.0.0.1", "10.0.0.2"],
+        "us-east-1": ["10.0.0.2", "10.0.0.1"],
+        "i-0001": ["10.0.0.1"],
+        "_meta": {"hostvars": {
+            "10.0.0.1": {"ec2_id": "i-0001", "ec2_tag_Name": "web \u00e9\"1\""},
+            "10.0.0.2": {"ec2_id": "i-0002", "ec2_tag_Name": "web"},
+        }},
+    }
+    INDEX = {"10.0.0.1": ["us-east-1", "i-0001"], "10.0.0.2": ["us-east-1", "i-0002"]}
+
+    def test_write_and_read(self):
+        for cache_format, cache_class in sorted(ec2_inventory.CACHE_FORMATS.items()):
+            with self.subTest(cache_format=cache_format):
+                cache = cache_class(self.workdir, cache_format + "-")
+                cache.write(self.INVENTORY, self.INDEX)
+
+                self.assertTrue(all(os.path.isfile(filename) for filename in cache.files))
+                self.assertEqual(cache.read_inventory(), self.INVENTORY)
+                self.assertEqual(cache.read_index(), self.INDEX)
+                self.assertEqual(cache.read_hostvars("10.0.0.1"), self.INVENTORY["_meta"]["hostvars"]["10.0.0.1"])
+                self.assertEqual(cache.read_hostvars("10.0.0.3"), {})
+                self.assertEqual(cache.inventory_json(), ec2_inventory.json_compact(self.INVENTORY))
+
+    def test_marshal_cache_is_not_shared_between_python_versions(self):
+        ec2_inventory.MarshalInventoryCache(self.workdir, "").write(self.INVENTORY, self.INDEX)
+
+        with mock.patch.object(ec2_inventory.MarshalInventoryCache, "extension", ".py27.marshal"):
+            other_version = ec2_inventory.MarshalInventoryCache(self.workdir, "")
+        self.assertTrue(os.path.isfile(other_version.json_path))
+        self.assertFalse(any(os.path.isfile(filename) for filename in other_version.files[1:]))
+
+    def test_switch_cache_format(self):
+        host = self.fake.instances["eu-west-1"][3].private_ip_address
+        expected, calls = self.run_inventory(self.inifile("cache", cache_format="json"), "--list")
+        self.assertEqual(calls["ec2:DescribeInstances"], len(REGIONS))
+        expected_host, _ = self.run_inventory(self.inifile("cache", cache_format="json"), "--host", host)
+
+        for cache_format in ["marshal", "sqlite", "json"]:
+            with self.subTest(cache_format=cache_format):
+                inifile = self.inifile("cache", cache_format=cache_format)
+                output, calls = self.run_inventory(inifile, "--list")
+                self.assertEqual(output, expected)
+                # Only the json cache was written before, by the first run
+                self.assertEqual(calls.get("ec2:DescribeInstances"), None if cache_format == "json" else len(REGIONS))
+
+                self.assertEqual(self.run_inventory(inifile, "--host", host), (expected_host, {}))
+                self.assertEqual(json.loads(self.run_inventory(inifile, "--list", "--pretty")[0]),
+                                 json.loads(expected))
+
+
+class TestCacheRefresh(Ec2InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache_path = os.path.join(self.workdir, "cache")
+        self.cache_files = [os.path.join(self.cache_path, "ansible-ec2.cache"),
+                            os.path.join(self.cache_path, "ansible-ec2.index")]
+
+    @contextlib.contextmanager
+    def hold_lock(self):
+        """Holds the cache lock the way another copy of the script would."""
+        with open(os.path.join(self.cache_path, "ansible-ec2.lock"), "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def expire_cache(self):
+        expired = time.time() - 3600
+        for filename in self.cache_files:
+            os.utime(filename, (expired, expired))
+
+    def test_stale_cache_is_served_while_refreshing_in_background(self):
+        inifile = self.inifile("cache", cache_stale_while_revalidate=True)
+        stale, _ = self.run_inventory(inifile, "--refresh-cache")
+        self.expire_cache()
+        self.fake.instances["us-east-1"].pop(1)
+
+        with mock.patch.object(ec2_inventory.Ec2Inventory, "spawn_background_refresh") as spawn:
+            output, calls = self.run_inventory(inifile, "--list")
+        self.assertEqual(output, stale)
+        self.assertEqual(calls, {})
+        self.assertEqual(spawn.call_count, 1)
+
+        # The background refresh gives up while another refresh is going on
+        with self.hold_lock():
+            _, calls = self.run_inventory(inifile, "--background-refresh")
+        self.assertEqual(calls, {})
+
+        _, calls = self.run_inventory(inifile, "--background-refresh")
+        self.assertEqual(calls["ec2:DescribeInstances"], len(REGIONS))
+        self.assertNotEqual(self.run_inventory(inifile, "--list")[0], stale)
+
+    def test_expired_cache_is_served_while_locked(self):
+        inifile = self.inifile("cache")
+        stale, _ = self.run_inventory(inifile, "--refresh-cache")
+        self.expire_cache()
+
+        with self.hold_lock():
+            output, calls = self.run_inventory(inifile, "--list")
+        self.assertEqual(output, stale)
+        self.assertEqual(calls, {})
+
+    def test_concurrent_refresh_waits_for_the_lock(self):
+        inifile = self.inifile("cache")
+        expected, _ = self.run_inventory(inifile, "--refresh-cache")
+        refreshed = os.path.join(self.workdir, "refreshed")
+        os.makedirs(refreshed)
+        for filename in self.cache_files:
+            shutil.move(filename, refreshed)
+
+        results = []
+        with self.hold_lock():
+            waiting = threading.Thread(target=lambda: results.append(self.run_inventory(inifile, "--list")))
+            waiting.start()
+            time.sleep(0.5)
+            self.assertTrue(waiting.is_alive())
+
+            # The other copy of the script finishes its refresh
+            for filename in self.cache_files:
+                shutil.move(os.path.join(refreshed, os.path.basename(filename)), filename)
+        waiting.join()
+
+        self.assertEqual(results, [(expected, {})])
+
+
+class TestDaemon(Ec2InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.inifile_path = self.inifile("daemon", cache_max_age=86400)
+        self.socket_path = os.path.join(self.workdir, "daemon", "ansible-ec2.sock")
+
+    def query_daemon(self, *argv):
+        args = ec2_inventory.build_arg_parser().parse_args(["--inifile", self.inifile_path] + list(argv))
+        return ec2_inventory.query_daemon(args, ec2_inventory.read_config(args))
+
+    @contextlib.contextmanager
+    def running_daemon(self):
+        """Runs the daemon in a thread until the end of the block."""
+        servers = []
+
+        class Server(socketserver.ThreadingUnixStreamServer):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                servers.append(self)
+
+        def run_daemon():
+            with self.fake.patched():
+                ec2_inventory.Ec2Inventory()
+
+        argv = [benchmark.EC2_SCRIPT_PATH, "--inifile", self.inifile_path, "--daemon"]
+        with mock.patch.object(sys, "argv", argv), \
+                mock.patch.object(ec2_inventory.socketserver, "ThreadingUnixStreamServer", Server):
+            daemon = threading.Thread(target=run_daemon)
+            daemon.start()
+            deadline = time.time() + 10
+            while not servers and daemon.is_alive() and time.time() < deadline:
+                time.sleep(0.01)
+            self.assertTrue(servers)
+            try:
+                yield
+            finally:
+                servers[0].shutdown()
+                daemon.join()
+
+    def test_daemon_answers_like_the_script(self):
+        host = self.fake.instances["us-east-1"][2].private_ip_address
+        expected = [self.run_inventory(self.inifile_path, *argv)[0].rstrip("\n")
+                    for argv in [["--list"], ["--host", host], ["--host", "10.255.255.255"], ["--list", "--pretty"]]]
+
+        with self.running_daemon():
+            self.assertEqual([self.query_daemon(), self.query_daemon("--host", host),
+                              self.query_daemon("--host", "10.255.255.255"), self.query_daemon("--list", "--pretty")],
+                             expected)
+            self.assertIsNone(self.query_daemon("--refresh-cache"))
+
+        self.assertFalse(os.path.exists(self.socket_path))
+
+    def test_missing_or_stale_socket(self):
+        os.makedirs(os.path.dirname(self.socket_path))
+        self.assertIsNone(self.query_daemon())
+
+        # Left behind by a daemon which was killed
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close()
+        self.assertIsNone(self.query_daemon())
+        self.assertIsNone(self.query_daemon("--host", "10.0.0.1"))
+
+        # A new daemon replaces the stale socket
+        with self.running_daemon():
+            self.assertEqual(self.query_daemon(), self.run_inventory(self.inifile_path)[0].rstrip("\n"))
+
+
+def launch_time(seconds_ago):
+    return time.strftime("%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(time.time() - seconds_ago))
+
+
+class TestIncrementalRefresh(Ec2InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.incremental = self.inifile("incremental", incremental_refresh=True)
+        self.full = self.inifile("full", incremental_refresh=False)
+
+        # Launched a little before the last refresh, and still pending
+        self.pending = self.fake.instances["us-east-1"][5]
+        self.pending.state = "pending"
+        self.pending.launch_time = launch_time(120)
+
+        self.run_inventory(self.incremental, "--refresh-cache")
+
+    def assert_same_as_full_refresh(self):
+        patch_cache = ec2_inventory.Ec2Inventory.do_api_calls_patch_cache
+        describe_instances = self.fake.describe_instances
+        downloaded = []
+
+        def count_instances(region, filters=None):
+            reservations = describe_instances(region, filters)
+            downloaded.extend(instance for reservation in reservations for instance in reservation.instances)
+            return reservations
+
+        with mock.patch.object(ec2_inventory.Ec2Inventory, "do_api_calls_patch_cache", autospec=True,
+                               side_effect=patch_cache) as patched, \
+                mock.patch.object(self.fake, "describe_instances", side_effect=count_instances):
+            incremental, _ = self.run_inventory(self.incremental, "--refresh-cache")
+        self.assertEqual(patched.call_count, 1)
+
+        # Only the recent launches and the instances that are not running
+        fleet = sum(len(instances) for instances in self.fake.instances.values())
+        self.assertLess(len(downloaded), fleet // 4)
+
+        full, _ = self.run_inventory(self.full, "--refresh-cache")
+        self.assertEqual(incremental, full)
+
+        host = self.fake.instances["us-east-1"][1].private_ip_address
+        self.assertEqual(self.run_inventory(self.incremental, "--host", host)[0],
+                         self.run_inventory(self.full, "--host", host)[0])
+
+    def test_pending_instance_becomes_running(self):
+        self.assertNotIn(self.pending.private_ip_address, self.run_inventory(self.incremental)[0])
+        self.pending.state = "running"
+        self.assert_same_as_full_refresh()
+        self.assertIn(self.pending.private_ip_address, self.run_inventory(self.incremental)[0])
+
+    def test_stopped_and_launched_instances(self):
+        self.fake.instances["us-east-1"][1].state = "stopped"
+
+        # Launched in the same second as the last refresh
+        launched = benchmark.FakeInstance("eu-west-1", 1, 100)
+        launched.launch_time = launch_time(0)
+        self.fake.instances["eu-west-1"].insert(3, launched)
+
+        # Started again, with a new address
+        restarted = self.fake.instances["eu-west-1"][7]
+        restarted.launch_time = launch_time(0)
+        restarted.private_ip_address = "10.9.9.9"
+
+        self.assert_same_as_full_refresh()
+        self.assertIn('"10.9.9.9"', self.run_inventory(self.incremental)[0])
+
+    def test_terminated_instance(self):
+        terminated = self.fake.instances["eu-west-1"][2]
+        terminated.state = "terminated"
+        self.assert_same_as_full_refresh()
+        self.assertNotIn('"%s"' % terminated.private_ip_address, self.run_inventory(self.incremental)[0])
+
+    def test_settings_change_forces_a_full_refresh(self):
+        config = configparser.ConfigParser()
+        config.read(self.incremental)
+        config.set("ec2", "group_by", "region,tag")
+        config.set("ec2", "group_by_tag_keys", "environment")
+        with open(self.incremental, "w") as f:
+            config.write(f)
+
+        with mock.patch.object(ec2_inventory.Ec2Inventory, "do_api_calls_patch_cache") as patched:
+            output, _ = self.run_inventory(self.incremental, "--refresh-cache")
+        patched.assert_not_called()
+        self.assertNotIn('"type_m5_large"', output)
+
+        # The next refresh is incremental again
+        self.full = self.inifile("full", group_by="region,tag", group_by_tag_keys="environment")
+        self.assert_same_as_full_refresh()
+
+    def test_vanished_instance_is_removed_by_a_full_refresh(self):
+        gone = self.fake.instances["eu-west-1"].pop(2)
+        self.run_inventory(self.incremental, "--refresh-cache")
+        self.assertIn('"%s"' % gone.private_ip_address, self.run_inventory(self.incremental)[0])
+
+        state_path = os.path.join(self.workdir, "incremental", "ansible-ec2.state")
+        with open(state_path) as f:
+            state = json.load(f)
+        state["last_full_refresh"] -= 3600
+        with open(state_path, "w") as f:
+            json.dump(state, f)
+
+        self.run_inventory(self.incremental, "--refresh-cache")
+        self.assertEqual(self.run_inventory(self.incremental)[0], self.run_inventory(self.full, "--refresh-cache")[0])
+
+
+class TestRoute53Index(Ec2InventoryTestCase):
+    def setUp(self):
+        super().setUp()
+        self.web = self.fake.instances["eu-west-1"][1].private_ip_address
+        self.db = self.fake.instances["us-east-1"][2].private_ip_address
+        self.zone = self.fake.add_zone("example.com", {"web.example.com": [self.web]})
+        self.fake.add_zone("internal.example.com", {"db.internal.example.com": [self.db]})
+        self.fake.add_zone("excluded.example.com", {"db.excluded.example.com": [self.db]})
+        self.inifile_path = self.inifile("route53", route53=True, route53_excluded_zones="excluded.example.com")
+
+    def refresh(self):
+        output, calls = self.run_inventory(self.inifile_path, "--refresh-cache")
+        return json.loads(output), calls
+
+    def test_instances_are_grouped_by_record_names(self):
+        inventory, calls = self.refresh()
+        self.assertEqual(inventory["web.example.com"], [self.web])
+        self.assertEqual(inventory["db.internal.example.com"], [self.db])
+        self.assertNotIn("db.excluded.example.com", inventory)
+        self.assertEqual(calls["route53:ListResourceRecordSets"], 2)
+
+    def test_unchanged_zones_are_not_listed_again(self):
+        expected, _ = self.refresh()
+        inventory, calls = self.refresh()
+        self.assertEqual(inventory, expected)
+        self.assertEqual(calls["route53:ListHostedZones"], 1)
+        self.assertNotIn("route53:ListResourceRecordSets", calls)
+
+    def test_changed_zone_is_listed_again(self):
+        self.refresh()
+        self.zone.record_sets.append(benchmark.FakeRecordSet("www.example.com.", [self.web]))
+
+        inventory, calls = self.refresh()
+        self.assertEqual(calls["route53:ListResourceRecordSets"], 1)
+        self.assertEqual(inventory["www.example.com"], [self.web])
+        self.assertEqual(inventory["db.internal.example.com"], [self.db])
+
+
+class TestParallelFetch(Ec2InventoryTestCase):
+    def test_parallel_merge_is_the_same_as_serial(self):
+        self.fake.add_zone("example.com", {"web.example.com": [self.fake.instances["us-east-1"][1].private_ip_address]})
+        serial, _ = self.run_inventory(self.inifile("serial", max_workers=1, route53=True), "--refresh-cache")
+
+        # The first region answers last, so the results arrive in the reverse order
+        describe_instances = self.fake.describe_instances
+
+        def slow_first_region(region, filters=None):
+            if region == REGIONS[0]:
+                time.sleep(0.05)
+            return describe_instances(region, filters)
+
+        with mock.patch.object(self.fake, "describe_instances", side_effect=slow_first_region):
+            parallel, _ = self.run_inventory(self.inifile("parallel", max_workers=8, route53=True), "--refresh-cache")
+
+        self.assertEqual(parallel, serial)
+        self.assertIn(json.loads(parallel)["security_group_admin"][0],
+                      [instance.private_ip_address for instance in self.fake.instances[REGIONS[0]]])
+
+
+class TestInventorySettings(Ec2InventoryTestCase):
+    def test_instance_filters_are_sent_to_the_api(self):
+        inifile = self.inifile("filters", instance_filters="instance-state-name=running,tag:environment=prod,"
+                                                           "tag:environment=stage,vpc-id=vpc-0001")
+        with mock.patch.object(self.fake, "describe_instances", wraps=self.fake.describe_instances) as describe:
+            inventory = json.loads(self.run_inventory(inifile, "--refresh-cache")[0])
+
+        for call in describe.call_args_list:
+            self.assertEqual(call[0][1], {"instance-state-name": ["running"], "tag:environment": ["prod", "stage"],
+                                          "vpc-id": ["vpc-0001"]})
+
+        expected = sorted(instance.private_ip_address
+                          for instances in self.fake.instances.values() for instance in instances
+                          if instance.state == "running" and instance.vpc_id == "vpc-0001" and
+                          instance.tags["environment"] in ("prod", "stage"))
+        self.assertTrue(expected)
+        self.assertEqual(sorted(inventory["_meta"]["hostvars"]), expected)
+
+    def test_group_by(self):
+        inventory = json.loads(self.run_inventory(
+            self.inifile("groups", group_by="region,first_in_tag", group_by_tag_keys="environment"),
+            "--refresh-cache")[0])
+
+        environments = ["tag_environment_dev", "tag_environment_prod", "tag_environment_stage"]
+        self.assertEqual(sorted(inventory), sorted(REGIONS + environments + ["_meta"] +
+                                                   ["first_in_" + group for group in environments]))
+        for group in environments:
+            self.assertEqual(inventory["first_in_" + group], inventory[group][:1])
+
+    def test_unknown_group_by(self):
+        with self.assertRaises(SystemExit):
+            self.run_inventory(self.inifile("groups", group_by="region,colour"), "--list")
+
+    def test_host_is_served_from_the_meta_block(self):
+        inventory = json.loads(self.run_inventory(self.inifile("hosts"), "--refresh-cache")[0])
+        for host in sorted(inventory["_meta"]["hostvars"])[:3]:
+            with self.subTest(host=host):
+                output, calls = self.run_inventory(self.inifile("hosts"), "--host", host)
+                self.assertEqual(json.loads(output), inventory["_meta"]["hostvars"][host])
+                self.assertEqual(calls, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,288 @@
+# Tests for the dependency analyzer in util/parsefiles.py
+#
+# How to run these tests:
+# python -m pytest tests/test_parsefiles.py
+
+import io
+import json
+import logging
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+UTIL_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "util")
+os.environ.setdefault("TRAVIS_BUILD_DIR", os.path.join(UTIL_DIR, ".."))
+sys.path.insert(0, UTIL_DIR)
+
+import dockerfile_dag
+import parsefiles
+
+FILES = {
+    "playbooks/roles/common/meta/main.yml": "dependencies: []\n",
+    "playbooks/roles/common/tasks/main.yml": "- name: common\n  command: /bin/true\n",
+    "playbooks/roles/app/meta/main.yml": "dependencies:\n  - common\n",
+    "playbooks/roles/app/tasks/main.yml": (
+        "- include: deploy.yml tags=deploy\n"
+        "- block:\n"
+        "  - include_role:\n"
+        "      name: lib\n"
+        "      tasks_from: extra\n"
+    ),
+    "playbooks/roles/app/tasks/deploy.yml": "- name: deploy\n  command: /bin/true\n",
+    "playbooks/roles/app/tasks/devstack.yml": "- name: devstack\n  command: /bin/true\n",
+    "playbooks/roles/lib/tasks/main.yml": "- name: lib\n  command: /bin/true\n",
+    "playbooks/roles/lib/tasks/extra.yml": "- name: extra\n  command: /bin/true\n",
+    "playbooks/roles/unused/meta/main.yml": "dependencies:\n  - common\n",
+    "playbooks/app.yml": "- hosts: all\n  roles:\n    - app\n",
+    "docker/plays/app.yml": "- hosts: all\n  roles:\n    - role: app\n",
+    "docker/plays/base.yml": "- hosts: all\n  roles:\n    - common\n",
+    "docker/build/base/Dockerfile": "FROM ubuntu:focal\n",
+    "docker/build/app/Dockerfile": "ARG BASE_IMAGE_TAG=latest\nFROM edxops/base:${BASE_IMAGE_TAG}\n",
+}
+
+
+class TestParsefiles(unittest.TestCase):
+    def setUp(self):
+        self.git_dir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.git_dir, ".build", "parsefiles_cache.json")
+        for path, contents in FILES.items():
+            self.write(path, contents)
+
+    def tearDown(self):
+        shutil.rmtree(self.git_dir)
+
+    def write(self, path, contents):
+        path = os.path.join(self.git_dir, path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write(contents)
+
+    def build_graph(self, **kwargs):
+        return parsefiles.build_graph(self.git_dir, ["playbooks/roles"], ["playbooks"], ["docker/plays"], **kwargs)
+
+    def affected_images(self, files, graph=None):
+        graph = graph or self.build_graph()
+        index = parsefiles.ChangeSetIndex(self.git_dir, ["playbooks/roles"], ["playbooks"], ["docker/plays"],
+                                          [parsefiles.DOCKER_BUILD_DIR], graph.graph["reachable_tasks"])
+        return parsefiles.get_affected_images(set(files), graph, index)
+
+    def test_role_change_affects_dependent_plays(self):
+        self.assertEqual(self.affected_images(["playbooks/roles/common/tasks/main.yml"]), {"app", "base"})
+        self.assertEqual(self.affected_images(["playbooks/roles/app/templates/app.j2"]), {"app"})
+
+    def test_deleted_files(self):
+        self.assertEqual(self.affected_images(["playbooks/roles/common/tasks/deleted.yml"]), set())
+        self.assertEqual(self.affected_images(["playbooks/roles/common/files/deleted"]), {"app", "base"})
+        self.assertEqual(self.affected_images(["playbooks/roles/deleted/tasks/main.yml"]), set())
+
+    def test_unreachable_tasks_are_ignored(self):
+        self.assertEqual(self.affected_images(["playbooks/roles/app/tasks/deploy.yml"]), {"app"})
+        self.assertEqual(self.affected_images(["playbooks/roles/app/tasks/devstack.yml"]), set())
+
+    def test_include_role_with_tasks_from(self):
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/extra.yml"]), {"app"})
+
+    def test_include_role_with_templated_tasks_from(self):
+        self.write("playbooks/roles/lib/tasks/install.yml", "- name: install\n  command: /bin/true\n")
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/install.yml"]), set())
+
+        self.write("playbooks/roles/app/tasks/main.yml", FILES["playbooks/roles/app/tasks/main.yml"].replace(
+            "tasks_from: extra", 'tasks_from: "{{ lib_action }}"'))
+        graph = self.build_graph(cache_file=self.cache_file)
+        self.assertIsNone(graph.graph["reachable_tasks"]["lib"])
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/install.yml"], graph), {"app"})
+        self.assertEqual(self.affected_images(["playbooks/roles/app/tasks/devstack.yml"], graph), set())
+
+        self.write("playbooks/roles/app/tasks/main.yml", FILES["playbooks/roles/app/tasks/main.yml"].replace(
+            "name: lib", 'name: "{{ lib_role }}"'))
+        graph = self.build_graph(cache_file=self.cache_file)
+        self.assertEqual(set(graph.graph["reachable_tasks"].values()), {None})
+
+    def test_reachability_is_per_docker_play(self):
+        self.write("playbooks/roles/lib/tasks/other.yml", "- name: other\n  command: /bin/true\n")
+        self.write("playbooks/roles/worker/tasks/main.yml", "- include_role:\n    name: lib\n    tasks_from: other\n")
+        self.write("docker/plays/worker.yml", "- hosts: all\n  roles:\n    - worker\n")
+        self.write("docker/build/worker/Dockerfile", "FROM ubuntu:focal\n")
+
+        # a role only included from a file of tasks that no play runs
+        self.write("playbooks/roles/app/tasks/devstack.yml", "- import_role:\n    name: devonly\n")
+        self.write("playbooks/roles/devonly/tasks/main.yml", "- name: devonly\n  command: /bin/true\n")
+
+        graph = self.build_graph()
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/extra.yml"], graph), {"app"})
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/other.yml"], graph), {"worker"})
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/main.yml"], graph), set())
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/templates/lib.j2"], graph), {"app", "worker"})
+        self.assertEqual(self.affected_images(["playbooks/roles/devonly/tasks/main.yml"], graph), set())
+        self.assertEqual(self.affected_images(["playbooks/roles/devonly/templates/dev.j2"], graph), set())
+        self.assertNotIn(("devonly", "role"), graph)
+
+    def test_include_paths_are_resolved_like_ansible(self):
+        self.write("playbooks/roles/app/tasks/main.yml", (
+            "- include_tasks: tasks/deploy.yml\n"
+            "- import_tasks: ../../lib/tasks/shared.yml\n"
+        ))
+        self.write("playbooks/roles/lib/tasks/shared.yml", "- include_tasks: nested/step.yml\n")
+        self.write("playbooks/roles/lib/tasks/nested/step.yml", "- name: step\n  command: /bin/true\n")
+
+        graph = self.build_graph()
+        self.assertEqual(graph.graph["reachable_tasks"]["app"], {"main.yml", "deploy.yml"})
+        self.assertEqual(graph.graph["reachable_tasks"]["lib"], {"shared.yml", "nested/step.yml"})
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/nested/step.yml"], graph), {"app"})
+        self.assertEqual(self.affected_images(["playbooks/roles/app/tasks/devstack.yml"], graph), set())
+        self.assertEqual(self.affected_images(["playbooks/roles/lib/tasks/extra.yml"], graph), set())
+
+    def test_docker_and_play_changes(self):
+        self.assertEqual(self.affected_images(["docker/build/app/Dockerfile"]), {"app"})
+        self.assertEqual(self.affected_images(["docker/plays/base.yml"]), {"base"})
+        self.assertEqual(self.affected_images(["playbooks/app.yml"]), {"app"})
+
+    def test_affected_docker_plays_match_dependencies(self):
+        graph = self.build_graph()
+        for role in ["common", "app", "lib", "unused", "missing"]:
+            self.assertEqual(
+                parsefiles.get_affected_docker_plays({role}, graph),
+                parsefiles.get_docker_plays(parsefiles.get_dependencies({role}, graph), graph),
+            )
+
+    def test_cache_is_updated_when_files_change(self):
+        uncached = self.build_graph()
+        cold = self.build_graph(cache_file=self.cache_file)
+        warm = self.build_graph(cache_file=self.cache_file)
+        self.assertEqual(set(uncached.edges()), set(cold.edges()))
+        self.assertEqual(set(cold.edges()), set(warm.edges()))
+
+        self.write("playbooks/roles/unused/meta/main.yml", "dependencies:\n  - lib\n")
+        graph = self.build_graph(cache_file=self.cache_file)
+        self.assertIn((("lib", "role"), ("unused", "role")), graph.edges())
+        self.assertNotIn((("common", "role"), ("unused", "role")), graph.edges())
+
+    def test_parallel_parse_is_the_same_as_serial(self):
+        for number in range(parsefiles.PARALLEL_PARSE_MIN_FILES // 2):
+            self.write("playbooks/roles/generated%d/meta/main.yml" % number, "dependencies:\n  - common\n")
+            self.write("playbooks/roles/generated%d/tasks/main.yml" % number,
+                       "- include_role:\n    name: generated%d\n" % (number + 1))
+        self.write("docker/plays/generated.yml", "- hosts: all\n  roles:\n    - generated0\n")
+        # Tasks that are not valid yaml are assumed to run every file of their role
+        self.write("playbooks/roles/app/tasks/deploy.yml", "- name: [deploy\n")
+
+        def build_graph(jobs):
+            with mock.patch.object(parsefiles, "ProcessPoolExecutor", wraps=parsefiles.ProcessPoolExecutor) as pool:
+                graph = self.build_graph(jobs=jobs)
+            self.assertEqual(pool.called, jobs > 1)
+            return graph
+
+        serial = build_graph(1)
+        parallel = build_graph(2)
+        self.assertEqual(sorted(parallel.edges()), sorted(serial.edges()))
+        self.assertEqual(parallel.graph, serial.graph)
+        self.assertIn((("generated32", "role"), ("generated31", "role")), parallel.edges())
+        self.assertIsNone(parallel.graph["reachable_tasks"]["app"])
+
+        # Any other file that is not valid yaml is an error
+        self.write("playbooks/roles/generated3/meta/main.yml", "dependencies: [common\n")
+        for jobs in [1, 2]:
+            with self.subTest(jobs=jobs), self.assertRaises(SystemExit):
+                build_graph(jobs)
+
+    def git(self, *args):
+        subprocess.check_call(["git", "-c", "user.name=test", "-c", "user.email=test@example.com"] + list(args),
+                              cwd=self.git_dir, stdout=subprocess.DEVNULL)
+
+    def test_run_batch(self):
+        self.git("init", "-q")
+        self.git("add", ".")
+        self.git("commit", "-q", "-m", "initial")
+        self.write("playbooks/roles/lib/tasks/extra.yml", "- name: changed\n  command: /bin/true\n")
+        self.git("commit", "-q", "-a", "-m", "change lib")
+
+        lines = [
+            '{"id": 1, "files": ["playbooks/roles/common/tasks/main.yml"]}\n',
+            '\n',
+            '{"id": 2, "files": [\n',
+            '{"id": "docker", "files": ["docker/build/app/Dockerfile", "docker/plays/base.yml"]}\n',
+            '{"id": 4}\n',
+            '{"files": ["playbooks/roles/app/tasks/devstack.yml"]}\n',
+            '{"id": "range", "range": "HEAD~1..HEAD"}\n',
+            '{"id": "bad range", "range": "missing..HEAD"}\n',
+        ]
+        self.write("util/parsefiles_config.yml", (
+            "roles_paths: [playbooks/roles]\n"
+            "aws_plays_paths: [playbooks]\n"
+            "docker_plays_paths: [docker/plays]\n"
+        ))
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+        with mock.patch.object(parsefiles, "TRAVIS_BUILD_DIR", self.git_dir), \
+                mock.patch.object(parsefiles, "CONFIG_FILE_PATH",
+                                  parsefiles.pathlib2.Path(self.git_dir, "util", "parsefiles_config.yml")), \
+                mock.patch.object(parsefiles, "build_graph", wraps=parsefiles.build_graph) as build_graph, \
+                mock.patch.object(parsefiles, "get_affected_images",
+                                  wraps=parsefiles.get_affected_images) as get_affected_images, \
+                mock.patch("sys.stdin", io.StringIO("".join(lines))), \
+                mock.patch("sys.stdout", io.StringIO()) as output:
+            parsefiles.main(["--batch", "--jobs", "1", "--cache-file", self.cache_file])
+
+        # the graph is built once and used for every change set
+        self.assertEqual(build_graph.call_count, 1)
+        self.assertEqual(get_affected_images.call_count, 4)
+        self.assertEqual(len(set(id(call[0][1]) for call in get_affected_images.call_args_list)), 1)
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([result.get("id") for result in results], [1, None, "docker", 4, None, "range", "bad range"])
+        self.assertEqual(results[0], {"id": 1, "images": ["app", "base"]})
+        self.assertIn("invalid request", results[1]["error"])
+        self.assertEqual(results[2], {"id": "docker", "images": ["app", "base"]})
+        self.assertIn("invalid request", results[3]["error"])
+        self.assertEqual(results[4], {"id": None, "images": []})
+        self.assertEqual(results[5], {"id": "range", "images": ["app"]})
+        self.assertIn("git diff failed", results[6]["error"])
+
+    def test_plan_shards_keeps_base_images_with_children(self):
+        images = {"app", "base", "other", "big"}
+        base_images = parsefiles.get_base_images(images, self.git_dir)
+        plan = parsefiles.plan_shards(images, 2, {"big": 10, "app": 3}, base_images)
+        self.assertEqual(plan, [["big"], ["base", "app", "other"]])
+
+        with self.assertRaises(ValueError):
+            parsefiles.plan_shards(images, 0, {}, base_images)
+
+    def test_shard_arguments_are_validated(self):
+        self.assertEqual(parsefiles.arg_parse(["--shards", "3", "--shard", "2"]).shard, 2)
+        for argv in [["--shards", "0"], ["--shards", "-1"], ["--shards", "2", "--shard", "-1"],
+                     ["--shards", "2", "--shard", "2"]]:
+            with self.subTest(argv=argv), mock.patch("sys.stderr", io.StringIO()) as stderr:
+                with self.assertRaises(SystemExit):
+                    parsefiles.arg_parse(argv)
+                self.assertIn("--shard", stderr.getvalue())
+
+
+class TestDockerfileDag(unittest.TestCase):
+    def test_build_layers(self):
+        docker_build_path = tempfile.mkdtemp()
+        try:
+            for image, contents in [("base", "FROM ubuntu:focal\n"),
+                                    ("app", "ARG BASE_IMAGE_TAG=latest\nFROM edxops/base:${BASE_IMAGE_TAG}\n"),
+                                    ("other", "FROM debian:buster-slim\n")]:
+                os.makedirs(os.path.join(docker_build_path, image))
+                with open(os.path.join(docker_build_path, image, "Dockerfile"), "w") as f:
+                    f.write(contents)
+
+            dag = dockerfile_dag.build_dag(docker_build_path)
+            self.assertEqual(dockerfile_dag.get_build_layers(dag, dag.nodes()), [["base", "other"], ["app"]])
+            self.assertEqual(dockerfile_dag.get_affected_images(dag, {"base"}), {"base", "app"})
+            self.assertEqual(dockerfile_dag.get_make_dependencies(dag, "app"), [
+                "docker.build.app: docker.pull/edxops/base@latest",
+                "docker.pkg.app: docker.pkg.base",
+            ])
+        finally:
+            shutil.rmtree(docker_build_path)
+
+
+if __name__ == '__main__':
+    unittest.main()
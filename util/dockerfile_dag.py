@@ -0,0 +1,288 @@
+"""
+Builds the dependency graph between the Docker images under docker/build from the FROM lines of
+their Dockerfiles, and turns it into a build plan: layers of images that can be built concurrently,
+each layer only depending on the ones before it.
+
+Given the images that changed, e.g. the output of parsefiles.py, only they and the images built
+FROM them are planned:
+
+    git diff --name-only $TRAVIS_COMMIT_RANGE | python util/parsefiles.py | python util/dockerfile_dag.py --stdin
+
+It also generates the make dependencies that docker.mk includes for every image:
+
+    python util/dockerfile_dag.py --make-deps docker/build/edxapp/Dockerfile
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+from collections import namedtuple
+
+import networkx as nx
+
+DOCKER_BUILD_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "docker", "build")
+LOGGER = logging.getLogger(__name__)
+
+# prefix of the images published from docker/build
+EDXOPS_PREFIX = "edxops/"
+
+ARG_LINE = re.compile(r"^ARG\s+([A-Za-z_][A-Za-z0-9_]*)(?:=(.*))?$", re.IGNORECASE)
+FROM_LINE = re.compile(r"^FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?\s*$", re.IGNORECASE)
+VARIABLE = re.compile(r"\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))")
+
+Dockerfile = namedtuple('Dockerfile', ['image', 'path', 'base_images', 'args'])
+
+
+def parse_dockerfile(path, image=None):
+    """
+    Parses the FROM lines of a Dockerfile, substituting the ARGs declared before them such as
+    BASE_IMAGE_TAG with their defaults. FROM lines that refer to an earlier build stage are skipped.
+
+    Input:
+    path: The path to the Dockerfile.
+    image: The name of the image, by default the name of the directory the Dockerfile is in.
+    """
+
+    if image is None:
+        image = os.path.basename(os.path.dirname(os.path.abspath(path)))
+
+    args = {}
+    stages = set()
+    base_images = []
+
+    for line in _read_instructions(path):
+        arg = ARG_LINE.match(line)
+        if arg and not base_images and not stages:
+            value = (arg.group(2) or "").strip()
+            args[arg.group(1)] = value.strip('"\'')
+            continue
+
+        from_line = FROM_LINE.match(line)
+        if from_line:
+            reference = VARIABLE.sub(lambda match: args.get(match.group(1) or match.group(2), ""), from_line.group(1))
+
+            if reference.lower() not in stages and reference not in base_images:
+                base_images.append(reference)
+
+            if from_line.group(2):
+                stages.add(from_line.group(2).lower())
+
+    return Dockerfile(image, path, base_images, args)
+
+
+def _read_instructions(path):
+    """
+    Yields the instructions of a Dockerfile, with comments dropped and continuation lines joined.
+
+    Input:
+    path: The path to the Dockerfile.
+    """
+
+    instruction = ""
+
+    with open(path) as dockerfile:
+        for line in dockerfile:
+            line = line.strip()
+
+            if not line or line.startswith("#"):
+                continue
+
+            if line.endswith("\\"):
+                instruction += line[:-1] + " "
+                continue
+
+            yield instruction + line
+            instruction = ""
+
+    if instruction:
+        yield instruction.strip()
+
+
+def get_edxops_base(reference):
+    """
+    Returns the name of the docker/build image a FROM reference such as edxops/focal-common:latest
+    refers to, or None if it refers to an external image.
+
+    Input:
+    reference: The image reference of a FROM line.
+    """
+
+    if not reference.startswith(EDXOPS_PREFIX):
+        return None
+
+    return re.split(r"[:@]", reference[len(EDXOPS_PREFIX):], 1)[0]
+
+
+def build_dag(docker_build_path=DOCKER_BUILD_PATH):
+    """
+    Builds a graph with a node for every image under docker_build_path and an edge [A, B] for every
+    image B that is built FROM image A. The parsed Dockerfiles are kept in graph["dockerfiles"].
+
+    Input:
+    docker_build_path: A path to the directory in which every image has a directory with a Dockerfile.
+    """
+
+    dag = nx.DiGraph()
+    dockerfiles = dag.graph["dockerfiles"] = {}
+
+    for image in sorted(os.listdir(docker_build_path)):
+        path = os.path.join(docker_build_path, image, "Dockerfile")
+
+        if os.path.isfile(path):
+            dockerfiles[image] = parse_dockerfile(path, image)
+            dag.add_node(image)
+
+    for image, dockerfile in dockerfiles.items():
+        for reference in dockerfile.base_images:
+            base = get_edxops_base(reference)
+
+            if base is not None and base != image and base in dag:
+                dag.add_edge(base, image)
+
+    return dag
+
+
+def get_affected_images(dag, changed):
+    """
+    Returns the images that have to be rebuilt when changed images change: the changed images
+    themselves and every image built FROM them, directly or not.
+
+    Input:
+    dag: The graph built by build_dag.
+    changed: A set of images.
+    """
+
+    affected = set()
+
+    for image in changed:
+        if image in dag:
+            affected.add(image)
+            affected |= nx.descendants(dag, image)
+        else:
+            LOGGER.warning("image '%s' does not have a Dockerfile." % image)
+
+    return affected
+
+
+def get_build_layers(dag, images):
+    """
+    Splits images into layers that can be built in order, the images in each layer concurrently.
+    An image is in the layer after the last one containing an image it is built FROM; images
+    that are not built are expected to be pulled instead.
+
+    Input:
+    dag: The graph built by build_dag.
+    images: A set of images to build.
+    """
+
+    images = set(images) & set(dag.nodes())
+    pending = {image: len(set(dag.predecessors(image)) & images) for image in images}
+
+    layers = []
+    layer = sorted(image for image, count in pending.items() if count == 0)
+
+    while layer:
+        layers.append(layer)
+
+        for image in layer:
+            del pending[image]
+
+        following = set()
+        for image in layer:
+            for child in dag.successors(image):
+                if child in pending:
+                    pending[child] -= 1
+                    if pending[child] == 0:
+                        following.add(child)
+
+        layer = sorted(following)
+
+    if pending:
+        raise ValueError("images built FROM each other in a cycle: %s" % " ".join(sorted(pending)))
+
+    return layers
+
+
+def get_make_dependencies(dag, image, docker_build="docker.build.", docker_pkg="docker.pkg.",
+                          docker_pull="docker.pull/"):
+    """
+    Returns the make rules docker.mk includes for an image: building it needs its base images
+    pulled, and packaging it needs the docker/build images it is built FROM packaged first.
+    Make can't handle ':' in target names, so '@' is used in its place.
+
+    Input:
+    dag: The graph built by build_dag.
+    image: The image to return the rules for.
+    docker_build, docker_pkg, docker_pull: The prefixes of the build, package and pull targets in docker.mk.
+    """
+
+    pulls = []
+    pkgs = []
+
+    for reference in dag.graph["dockerfiles"][image].base_images:
+        pull = docker_pull + reference.replace(":", "@")
+        pulls.append(pull)
+
+        base = get_edxops_base(reference)
+        pkgs.append(docker_pkg + base if base is not None and base in dag else pull)
+
+    return [
+        "%s%s: %s" % (docker_build, image, " ".join(pulls)),
+        "%s%s: %s" % (docker_pkg, image, " ".join(pkgs)),
+    ]
+
+
+def arg_parse():
+
+    parser = argparse.ArgumentParser(description='Build the FROM dependency graph between the Docker images under '
+                                     'docker/build and output the layers in which the given images, and the images '
+                                     'built FROM them, can be built concurrently.')
+    parser.add_argument('images', nargs='*', help="changed images; every image if none are given")
+    parser.add_argument('--stdin', action="store_true", help="read the changed images from standard in")
+    parser.add_argument('--docker-build-path', default=DOCKER_BUILD_PATH,
+                        help="directory containing a directory with a Dockerfile for every image")
+    parser.add_argument('--json', action="store_true",
+                        help="output the layers and the base images of every image in them as JSON")
+    parser.add_argument('--make-deps', metavar="DOCKERFILE",
+                        help="output the make dependencies of the image built by DOCKERFILE instead")
+    parser.add_argument('--verbose', help="set warnings to be displayed", action="store_true")
+
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+
+    args = arg_parse()
+
+    # configure logging
+    logging.basicConfig()
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    dag = build_dag(args.docker_build_path)
+
+    if args.make_deps:
+        image = os.path.basename(os.path.dirname(os.path.abspath(args.make_deps)))
+        print("\n".join(get_make_dependencies(dag, image)))
+        sys.exit(0)
+
+    changed = set(args.images)
+    if args.stdin:
+        changed |= set(sys.stdin.read().split())
+
+    images = get_affected_images(dag, changed) if changed or args.stdin else set(dag.nodes())
+
+    layers = get_build_layers(dag, images)
+
+    if args.json:
+        print(json.dumps({
+            "layers": layers,
+            "base_images": {image: dag.graph["dockerfiles"][image].base_images for layer in layers for image in layer},
+        }, indent=2, sort_keys=True))
+    else:
+        for layer in layers:
+            print(" ".join(layer))
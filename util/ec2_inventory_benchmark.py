@@ -0,0 +1,353 @@
+"""
+Benchmarks the EC2 dynamic inventory script (playbooks/ec2.py).
+
+The script is run in-process against a local stand-in for the EC2, RDS and
+Route53 APIs, which serves a synthetic fleet spread over several regions. For
+every fleet size, three modes are measured:
+
+    cold:  --refresh-cache with an empty cache directory
+    warm:  --list served from the cache
+    host:  --host for one instance, served from the cache
+
+and for each of them the wall time, the peak memory allocated by Python, the
+number of API calls per operation and the size of the output are reported.
+Every API call takes --latency seconds, 50ms by default, about what a call to
+AWS takes from outside its region, so that concurrency and the number of
+calls show in the wall time.
+
+Usage:
+
+    python util/ec2_inventory_benchmark.py --sizes 100,5000,50000 --output ec2_benchmark.json
+
+The peak memory is measured with tracemalloc in a second run of every mode, so
+it does not slow down the timed run. It does not include the synthetic fleet,
+which is built before the measurements start.
+"""
+
+import argparse
+import configparser
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from boto import ec2
+from boto import rds
+from boto import route53
+
+EC2_SCRIPT_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "playbooks", "ec2.py")
+EC2_INI_PATH = os.path.join(os.path.dirname(EC2_SCRIPT_PATH), "ec2.ini")
+DEFAULT_REGIONS = "us-east-1,us-west-2,eu-west-1,ap-southeast-1"
+MODES = ("cold", "warm", "host")
+DEFAULT_LATENCY = 0.05
+
+# DescribeInstances filters the stand-in understands, and the attributes they match
+INSTANCE_FILTERS = {
+    "availability-zone": "placement",
+    "image-id": "image_id",
+    "instance-id": "id",
+    "instance-state-name": "state",
+    "instance-type": "instance_type",
+    "key-name": "key_name",
+    "launch-time": "launch_time",
+    "private-ip-address": "private_ip_address",
+    "subnet-id": "subnet_id",
+    "vpc-id": "vpc_id",
+}
+
+
+class FakeRegion:
+    def __init__(self, name):
+        self.name = name
+
+
+class FakeGroup:
+    def __init__(self, group_id, name):
+        self.id = group_id
+        self.name = name
+
+
+class FakeInstance:
+    """An EC2 instance with the attributes boto.ec2.instance.Instance exposes."""
+
+    def __init__(self, region, region_number, number):
+        self.id = "i-%02d%015x" % (region_number, number)
+        self.region = FakeRegion(region)
+        self.state = "running" if number % 20 else "stopped"
+        self.state_code = 16 if self.state == "running" else 80
+        self.placement = region + "abc"[number % 3]
+        self.instance_type = ("m5.large", "c5.xlarge", "t3.medium")[number % 3]
+        self.image_id = "ami-%08x" % (number % 7)
+        self.architecture = "x86_64"
+        self.key_name = "deployment-%d" % (number % 4)
+        self.launch_time = "2020-01-%02dT00:00:00.000Z" % (1 + number % 28)
+        self.vpc_id = "vpc-%04d" % (number % 3)
+        self.subnet_id = "subnet-%04d" % (number % 12)
+        self.private_ip_address = "10.%d.%d.%d" % (region_number, number // 256 % 256, number % 256)
+        self.private_dns_name = "ip-10-%d-%d-%d.ec2.internal" % (region_number, number // 256 % 256, number % 256)
+        self.ip_address = ""
+        self.public_dns_name = ""
+        self.monitored = False
+        self.root_device_type = "ebs"
+        self.groups = [
+            FakeGroup("sg-%04d" % (number % 10), "service-%d" % (number % 10)),
+            FakeGroup("sg-admin", "admin"),
+        ]
+        self.tags = {
+            "Name": "service-%d-%d" % (number % 10, number % 50),
+            "environment": ("prod", "stage", "dev")[number % 3],
+            "deployment": "deployment-%d" % (number % 4),
+            "cluster": "service-%d" % (number % 10),
+        }
+
+
+class FakeReservation:
+    def __init__(self, instances):
+        self.instances = instances
+
+
+class FakeRecordSet:
+    def __init__(self, name, resource_records):
+        self.name = name
+        self.resource_records = resource_records
+
+
+class FakeZone:
+    """A Route53 hosted zone with the attributes boto.route53.zone.Zone exposes."""
+
+    def __init__(self, zone_id, name):
+        self.id = zone_id
+        self.name = name
+        self.record_sets = []
+
+    @property
+    def resourcerecordsetcount(self):
+        return str(len(self.record_sets))
+
+
+def _matches(instance, name, values):
+    """Whether an instance matches a DescribeInstances filter, where * and ? are wildcards like in AWS."""
+    if name.startswith("tag:"):
+        value = instance.tags.get(name[len("tag:"):])
+    elif name in INSTANCE_FILTERS:
+        value = getattr(instance, INSTANCE_FILTERS[name])
+    else:
+        raise ValueError("unsupported DescribeInstances filter: %s" % name)
+
+    if value is None:
+        return False
+    return any(re.match(re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".") + r"\Z", value)
+               for pattern in values)
+
+
+class FakeAWS:
+    """Local stand-in for the AWS APIs used by ec2.py, counting every call."""
+
+    def __init__(self, regions, size, latency=DEFAULT_LATENCY):
+        self.latency = latency
+        self.calls = Counter()
+        self.lock = threading.Lock()
+        self.instances = {}
+        self.zones = {}
+
+        per_region = size // len(regions)
+        for region_number, region in enumerate(regions):
+            count = per_region + (1 if region_number < size % len(regions) else 0)
+            self.instances[region] = [FakeInstance(region, region_number, number) for number in range(count)]
+
+    def call(self, operation):
+        with self.lock:
+            self.calls[operation] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def describe_instances(self, region, filters=None):
+        self.call("ec2:DescribeInstances")
+        instances = self.instances.get(region, [])
+        for name, values in (filters or {}).items():
+            values = values if isinstance(values, list) else [values]
+            instances = [instance for instance in instances if _matches(instance, name, values)]
+        return [FakeReservation(instances[i:i + 10]) for i in range(0, len(instances), 10)]
+
+    def describe_db_instances(self, region):
+        self.call("rds:DescribeDBInstances")
+        return []
+
+    def add_zone(self, name, records):
+        """Adds a Route53 hosted zone with the given map of record names to resource records."""
+        zone = FakeZone("Z%04d" % len(self.zones), name + ".")
+        zone.record_sets = [FakeRecordSet(record + ".", resources) for record, resources in sorted(records.items())]
+        self.zones[zone.id] = zone
+        return zone
+
+    def list_hosted_zones(self):
+        self.call("route53:ListHostedZones")
+        return list(self.zones.values())
+
+    def list_resource_record_sets(self, zone_id):
+        self.call("route53:ListResourceRecordSets")
+        return list(self.zones[zone_id].record_sets)
+
+    @contextlib.contextmanager
+    def patched(self):
+        """Points boto at this stand-in for the duration of the block."""
+        fake = self
+
+        class FakeEC2Connection:
+            def __init__(self, region):
+                self.region = region
+
+            def get_all_instances(self, instance_ids=None, filters=None):
+                return fake.describe_instances(self.region, filters)
+
+        class FakeRDSConnection:
+            def __init__(self, region):
+                self.region = region
+
+            def get_all_dbinstances(self):
+                return fake.describe_db_instances(self.region)
+
+        class FakeRoute53Connection:
+            def get_zones(self):
+                return fake.list_hosted_zones()
+
+            def get_all_rrsets(self, zone_id):
+                return fake.list_resource_record_sets(zone_id)
+
+        originals = (ec2.connect_to_region, rds.connect_to_region, route53.Route53Connection)
+        ec2.connect_to_region = FakeEC2Connection
+        rds.connect_to_region = FakeRDSConnection
+        route53.Route53Connection = FakeRoute53Connection
+        try:
+            yield
+        finally:
+            ec2.connect_to_region, rds.connect_to_region, route53.Route53Connection = originals
+
+
+def load_ec2_script():
+    """Imports playbooks/ec2.py as a module, without running it."""
+    spec = importlib.util.spec_from_file_location("ec2_inventory", EC2_SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_inifile(path, regions, cache_path, cache_format=None):
+    """Writes a copy of the shipped ec2.ini that uses the given regions and cache."""
+    config = configparser.ConfigParser()
+    config.read(EC2_INI_PATH)
+    config.set("ec2", "regions", ",".join(regions))
+    config.set("ec2", "cache_path", cache_path)
+    if cache_format:
+        config.set("ec2", "cache_format", cache_format)
+    with open(path, "w") as inifile:
+        config.write(inifile)
+
+
+def run_inventory(module, fake, argv):
+    """Runs the inventory script once, returning its output and the API calls it made."""
+    fake.calls.clear()
+    output = io.StringIO()
+    saved_argv = sys.argv
+    sys.argv = [EC2_SCRIPT_PATH] + argv
+    try:
+        with fake.patched(), contextlib.redirect_stdout(output):
+            module.Ec2Inventory()
+    finally:
+        sys.argv = saved_argv
+    return output.getvalue(), dict(fake.calls)
+
+
+def benchmark_size(module, regions, size, cache_format, latency):
+    """Measures every mode against a fleet of the given size."""
+    fake = FakeAWS(regions, size, latency)
+    host = next(instance.private_ip_address
+                for instances in fake.instances.values() for instance in instances
+                if instance.state == "running")
+    results = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        inifile = os.path.join(workdir, "ec2.ini")
+        cache_path = os.path.join(workdir, "cache")
+        write_inifile(inifile, regions, cache_path, cache_format)
+        base_argv = ["--inifile", inifile]
+
+        argvs = {
+            "cold": base_argv + ["--refresh-cache"],
+            "warm": base_argv + ["--list"],
+            "host": base_argv + ["--host", host],
+        }
+
+        for mode in MODES:
+            start = time.perf_counter()
+            output, calls = run_inventory(module, fake, argvs[mode])
+            wall_time = time.perf_counter() - start
+
+            tracemalloc.start()
+            run_inventory(module, fake, argvs[mode])
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            results.append({
+                "instances": size,
+                "regions": len(regions),
+                "mode": mode,
+                "wall_time_seconds": round(wall_time, 4),
+                "peak_memory_bytes": peak_memory,
+                "api_calls": calls,
+                "total_api_calls": sum(calls.values()),
+                "output_bytes": len(output.encode("utf-8")),
+            })
+
+    return results
+
+
+def print_results(results):
+    print("%10s %6s %12s %14s %10s %14s" % ("instances", "mode", "wall time", "peak memory", "API calls", "output bytes"))
+    for result in results:
+        print("%10d %6s %11.3fs %13.1fM %10d %14d" % (
+            result["instances"], result["mode"], result["wall_time_seconds"],
+            result["peak_memory_bytes"] / 1024.0 / 1024.0, result["total_api_calls"], result["output_bytes"]))
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="Benchmark the EC2 inventory script against a synthetic fleet.")
+    parser.add_argument("--sizes", default="100,5000,50000",
+                        help="comma separated fleet sizes (default: %(default)s)")
+    parser.add_argument("--regions", default=DEFAULT_REGIONS,
+                        help="comma separated regions the fleet is spread over (default: %(default)s)")
+    parser.add_argument("--cache-format", help="cache_format to benchmark (default: the one in ec2.ini)")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY,
+                        help="seconds every fake API call takes (default: %(default)s)")
+    parser.add_argument("--output", help="file the results are written to as JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    # The cache path and prefix must come from the generated ec2.ini
+    os.environ.pop("EC2_CACHE_PATH", None)
+    os.environ.pop("AWS_PROFILE", None)
+
+    module = load_ec2_script()
+    regions = args.regions.split(",")
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        results.extend(benchmark_size(module, regions, size, args.cache_format, args.latency))
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"cache_format": args.cache_format, "latency": args.latency, "results": results},
+                      output, indent=2, sort_keys=True)
@@ -1,140 +1,583 @@
+import hashlib
+import heapq
+import json
 import os
 import pathlib2
+import posixpath
 import logging
 import yaml
 import sys
 import networkx as nx
-from collections import namedtuple
+from collections import deque, namedtuple
 import argparse
 import six
+import subprocess
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import dockerfile_dag
 
 TRAVIS_BUILD_DIR = os.environ.get("TRAVIS_BUILD_DIR")
-DOCKER_PATH_ROOT = pathlib2.Path(TRAVIS_BUILD_DIR, "docker", "build")
-DOCKER_PLAYS_PATH = pathlib2.Path(TRAVIS_BUILD_DIR, "docker", "plays")
+DOCKER_BUILD_DIR = os.path.join("docker", "build")
+DOCKER_PLAYS_DIR = os.path.join("docker", "plays")
 CONFIG_FILE_PATH = pathlib2.Path(TRAVIS_BUILD_DIR, "util", "parsefiles_config.yml")
+GRAPH_CACHE_PATH = pathlib2.Path(TRAVIS_BUILD_DIR, ".build", "parsefiles_cache.json")
 LOGGER = logging.getLogger(__name__)
 
+# libyaml's loader is much faster than the pure Python one, but is not always compiled in
+SafeLoader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# Below this many files to parse, starting worker processes costs more than it saves
+PARALLEL_PARSE_MIN_FILES = 64
+
+# Bump whenever the way roles are read from yaml files changes, so that existing caches are discarded
+GRAPH_CACHE_VERSION = 5
+
+# task keywords, without an ansible.builtin. or ansible.legacy. prefix, that run another file of tasks or a role
+INCLUDE_TASKS_ACTIONS = ("include_tasks", "import_tasks", "include")
+INCLUDE_ROLE_ACTIONS = ("include_role", "import_role")
+
+# keys of a task or play that contain lists of tasks
+TASK_LIST_KEYS = ("block", "rescue", "always", "pre_tasks", "tasks", "post_tasks", "handlers")
+
+Node = namedtuple('Node', ['name', 'type'])
+GraphSource = namedtuple('GraphSource', ['path', 'name', 'type', 'key'])
 
-def build_graph(git_dir, roles_dirs, aws_play_dirs, docker_play_dirs):
+
+def build_graph(git_dir, roles_dirs, aws_play_dirs, docker_play_dirs, cache_file=None, jobs=1):
     """
     Builds a dependency graph that shows relationships between roles and playbooks.
     An edge [A, B], where A and B are roles, signifies that A depends on B. An edge
     [C, D], where C is a playbook and D is a role, signifies that C uses D.
 
+    Roles depend on the roles listed in their meta/*.yml files and on the roles included by the
+    files of their tasks that can run. graph.graph["reachable_tasks"] maps the roles any playbook
+    runs to the files in their tasks directory that can run at all, see _get_play_reachable_tasks,
+    and graph.graph["docker_play_index"] maps roles and files of tasks to the docker plays that
+    run them.
+
     Input:
     git_dir: A path to the top-most directory in the local git repository tool is to be run in.
     roles_dirs: A list of relative paths to directories in which Ansible roles reside.
     aws_play_dirs: A list of relative paths to directories in which AWS Ansible playbooks reside.
     docker_play_dirs: A list of relative paths to directories in which Docker Ansible playbooks reside.
+    cache_file: An optional path to a file in which the parsed edges of every file are cached along
+        with a hash of the file's contents. Only files whose contents changed since the cache was
+        written are parsed again.
+    jobs: The number of processes used to parse the yaml files that are not cached.
 
     """
 
+    sources = _find_graph_sources(git_dir, roles_dirs, aws_play_dirs, docker_play_dirs)
+
+    cache = _load_graph_cache(cache_file) if cache_file is not None else {}
+    cached_entries = cache.get("files", {})
+
+    entries = {}
+    unparsed = []
+    for cache_key in sorted(sources):
+        entry, contents = _get_graph_cache_entry(git_dir, sources[cache_key], cached_entries.get(cache_key))
+        entries[cache_key] = entry
+
+        # files that are new or whose contents changed are parsed together below
+        if contents is not None:
+            unparsed.append((cache_key, contents))
+
+    results = _parse_graph_sources([(sources[key], contents) for key, contents in unparsed], jobs)
+
+    errors = False
+    for (cache_key, _), (references, error) in zip(unparsed, results):
+        if error is not None and sources[cache_key].type == "tasks":
+            # tasks are only parsed to narrow down what a change affects, so assume the worst
+            LOGGER.warning("could not parse tasks, assuming every file of the role can run: %s" % error)
+            entries[cache_key].update(roles=[], included_roles=[], includes=[], dynamic=True)
+        elif error is not None:
+            LOGGER.error("error in configuration file: %s" % error)
+            errors = True
+        else:
+            entries[cache_key].update(references)
+
+    if errors:
+        sys.exit(1)
+
+    # the docker play index only depends on what was parsed, so it is reused as long as that is unchanged
+    fingerprint = hashlib.sha1(json.dumps(
+        [[key] + [entries[key].get(field) for field in ("name", "type", "file", "roles", "included_roles", "includes",
+                                                         "dynamic")] for key in sorted(entries)]
+    ).encode("utf-8")).hexdigest()
+
+    index = cache.get("index")
+    if index is None or index["fingerprint"] != fingerprint:
+        play_reachable_tasks, reachable_tasks = _get_play_reachable_tasks(entries)
+        index = None
+    else:
+        reachable_tasks = {role: None if files is None else set(files)
+                           for role, files in index["reachable_tasks"].items()}
+
     graph = nx.DiGraph()
 
-    _map_roles_to_roles(graph, roles_dirs, git_dir, "dependencies", "role", "role")
-    _map_plays_to_roles(graph, aws_play_dirs, git_dir, "roles", "aws_playbook", "role")
-    _map_plays_to_roles(graph, docker_play_dirs, git_dir, "roles", "docker_playbook", "role")
+    for cache_key in sorted(entries):
+        entry = entries[cache_key]
+
+        # a file of tasks adds the roles it includes to the dependencies of its role, if it can run
+        node = Node(entry["name"], "role" if entry["type"] == "tasks" else entry["type"])
+        if entry["type"] == "tasks" and not _is_reachable(reachable_tasks, entry["name"], entry["file"]):
+            continue
+
+        # add edge, typically dependent role - role or role - playbook that uses it
+        for name in entry["roles"] + [name for name, _ in entry["included_roles"] if name is not None]:
+            graph.add_edge(Node(name, "role"), node)
+
+    graph.graph["reachable_tasks"] = reachable_tasks
+
+    if index is None:
+        index = _build_docker_play_index(graph, fingerprint, play_reachable_tasks, reachable_tasks)
+    graph.graph["docker_play_index"] = index
+
+    if cache_file is not None and (entries != cached_entries or index is not cache.get("index")):
+        _write_graph_cache(cache_file, entries, index)
 
     return graph
 
-def _map_roles_to_roles(graph, dirs, git_dir, key, type_1, type_2):
+def _find_graph_sources(git_dir, roles_dirs, aws_play_dirs, docker_play_dirs):
     """
-    Maps roles to the roles that they depend on.
+    Lists the files the dependency graph is built from, keyed by the type of the node they describe
+    and their path relative to git_dir.
 
     Input:
-    graph: A networkx digraph that is used to map Ansible dependencies.
-    dirs: A list of relative paths to directories in which Ansible roles reside.
     git_dir: A path to the top-most directory in the local git repository tool is to be run in.
-    key: The key in a role yaml file in dirs that maps to relevant role data. In this case, key is
-        "dependencies", because a role's dependent roles is of interest.
-    type_1: Given edges A-B, the type of node A.
-    type_2: Given edges A-B, the type of node B.
-        Since this function maps roles to their dependent roles, both type_1 and type_2 are "role".
+    roles_dirs: A list of relative paths to directories in which Ansible roles reside.
+    aws_play_dirs: A list of relative paths to directories in which AWS Ansible playbooks reside.
+    docker_play_dirs: A list of relative paths to directories in which Docker Ansible playbooks reside.
     """
 
-    Node = namedtuple('Node', ['name', 'type'])
+    sources = {}
 
     # for each role directory
-    for d in dirs:
+    for d in roles_dirs:
         d = pathlib2.Path(git_dir, d)
 
         # for all files/sub-directories in directory
         for item in d.iterdir():
 
-            # attempts to find meta/*.yml file in item directory tree
-            roles = {f for f in item.glob("meta/*.yml")}
+            # every meta/*.yml file lists dependencies of the role in item
+            for role in item.glob("meta/*.yml"):
+                _add_graph_source(sources, git_dir, role, item.name, "role", "dependencies")
 
-            # if a meta/*.yml file(s) exists for a role
-            if roles:
-                # for each role
-                for role in roles:
-                    yaml_file = _open_yaml_file(role)
+            # files of tasks include other files of tasks and roles
+            tasks_dir = item / "tasks"
+            for pattern in ("**/*.yml", "**/*.yaml"):
+                for tasks in tasks_dir.glob(pattern):
+                    _add_graph_source(sources, git_dir, tasks, item.name, "tasks", tasks.relative_to(tasks_dir).as_posix())
 
-                    # if not an empty yaml file and key in file
-                    if yaml_file is not None and key in yaml_file:
-                        # for each dependent role; yaml_file["dependencies"] returns list of
-                        # dependent roles
-                        for dependent in yaml_file[key]:
-                            # get role name of each dependent role
-                            name = _get_role_name(dependent)
+    for dirs, node_type in ((aws_play_dirs, "aws_playbook"), (docker_play_dirs, "docker_playbook")):
+        # for each play directory
+        for d in dirs:
+            d = pathlib2.Path(git_dir, d)
 
-                            # add node for type_1, typically role
-                            node_1 = Node(item.name, type_1)
+            # for all files/sub-directories in directory
+            for item in d.iterdir():
 
-                            # add node for type_2, typically dependent role
-                            node_2 = Node(name, type_2)
+                # if item is a file ending in .yml
+                if item.match("*.yml"):
+                    _add_graph_source(sources, git_dir, item, item.stem, node_type, "roles")
 
-                            # add edge, typically dependent role - role
-                            graph.add_edge(node_2, node_1)
+    return sources
 
-def _map_plays_to_roles(graph, dirs, git_dir, key, type_1, type_2):
+def _add_graph_source(sources, git_dir, path, name, node_type, key):
     """
-    Maps plays to the roles they use.
+    Adds a file the dependency graph is built from to sources.
 
     Input:
-    graph: A networkx digraph that is used to map Ansible dependencies.
-    dirs: A list of relative paths to directories in which Ansible playbooks reside.
+    sources: A dict of the files the dependency graph is built from.
     git_dir: A path to the top-most directory in the local git repository tool is to be run in.
-    key: The key in a playbook yaml file in dirs that maps to relevant playbook data. In this case, key is
-        "roles", because the roles used by a playbook is of interest.
-    type_1: Given edges A-B, the type of node A.
-    type_2: Given edges A-B, the type of node B.
-        Since this function maps plays to the roles they use, both type_1 is a type of playbook and type_2 is "role".
+    path: The path to the yaml file.
+    name: The name of the node the yaml file describes.
+    node_type: The type of the node the yaml file describes, e.g. "role" or "docker_playbook", or
+        "tasks" for a file in the tasks directory of the role name.
+    key: The key in the yaml file that maps to the roles the node depends on, e.g. "dependencies"
+        for a role or "roles" for a playbook. For a file of tasks, its path relative to the tasks
+        directory.
     """
 
-    Node = namedtuple('Node', ['name', 'type'])
+    relative_path = str(path.relative_to(git_dir))
+    source = GraphSource(relative_path, name, node_type, key)
+    sources["%s:%s" % (node_type, relative_path)] = source
 
-    # for each play directory
-    for d in dirs:
-        d = pathlib2.Path(git_dir, d)
+def _get_graph_cache_entry(git_dir, source, cached):
+    """
+    Returns the cache entry for a file the dependency graph is built from. If the file has to be
+    parsed, because its contents differ from the ones the cached entry was created from, the
+    entry has no roles yet and its contents are returned as well.
 
-        # for all files/sub-directories in directory
-        for item in d.iterdir():
+    Input:
+    git_dir: A path to the top-most directory in the local git repository tool is to be run in.
+    source: The GraphSource describing the file.
+    cached: The entry for the file in the existing cache, or None.
+    """
+
+    path = pathlib2.Path(git_dir, source.path)
+    stat = os.stat(str(path))
+
+    if cached is not None and (cached["name"], cached["type"]) != (source.name, source.type):
+        cached = None
+
+    # an unchanged size and modification time means the file was not touched since it was hashed
+    if cached is not None and (cached["size"], cached["mtime_ns"]) == (stat.st_size, stat.st_mtime_ns):
+        return cached, None
+
+    with path.open(mode='rb') as file:
+        contents = file.read()
+
+    digest = hashlib.sha1(contents).hexdigest()
 
-            # if item is a file ending in .yml
-            if item.match("*.yml"):
-                # open .yml file for playbook
-                yaml_file = _open_yaml_file(item)
+    entry = {
+        "name": source.name,
+        "type": source.type,
+        "sha1": digest,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
 
-                # if not an empty yaml file
-                if yaml_file is not None:
-                    # for each play in yaml file
-                    for play in yaml_file:
-                        # if specified key in yaml file (e.g. "roles")
-                        if key in play:
-                            # for each role
-                            for role in play[key]:
-                                # get role name
-                                name = _get_role_name(role)
+    if source.type == "tasks":
+        entry["file"] = source.key
 
-                                #add node for type_1, typically for playbook
-                                node_1 = Node(item.stem, type_1)
+    if cached is not None and cached["sha1"] == digest:
+        # keep what was parsed from the file
+        for key, value in cached.items():
+            entry.setdefault(key, value)
+        return entry, None
 
-                                # add node for type_2, typically for role
-                                node_2 = Node(name, type_2)
+    return entry, contents
 
-                                 # add edge, typically role - playbook that uses it
-                                graph.add_edge(node_2, node_1)
+def _parse_graph_sources(items, jobs):
+    """
+    Parses yaml files the dependency graph is built from, in a pool of processes if there are
+    enough of them. Returns a (references, error) tuple for every item, in the order of items.
+
+    Input:
+    items: A list of (GraphSource, contents) tuples.
+    jobs: The number of processes used to parse the files.
+    """
+
+    if jobs > 1 and len(items) >= PARALLEL_PARSE_MIN_FILES:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            return list(pool.map(_parse_graph_source, items, chunksize=max(1, len(items) // (jobs * 4))))
+
+    return [_parse_graph_source(item) for item in items]
+
+def _parse_graph_source(item):
+    """
+    Returns what _get_references_from_yaml finds in a file the dependency graph is built from, and
+    None, or None and the error if the file is not valid yaml. This runs in worker processes, so it
+    must not exit.
+
+    Input:
+    item: A (GraphSource, contents) tuple.
+    """
+
+    source, contents = item
+
+    try:
+        yaml_file = yaml.load(contents, Loader=SafeLoader)
+    except yaml.YAMLError as exc:
+        return None, "%s: %s" % (source.path, exc)
+
+    return _get_references_from_yaml(yaml_file, source), None
+
+def _get_references_from_yaml(yaml_file, source):
+    """
+    Returns a dict of what a file the dependency graph is built from refers to:
+
+    roles: The names of the roles a role depends on or a playbook lists in its roles.
+    included_roles: [role, file] pairs for the roles included with include_role or import_role, and
+        the file of their tasks directory that is run, "main" unless tasks_from is set. The file is
+        None if tasks_from is templated, and the role is None if its name is templated, as then any
+        file of the role, or of any role, might run.
+    includes: For a file of tasks, the files of tasks it includes, as they are written.
+    dynamic: For a file of tasks, whether it includes files whose names are templated.
+
+    Input:
+    yaml_file: The parsed contents of a role's meta/*.yml file, of a playbook or of a file of tasks.
+    source: The GraphSource describing the file.
+    """
+
+    references = {"roles": [], "included_roles": []}
+
+    if source.type == "tasks":
+        references.update(includes=[], dynamic=False)
+
+    # if an empty yaml file
+    if yaml_file is None:
+        return references
+
+    if source.type == "role":
+        # yaml_file["dependencies"] returns list of dependent roles
+        if source.key in yaml_file:
+            references["roles"] = [_get_role_name(dependent) for dependent in yaml_file[source.key]]
+        return references
+
+    if source.type != "tasks":
+        # for each play in yaml file
+        for play in yaml_file:
+            # if specified key in yaml file (e.g. "roles")
+            if source.key in play:
+                references["roles"].extend(_get_role_name(role) for role in play[source.key])
+
+    for task in _walk_tasks(yaml_file):
+        for action, value in task.items():
+            action = action.split(".")[-1] if str(action).startswith(("ansible.builtin.", "ansible.legacy.")) else action
+
+            if action in INCLUDE_TASKS_ACTIONS and "includes" in references:
+                # include: <file> [<var>=<value> ...], or include_tasks: {file: <file>}
+                target = value.get("file") if isinstance(value, dict) else value
+                if not isinstance(target, six.string_types) or "{{" in target or not target.split():
+                    references["dynamic"] = True
+                else:
+                    references["includes"].append(target.split()[0])
+
+            elif action in INCLUDE_ROLE_ACTIONS:
+                # include_role: {name: <role>, tasks_from: <file>}, or include_role: name=<role> tasks_from=<file>
+                if isinstance(value, six.string_types):
+                    value = dict(arg.split("=", 1) for arg in value.split() if "=" in arg)
+                if not isinstance(value, dict):
+                    continue
+
+                name = value.get("name")
+                if not isinstance(name, six.string_types) or "{{" in name:
+                    name = None
+
+                tasks_from = value.get("tasks_from") or "main"
+                if not isinstance(tasks_from, six.string_types) or "{{" in tasks_from:
+                    tasks_from = None
+
+                references["included_roles"].append([name, tasks_from])
+
+    return references
+
+def _walk_tasks(tasks):
+    """
+    Yields every task in a list of tasks or plays, including the ones nested in blocks and in the
+    task lists of plays.
+
+    Input:
+    tasks: The parsed contents of a file of tasks or of a playbook.
+    """
+
+    if not isinstance(tasks, list):
+        return
+
+    for task in tasks:
+        if isinstance(task, dict):
+            yield task
+
+            for key in TASK_LIST_KEYS:
+                for nested in _walk_tasks(task.get(key)):
+                    yield nested
+
+def _get_play_reachable_tasks(entries):
+    """
+    Returns a tuple of a dict mapping every docker playbook, as a Node, to what it can run, and of
+    what all the playbooks together can run. What playbooks can run is a dict mapping every role
+    they run to the set of the files in the role's tasks directory, relative to it, that can run, or
+    to None if any of them might. Roles are entered the way Ansible runs them, from the roles of the
+    play and the roles it includes, running their meta dependencies and then their tasks/main.yml
+    or tasks_from file, and following the files of tasks and roles these include, transitively.
+
+    Input:
+    entries: A dict mapping every file the dependency graph is built from to its cache entry.
+    """
+
+    tasks = {}
+    dependencies = {}
+    plays = []
+
+    for entry in entries.values():
+        if entry["type"] == "tasks":
+            tasks.setdefault(entry["name"], {})[entry["file"]] = entry
+        elif entry["type"] == "role":
+            dependencies.setdefault(entry["name"], []).extend(role for role in entry["roles"] if role)
+        else:
+            plays.append(entry)
+
+    all_roles = sorted(set(tasks) | set(dependencies))
+
+    docker_plays = {Node(play["name"], play["type"]): _get_reachable_tasks([play], tasks, dependencies, all_roles)
+                    for play in plays if play["type"] == "docker_playbook"}
+
+    # what the plays run together is what they each run, so it is found in a single pass
+    return docker_plays, _get_reachable_tasks(plays, tasks, dependencies, all_roles)
+
+def _get_reachable_tasks(plays, tasks, dependencies, all_roles):
+    """
+    Returns a dict mapping every role playbooks run to the set of the files in its tasks directory
+    that can run, or to None if any of them might, see _get_play_reachable_tasks.
+
+    Input:
+    plays: The cache entries of the playbooks.
+    tasks: A dict mapping roles to a dict of the cache entries of the files in their tasks directory.
+    dependencies: A dict mapping roles to the roles their meta/*.yml files list.
+    all_roles: Every role, any of which a role with a templated name included by a play might be.
+    """
+
+    reachable = {}
+    # (role, including file, included file) of the files of tasks to run, None for all of them
+    pending = []
+
+    def _enter(role, tasks_from):
+        if role not in reachable:
+            reachable[role] = set()
+            for dependency in dependencies.get(role, ()):
+                _enter(dependency, "main")
+        pending.append((role, "", tasks_from))
+
+    def _include_roles(included_roles):
+        for role, tasks_from in included_roles:
+            if role is None:
+                # the role with a templated name might be any role, running any of its files
+                for role in all_roles:
+                    _enter(role, None)
+            else:
+                _enter(role, tasks_from)
+
+    for play in plays:
+        for role in play["roles"]:
+            if role:
+                _enter(role, "main")
+        _include_roles(play["included_roles"])
+
+    while pending:
+        role, including, target = pending.pop()
+
+        if target is None:
+            if reachable[role] is None:
+                continue
+            reachable[role] = None
+            run = sorted(tasks.get(role, {}).items())
+        else:
+            resolved = _resolve_tasks_file(tasks, role, including, target)
+            if resolved is None:
+                continue
+            if resolved is False:
+                pending.append((role, "", None))
+                continue
+
+            # the file may be in the tasks directory of another role
+            role, path = resolved
+            files = reachable.setdefault(role, set())
+            if files is None or path in files:
+                continue
+            files.add(path)
+            run = [(path, tasks[role][path])]
+
+        for path, entry in run:
+            if entry["dynamic"]:
+                pending.append((role, "", None))
+            pending.extend((role, path, included) for included in entry["includes"])
+            _include_roles(entry["included_roles"])
+
+    return reachable
+
+def _is_reachable(reachable_tasks, role, path):
+    """
+    Whether a file of tasks can run according to a dict mapping roles to the files of their tasks
+    directory that can run, or to None if any of them might.
+
+    Input:
+    reachable_tasks: A dict as returned by _get_reachable_tasks.
+    role: The role of the file.
+    path: The path of the file relative to the tasks directory of role.
+    """
+
+    return role in reachable_tasks and (reachable_tasks[role] is None or path in reachable_tasks[role])
+
+def _resolve_tasks_file(tasks, role, including, target):
+    """
+    Resolves the name of an included file of tasks the way Ansible does: relative to the directory
+    of the including file, to the tasks directory of the role, or to the role itself, adding .yml or
+    .yaml if there is no such file. A relative name can lead into the tasks directory of another
+    role. Returns a (role, path) tuple, the path being relative to the tasks directory of that role,
+    None if there is no such file, or False if the name is absolute or points out of the roles
+    directory, as then it cannot be told which files run.
+
+    Input:
+    tasks: A dict mapping roles to a dict of the cache entries of the files in their tasks directory.
+    role: The role of the including file.
+    including: The path of the including file relative to the tasks directory of role.
+    target: The name of the included file.
+    """
+
+    if target.startswith("/"):
+        return False
+
+    tasks_dir = posixpath.join(role, "tasks")
+    candidates = [
+        posixpath.normpath(posixpath.join(tasks_dir, posixpath.dirname(including), target)),
+        posixpath.normpath(posixpath.join(tasks_dir, target)),
+        posixpath.normpath(posixpath.join(role, target)),
+    ]
+
+    for candidate in candidates:
+        parts = candidate.split("/", 2)
+        if len(parts) < 3 or parts[1] != "tasks":
+            continue
+
+        files = tasks.get(parts[0], {})
+        for suffix in ("", ".yml", ".yaml"):
+            if parts[2] + suffix in files:
+                return parts[0], parts[2] + suffix
+
+    if any(candidate.startswith("..") for candidate in candidates):
+        return False
+
+    return None
+
+def _load_graph_cache(cache_file):
+    """
+    Reads the cache written by _write_graph_cache, returning an empty cache if it is missing,
+    unreadable or was written by a different version of this tool.
+
+    Input:
+    cache_file: The path to the cache file.
+    """
+
+    try:
+        with open(str(cache_file)) as file:
+            cache = json.load(file)
+    except (IOError, OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get("version") != GRAPH_CACHE_VERSION:
+        return {}
+
+    return cache
+
+def _write_graph_cache(cache_file, entries, index):
+    """
+    Atomically replaces the cache file with entries and the docker play index.
+
+    Input:
+    cache_file: The path to the cache file.
+    entries: A dict mapping every file the dependency graph is built from to its cache entry.
+    index: The docker play index built by _build_docker_play_index.
+    """
+
+    cache_dir = os.path.dirname(os.path.abspath(str(cache_file)))
+
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=".parsefiles_cache.")
+        try:
+            with os.fdopen(fd, "w") as file:
+                json.dump({"version": GRAPH_CACHE_VERSION, "files": entries, "index": index}, file, sort_keys=True)
+            os.rename(tmp_path, str(cache_file))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except (IOError, OSError) as exc:
+        LOGGER.warning("could not write dependency graph cache %s: %s" % (cache_file, exc))
 
 def _open_yaml_file(file_str):
     """
@@ -145,12 +588,122 @@ def _open_yaml_file(file_str):
     """
 
     with (file_str.open(mode='r')) as file:
-        try:
-            yaml_file = yaml.safe_load(file)
-            return yaml_file
-        except yaml.YAMLError as exc:
-            LOGGER.error("error in configuration file: %s" % str(exc))
-            sys.exit(1)
+        return _load_yaml(file)
+
+def _load_yaml(stream):
+    """
+    Parses yaml, exiting if it is invalid.
+
+    Input:
+    stream: The yaml document, as a string or an open file.
+    """
+
+    try:
+        return yaml.load(stream, Loader=SafeLoader)
+    except yaml.YAMLError as exc:
+        LOGGER.error("error in configuration file: %s" % str(exc))
+        sys.exit(1)
+
+
+class ChangeSetIndex(object):
+    """
+    A trie of path components that maps changed files to the roles, playbooks and Docker images
+    they belong to, in time proportional to the depth of their paths. Only the paths themselves
+    are looked at, so files deleted by a change set are mapped like any other.
+
+    Input:
+    git_dir: A path to the top-most directory in the local git repository tool is to be run in.
+    roles_dirs: A list of relative paths to directories in which Ansible roles reside.
+    aws_play_dirs: A list of relative paths to directories in which AWS Ansible playbooks reside.
+    docker_play_dirs: A list of relative paths to directories in which Docker Ansible playbooks reside.
+    docker_build_dirs: A list of relative paths to directories in which Docker images reside.
+    reachable_tasks: An optional dict mapping roles to the files in their tasks directories that can
+        run, as in graph.graph["reachable_tasks"]. A yaml file in the tasks directory of one of
+        these roles belongs to a "tasks" node named by the (role, file) tuple if it can run, so that
+        only the docker plays that run it are affected, and to nothing otherwise.
+    """
+
+    # key of a trie node under which the types of the directories ending at that node are stored;
+    # it cannot collide with a path component, which are strings
+    TYPES = None
+
+    def __init__(self, git_dir, roles_dirs=(), aws_play_dirs=(), docker_play_dirs=(), docker_build_dirs=(),
+                 reachable_tasks=None):
+        self.git_dir = str(git_dir)
+        self.reachable_tasks = reachable_tasks or {}
+        self.root = {}
+
+        for dirs, node_type in ((roles_dirs, "role"), (aws_play_dirs, "aws_playbook"),
+                                (docker_play_dirs, "docker_playbook"), (docker_build_dirs, "docker_image")):
+            for d in dirs:
+                node = self.root
+                for part in self._split(d):
+                    node = node.setdefault(part, {})
+                node.setdefault(self.TYPES, []).append(node_type)
+
+    def _split(self, path):
+        """Splits a path, absolute or relative to git_dir, into its components relative to git_dir."""
+        relative_path = os.path.relpath(os.path.join(self.git_dir, str(path)), self.git_dir)
+        if relative_path == os.curdir:
+            return []
+        return relative_path.split(os.sep)
+
+    def lookup(self, path):
+        """
+        Returns a list of the Nodes a changed file belongs to.
+
+        Input:
+        path: The path to the changed file, absolute or relative to git_dir.
+        """
+
+        parts = self._split(path)
+        nodes = []
+
+        node = self.root
+        for depth, part in enumerate(parts):
+            rest = parts[depth:]
+
+            for node_type in node.get(self.TYPES, ()):
+                if node_type == "role" and self._is_tasks_file(rest) and rest[0] in self.reachable_tasks:
+                    tasks_file = "/".join(rest[2:])
+                    if _is_reachable(self.reachable_tasks, rest[0], tasks_file):
+                        nodes.append(Node((rest[0], tasks_file), "tasks"))
+                    else:
+                        LOGGER.warning("'%s' is not run by any role or playbook." % path)
+                elif node_type in ("role", "docker_image"):
+                    # <dir>/<role or image>/... belongs to the role or image
+                    if len(rest) > 1:
+                        nodes.append(Node(rest[0], node_type))
+                # <dir>/<playbook>.yml is a playbook
+                elif len(rest) == 1 and rest[0].endswith(".yml"):
+                    nodes.append(Node(os.path.splitext(rest[0])[0], node_type))
+
+            node = node.get(part)
+            if node is None:
+                break
+
+        return nodes
+
+    def _is_tasks_file(self, parts):
+        """Whether <role>/tasks/<file> is a yaml file in the tasks directory of a role."""
+        return len(parts) >= 3 and parts[1] == "tasks" and parts[-1].endswith((".yml", ".yaml"))
+
+    def classify(self, files):
+        """
+        Returns a dict mapping every node type to the set of names of the nodes of that type the
+        changed files belong to.
+
+        Input:
+        files: A list of files modified by a commit range.
+        """
+
+        items = {"role": set(), "tasks": set(), "aws_playbook": set(), "docker_playbook": set(), "docker_image": set()}
+
+        for f in files:
+            for node in self.lookup(f):
+                items[node.type].add(node.name)
+
+        return items
 
 
 def change_set_to_roles(files, git_dir, roles_dirs, playbooks_dirs, graph):
@@ -165,25 +718,7 @@ def change_set_to_roles(files, git_dir, roles_dirs, playbooks_dirs, graph):
     graph: A networkx digraph that is used to map Ansible dependencies.
     """
 
-    # set of roles
-    items = set()
-
-    # for all directories containing roles
-    for role_dir in roles_dirs:
-        role_dir_path = pathlib2.Path(git_dir, role_dir)
-
-        # get all files in the directories containing roles (i.e. all the roles in that directory)
-        candidate_files = {f for f in role_dir_path.glob("**/*")}
-
-        # for all the files in the change set
-        for f in files:
-            file_path = pathlib2.Path(git_dir, f)
-
-            # if the change set file is in the set of role files
-            if file_path in candidate_files:
-                # get name of role and add it to set of roles of the change set
-                items.add(_get_role_name_from_file(file_path))
-    return items
+    return ChangeSetIndex(git_dir, roles_dirs=roles_dirs).classify(files)["role"]
 
 
 def get_plays(files, git_dir, playbooks_dirs):
@@ -196,108 +731,160 @@ def get_plays(files, git_dir, playbooks_dirs):
 
     """
 
-    plays = set()
+    return ChangeSetIndex(git_dir, aws_play_dirs=playbooks_dirs).classify(files)["aws_playbook"]
 
-    # for all directories containing playbooks
-    for play_dir in playbooks_dirs:
-        play_dir_path = pathlib2.Path(git_dir, play_dir)
 
-        # get all files in directory containing playbook that end with yml extension
-        # (i.e. all playbooks in that directory)
-        candidate_files = {f for f in play_dir_path.glob("*.yml")}
+def get_dependencies(roles, graph):
+    """
+    Determines all roles dependent on set of roles and returns set containing both.
 
-        # for all filse in the change set
-        for f in files:
-            file_path = pathlib2.Path(git_dir, f)
+    Input:
+    roles: A set of roles.
+    graph: A networkx digraph that is used to map Ansible dependencies.
+    """
 
-            # if the change set file is in the set of playbook files
-            if file_path in candidate_files:
-                plays.add(_get_playbook_name_from_file(file_path))
+    # a role that nothing depends on and no playbook uses, e.g. one deleted by the change set,
+    # is not in the graph
+    sources = [Node(role, "role") for role in roles if (role, "role") in graph]
 
-    return plays
+    # a single breadth-first search from all the roles finds every node that depends on any of them
+    seen = set(sources)
+    queue = deque(sources)
+    while queue:
+        for dependent in graph.successors(queue.popleft()):
+            if dependent not in seen:
+                seen.add(dependent)
+                queue.append(dependent)
 
+    return set(roles) | {node.name for node in seen}
 
-def _get_playbook_name_from_file(path):
-    """
-    Gets name of playbook from the filepath, which is the last part of the filepath.
 
-    Input:
-    path: A path to the playbook
-    """
-    # get last part of filepath
-    return path.stem
+def get_docker_plays(roles, graph):
+    """Gets all docker plays that contain at least role in common with roles."""
 
+    direct_plays = _get_docker_play_index(graph)["direct"]
 
-def _get_role_name_from_file(path):
-    """
-    Gets name of role from the filepath, which is the directory following occurence of the word "roles".
+    items = set()
 
-    Input:
-    path: A path to the role
-    """
-    # get individual parts of a file path
-    dirs = path.parts
+    for role in roles:
+        plays = direct_plays.get(role)
 
-    # name of role is the next part of the file path after "roles"
-    return dirs[dirs.index("roles")+1]
+        if plays:
+            items.update(plays)
+        else:
+            LOGGER.warning("role '%s' is not covered." % role)
 
+    return items
 
-def get_dependencies(roles, graph):
+
+def get_affected_docker_plays(roles, graph):
     """
-    Determines all roles dependent on set of roles and returns set containing both.
+    Gets all docker plays that run a role in roles: the ones that use it or a role that depends on
+    it, or that include it from a file of tasks they run. Answered from the docker play index.
 
     Input:
     roles: A set of roles.
     graph: A networkx digraph that is used to map Ansible dependencies.
     """
 
+    if LOGGER.isEnabledFor(logging.WARNING):
+        # the coverage warnings need every dependent role, so take the long way round for them
+        get_docker_plays(get_dependencies(roles, graph), graph)
+
+    transitive_plays = _get_docker_play_index(graph)["transitive"]
+
     items = set()
 
     for role in roles:
-        # add the role itself
-        items.add(role)
+        items.update(transitive_plays.get(role, ()))
+
+    return items
+
+
+def get_docker_plays_running_tasks(tasks, graph):
+    """
+    Gets all docker plays that can run a file of tasks in tasks.
 
-        # add all the roles that depend on the role
-        dependents = nx.descendants(graph, (role, "role"))
+    Input:
+    tasks: A set of (role, file) tuples, the file being relative to the tasks directory of the role.
+    graph: A networkx digraph that is used to map Ansible dependencies.
+    """
+
+    index = _get_docker_play_index(graph)
+
+    items = set()
 
-        items |= {dependent.name for dependent in dependents}
+    for role, path in tasks:
+        items.update(index["tasks"].get(role, {}).get(path, ()))
+        items.update(index["all_tasks"].get(role, ()))
 
     return items
 
 
-def get_docker_plays(roles, graph):
-    """Gets all docker plays that contain at least role in common with roles."""
+def _get_docker_play_index(graph):
+    """
+    Returns the docker play index of a graph, building it if the graph was not built by build_graph.
+
+    Input:
+    graph: A networkx digraph that is used to map Ansible dependencies.
+    """
 
-    # dict to determine coverage of plays
-    coverage = dict.fromkeys(roles, False)
+    if "docker_play_index" not in graph.graph:
+        graph.graph["docker_play_index"] = _build_docker_play_index(graph, None)
 
-    items = set()
+    return graph.graph["docker_play_index"]
 
-    docker_plays = {node.name for node in graph.nodes() if node.type == "docker_playbook"}
 
-    for play in docker_plays:
-        # all roles that are used by play
-        roles_nodes = nx.all_neighbors(graph, (play, "docker_playbook"))
+def _build_docker_play_index(graph, fingerprint, play_reachable_tasks=None, reachable_tasks=None):
+    """
+    Builds an inverted index from the name of every role to the docker plays that use it directly,
+    and to the docker plays that run it, and from the files of tasks of every role to the docker
+    plays that can run them. Without play_reachable_tasks, a docker play runs the roles it uses
+    and all of their dependencies in the graph, and the files of tasks are not indexed. The files
+    of tasks that can run at all are stored alongside, so that a graph built from the same files
+    does not need to find them again.
 
-        docker_roles = {role.name for role in roles_nodes}
+    Input:
+    graph: A networkx digraph that is used to map Ansible dependencies.
+    fingerprint: A hash of what the graph was built from, stored alongside the index.
+    play_reachable_tasks: An optional dict of the docker plays as returned by _get_play_reachable_tasks.
+    reachable_tasks: An optional dict of what all the playbooks run as returned by _get_play_reachable_tasks.
+    """
 
-        # compares roles and docker roles
-        common_roles = roles & docker_roles
+    direct = {}
 
-        # if their intersection is non-empty, add the docker role
-        if common_roles:
-            items.add(play)
+    for play in sorted(node for node in graph.nodes() if node.type == "docker_playbook"):
+        for role in graph.predecessors(play):
+            direct.setdefault(role.name, []).append(play.name)
 
-            # each aws role that was in common is marked as being covered by a docker play
-            for role in common_roles:
-                coverage[role] = True
+    transitive = {}
+    tasks = {}
+    all_tasks = {}
 
-    # check coverage of roles
-    for role in coverage:
-        if not coverage[role]:
-            LOGGER.warning("role '%s' is not covered." % role)
+    if play_reachable_tasks is None:
+        for role in graph.nodes():
+            if role.type == "role":
+                plays = set(direct.get(role.name, ()))
+                for dependent in nx.descendants(graph, role):
+                    plays.update(direct.get(dependent.name, ()))
 
-    return items
+                if plays:
+                    transitive[role.name] = sorted(plays)
+    else:
+        for play in sorted(play_reachable_tasks):
+            for role, files in sorted(play_reachable_tasks[play].items()):
+                transitive.setdefault(role, []).append(play.name)
+                if files is None:
+                    all_tasks.setdefault(role, []).append(play.name)
+                else:
+                    for path in sorted(files):
+                        tasks.setdefault(role, {}).setdefault(path, []).append(play.name)
+
+    reachable_tasks = {role: None if files is None else sorted(files)
+                       for role, files in (reachable_tasks or {}).items()}
+
+    return {"fingerprint": fingerprint, "direct": direct, "transitive": transitive, "tasks": tasks,
+            "all_tasks": all_tasks, "reachable_tasks": reachable_tasks}
 
 
 def filter_docker_plays(plays, repo_path):
@@ -306,7 +893,7 @@ def filter_docker_plays(plays, repo_path):
     items = set()
 
     for play in plays:
-        dockerfile = pathlib2.Path(DOCKER_PATH_ROOT, play, "Dockerfile")
+        dockerfile = pathlib2.Path(repo_path, DOCKER_BUILD_DIR, play, "Dockerfile")
 
         if dockerfile.exists():
             items.add(play)
@@ -316,6 +903,100 @@ def filter_docker_plays(plays, repo_path):
     return items
 
 
+def get_image_weights(config):
+    """
+    Returns a dict mapping Docker images to their weights, the approximate running time of their
+    builds, from the weights in the configuration file.
+
+    Input:
+    config: The parsed configuration file, whose weights are a list of single-key dicts.
+    """
+
+    weights = {}
+
+    for item in config.get("weights") or []:
+        weights.update(item)
+
+    return weights
+
+
+def get_base_images(images, git_dir):
+    """
+    Returns a dict mapping every Docker image in images to the images under docker/build that its
+    Dockerfile is built FROM.
+
+    Input:
+    images: A set of Docker images.
+    git_dir: A path to the top-most directory in the local git repository tool is to be run in.
+    """
+
+    dag = dockerfile_dag.build_dag(os.path.join(str(git_dir), DOCKER_BUILD_DIR))
+
+    return {image: set(dag.predecessors(image)) if image in dag else set() for image in images}
+
+
+def plan_shards(images, shards, weights, base_images, default_weight=1):
+    """
+    Splits Docker images into shards of roughly equal total weight, using longest-processing-time
+    first bin packing. An image is kept on the same shard as the images it is built FROM if they
+    are built as well, so the whole chain is handled by one build job.
+
+    Returns a list of shards, each a list of images in which base images come first.
+
+    Input:
+    images: A set of Docker images.
+    shards: The number of shards.
+    weights: A dict mapping Docker images to their weights.
+    base_images: A dict mapping Docker images to the images they are built FROM.
+    default_weight: The weight of images that are not in weights.
+    """
+
+    if shards < 1:
+        raise ValueError("the number of shards must be at least 1, not %d" % shards)
+
+    images = set(images)
+
+    # union-find over the FROM lines between images, whose sets are the units that are packed
+    roots = {image: image for image in images}
+
+    def _find(image):
+        while roots[image] != image:
+            roots[image] = roots[roots[image]]
+            image = roots[image]
+        return image
+
+    for image in images:
+        for base in base_images.get(image, ()):
+            if base in images:
+                roots[_find(image)] = _find(base)
+
+    units = {}
+    for image in images:
+        units.setdefault(_find(image), set()).add(image)
+
+    depths = {}
+
+    def _depth(image, seen=()):
+        # the number of images in images that image is built on top of
+        if image not in depths:
+            bases = [base for base in base_images.get(image, ()) if base in images and base not in seen]
+            depths[image] = max([_depth(base, seen + (image,)) + 1 for base in bases] or [0])
+        return depths[image]
+
+    def _weight(unit):
+        return sum(weights.get(image, default_weight) for image in unit)
+
+    plan = [[] for _ in range(shards)]
+    loads = [(0, shard) for shard in range(shards)]
+
+    for unit in sorted(units.values(), key=lambda unit: (-_weight(unit), sorted(unit))):
+        load, shard = heapq.heappop(loads)
+        plan[shard].extend(sorted(unit, key=lambda image: (_depth(image), image)))
+        heapq.heappush(loads, (load + _weight(unit), shard))
+
+    return plan
+
+
 def _get_role_name(role):
     """
     Resolves a role name from either a simple declaration or a dictionary style declaration.
@@ -348,17 +1029,7 @@ def _get_modified_dockerfiles(files, git_dir):
     :param git_dir:
     :return:
     """
-    items = set()
-    candidate_files = {f for f in DOCKER_PATH_ROOT.glob("**/*")}
-    for f in files:
-        file_path = pathlib2.Path(git_dir, f)
-        if file_path in candidate_files:
-            play = items.add(_get_play_name(file_path))
-
-            if play is not None:
-                items.add(play)
-
-    return items
+    return ChangeSetIndex(git_dir, docker_build_dirs=[DOCKER_BUILD_DIR]).classify(files)["docker_image"]
 
 
 def get_modified_dockerfiles_plays(files, git_dir):
@@ -368,49 +1039,146 @@ def get_modified_dockerfiles_plays(files, git_dir):
     :param git_dir:
     :return:
     """
-    items = set()
-    candidate_files = {f for f in DOCKER_PLAYS_PATH.glob("*.yml")}
-    for f in files:
-        file_path = pathlib2.Path(git_dir, f)
-        if file_path in candidate_files:
-            items.add(_get_playbook_name_from_file(file_path))
-    return items
+    return ChangeSetIndex(git_dir, docker_play_dirs=[DOCKER_PLAYS_DIR]).classify(files)["docker_playbook"]
 
 
-def _get_play_name(path):
+def get_affected_images(change_set, graph, index):
+    """
+    Determines the Docker images to rebuild for a change set: the docker plays that use a changed
+    role, or a role that depends on one, changed aws playbooks that are also docker plays, and
+    images whose docker/build or docker/plays files changed.
 
+    Input:
+    change_set: A set of files modified by a commit range.
+    graph: A networkx digraph that is used to map Ansible dependencies.
+    index: A ChangeSetIndex for the configured role, playbook and docker/build directories.
     """
-    Gets name of play from the filepath, which is the token
-    after either "docker/build" in the file path.
+
+    # maps every file in the commit range to the role, playbook or Docker image it belongs to
+    changes = index.classify(change_set)
+
+    # gets any playbooks in the commit range
+    plays = changes["aws_playbook"]
+
+    # transforms list of roles and plays into list of original roles and the roles contained in the plays
+    roles = changes["role"]
+
+    # determine which docker plays cover at least one of the roles or the roles that are dependent on them
+    docker_plays = get_affected_docker_plays(roles, graph)
+
+    # and which ones run the changed files of tasks
+    docker_plays = docker_plays | get_docker_plays_running_tasks(changes["tasks"], graph)
+
+    docker_plays = docker_plays | plays
+
+    # filter out docker plays without a Dockerfile
+    docker_plays = filter_docker_plays(docker_plays, index.git_dir)
+
+    # Add playbooks to the list whose docker file has been modified
+    modified_docker_files = changes["docker_image"]
+
+    # Add plays to the list which got changed in docker/plays directory
+    docker_plays_dir = changes["docker_playbook"]
+
+    return set(docker_plays) | set(modified_docker_files) | set(docker_plays_dir)
+
+
+def get_commit_range_files(commit_range, git_dir):
+    """
+    Returns the set of files modified by a commit range, as listed by git diff --name-only.
 
     Input:
-    path: A path to the changed file under docker/build dir
+    commit_range: A commit range, e.g. "master...feature".
+    git_dir: A path to the top-most directory in the local git repository tool is to be run in.
     """
 
-    # attempt to extract Docker image name from file path; splits the path of a file over
-    # "docker/build/", because the first token after "docker/build/" is the image name
-    suffix = (str(path)).split(str(os.path.join('docker', 'build', '')))
+    output = subprocess.check_output(["git", "diff", "--name-only", commit_range], cwd=str(git_dir),
+                                     stderr=subprocess.PIPE)
 
-    # if file path contains "docker/build/"
-    if len(suffix) > 1:
-        # split suffix over separators to file path components separately
-        suffix_parts = suffix[1].split(os.sep)
-        # first token will be image name; <repo>/docker/build/<image>/...
-        return suffix_parts[0]
-    return None
+    return set(output.decode("utf-8").splitlines())
 
 
-def arg_parse():
+def run_batch(lines, graph, index, output=sys.stdout):
+    """
+    Determines the Docker images to rebuild for many change sets over the same graph. Every line is
+    a JSON object with either the "files" of a change set or a commit "range" to run git diff on,
+    and optionally an "id". A JSON object with the id and the sorted "images", or an "error", is
+    written to output for every line, as soon as it is read.
+
+    Input:
+    lines: An iterable of JSON lines, e.g. standard in.
+    graph: A networkx digraph that is used to map Ansible dependencies.
+    index: A ChangeSetIndex for the configured role, playbook and docker/build directories.
+    output: The file the results are written to.
+    """
+
+    for line in lines:
+        if not line.strip():
+            continue
+
+        result = {}
+
+        try:
+            request = json.loads(line)
+            result["id"] = request.get("id")
+
+            if "files" in request:
+                change_set = set(request["files"])
+            else:
+                change_set = get_commit_range_files(request["range"], index.git_dir)
+
+            result["images"] = sorted(get_affected_images(change_set, graph, index))
+        except (ValueError, KeyError, AttributeError, TypeError) as exc:
+            result["error"] = "invalid request: %s" % exc
+        except subprocess.CalledProcessError as exc:
+            result["error"] = "git diff failed: %s" % (exc.stderr or b"").decode("utf-8", "replace").strip()
+        except OSError as exc:
+            result["error"] = "git diff failed: %s" % exc
+
+        output.write(json.dumps(result, sort_keys=True) + "\n")
+        output.flush()
+
+
+def arg_parse(argv=None):
 
     parser = argparse.ArgumentParser(description = 'Given a commit range, analyze Ansible dependencies between roles and playbooks '
     'and output a list of Docker plays affected by this commit range via these dependencies.')
     parser.add_argument('--verbose', help="set warnings to be displayed", action="store_true")
+    parser.add_argument('--cache-file', default=str(GRAPH_CACHE_PATH),
+                        help="file in which the parsed dependency graph is cached (default: %(default)s)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+                        help="number of processes used to parse roles and playbooks (default: %(default)s)")
+    parser.add_argument('--no-cache', help="parse every role and playbook without using the cache",
+                        action="store_true")
+    parser.add_argument('--shards', type=int,
+                        help="instead of a commit range, read Docker images from standard in and split them into "
+                        "this many shards balanced by the weights in the configuration file")
+    parser.add_argument('--shard', type=int, default=0,
+                        help="with --shards, the shard whose images are output (default: %(default)s)")
+    parser.add_argument('--batch', action="store_true",
+                        help="build the graph once and read many change sets from standard in, one JSON object "
+                        "per line with the \"files\" changed or a commit \"range\" and an optional \"id\"; "
+                        "write one JSON object per line with the id and the affected \"images\"")
+
+    args = parser.parse_args(argv)
+
+    if args.shards is not None and args.shards < 1:
+        parser.error("--shards must be at least 1")
+    if args.shards is not None and not 0 <= args.shard < args.shards:
+        parser.error("--shard must be between 0 and %d" % (args.shards - 1))
+
+    return args
+
+def main(argv=None):
+    """
+    Reads changed files from standard in and prints the Docker images to rebuild, see arg_parse for
+    the other modes.
 
-    return parser.parse_args()
-
-if __name__ == '__main__':
+    Input:
+    argv: The command line arguments, sys.argv[1:] by default.
+    """
 
-    args = arg_parse()
+    args = arg_parse(argv)
 
     # configure logging
     logging.basicConfig()
@@ -418,13 +1186,6 @@ if __name__ == '__main__':
     if not args.verbose:
         logging.disable(logging.WARNING)
 
-    # set of modified files in the commit range
-    change_set = set()
-
-    # read from standard in
-    for line in sys.stdin:
-        change_set.add(line.rstrip())
-
     # configuration file is expected to be in the following format:
     #
     # roles_paths:
@@ -433,36 +1194,43 @@ if __name__ == '__main__':
     #       - <all paths relative to configuration repository that contain aws Ansible playbooks>
     # docker_plays_paths:
     #       - <all paths relative to configuration repository that contain Docker Ansible playbooks>
+    # weights:
+    #       - <Docker image>: <approximate running time of its build>
 
     # read config file
     config = _open_yaml_file(CONFIG_FILE_PATH)
 
-    # build graph
-    graph = build_graph(TRAVIS_BUILD_DIR, config["roles_paths"], config["aws_plays_paths"], config["docker_plays_paths"])
+    if args.shards is not None:
+        # images to split into shards, e.g. the output of a previous run
+        images = set(sys.stdin.read().split())
 
-    # gets any playbooks in the commit range
-    plays = get_plays(change_set, TRAVIS_BUILD_DIR, config["aws_plays_paths"])
+        plan = plan_shards(images, args.shards, get_image_weights(config), get_base_images(images, TRAVIS_BUILD_DIR))
 
-    # transforms list of roles and plays into list of original roles and the roles contained in the plays
-    roles = change_set_to_roles(change_set, TRAVIS_BUILD_DIR, config["roles_paths"], config["aws_plays_paths"], graph)
+        print(" ".join(plan[args.shard]))
+        return
 
-    # expands roles set to include roles that are dependent on existing roles
-    dependent_roles = get_dependencies(roles, graph)
+    # build graph
+    graph = build_graph(TRAVIS_BUILD_DIR, config["roles_paths"], config["aws_plays_paths"], config["docker_plays_paths"],
+                        cache_file=None if args.no_cache else args.cache_file, jobs=args.jobs)
 
-    # determine which docker plays cover at least one role
-    docker_plays = get_docker_plays(dependent_roles, graph)
+    index = ChangeSetIndex(TRAVIS_BUILD_DIR, config["roles_paths"], config["aws_plays_paths"],
+                           config["docker_plays_paths"], [DOCKER_BUILD_DIR], graph.graph["reachable_tasks"])
 
-    docker_plays = docker_plays | plays
+    if args.batch:
+        run_batch(sys.stdin, graph, index, sys.stdout)
+        return
 
-    # filter out docker plays without a Dockerfile
-    docker_plays = filter_docker_plays(docker_plays, TRAVIS_BUILD_DIR)
+    # set of modified files in the commit range
+    change_set = set()
 
-    # Add playbooks to the list whose docker file has been modified
-    modified_docker_files = _get_modified_dockerfiles(change_set, TRAVIS_BUILD_DIR)
+    # read from standard in
+    for line in sys.stdin:
+        change_set.add(line.rstrip())
 
-    # Add plays to the list which got changed in docker/plays directory
-    docker_plays_dir = get_modified_dockerfiles_plays(change_set, TRAVIS_BUILD_DIR)
+    all_plays = get_affected_images(change_set, graph, index)
 
-    all_plays = set(set(docker_plays) | set( modified_docker_files) | set(docker_plays_dir))
+    print(" ".join(sorted(all_plays)))
 
-    print(" ".join(all_plays))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,249 @@
+"""
+Benchmarks the dependency analyzer (util/parsefiles.py) on synthetic repositories.
+
+A repository shaped like this one is generated for every size: roles with meta dependencies, task
+files that include each other and other roles, aws playbooks, docker plays and a docker/build
+directory with Dockerfiles. A handful of base roles is depended on by most other roles, as
+common is here, and the remaining dependencies point at a few random roles with a lower index,
+so that the graph is acyclic.
+
+For every size, the following are measured:
+
+    build_graph (no cache), build_graph (cold cache), build_graph (warm cache),
+    change_set_to_roles, get_dependencies, get_docker_plays, get_affected_docker_plays
+
+and for each of them the wall time, the best of --repeat runs, and the peak memory allocated by
+Python, in a separate run under tracemalloc, are reported.
+
+Usage:
+
+    python util/parsefiles_benchmark.py --sizes 150,1500,15000 --output parsefiles_benchmark.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+# parsefiles reads its paths from TRAVIS_BUILD_DIR when it is imported
+os.environ.setdefault("TRAVIS_BUILD_DIR", os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import parsefiles  # noqa: E402
+
+ROLES_DIR = "playbooks/roles"
+AWS_PLAYS_DIR = "playbooks"
+DOCKER_PLAYS_DIR = "docker/plays"
+
+# ratios of playbooks and base roles to roles in this repository
+AWS_PLAYS_PER_ROLE = 130 / 150.0
+DOCKER_PLAYS_PER_ROLE = 20 / 150.0
+BASE_ROLES_PER_ROLE = 3 / 150.0
+
+CHANGE_SET_SIZE = 20
+
+
+def role_name(number):
+    return "role_%05d" % number
+
+
+def write_yaml(path, lines):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, "w") as yaml_file:
+        yaml_file.write("\n".join(["---"] + lines) + "\n")
+
+
+def generate_repo(path, roles, aws_plays, docker_plays, seed=0):
+    """
+    Writes a synthetic repository with the given number of roles and playbooks to path, returning
+    a change set of files in it.
+
+    Input:
+    path: The directory the repository is written to.
+    roles: The number of roles.
+    aws_plays: The number of aws playbooks.
+    docker_plays: The number of docker plays, each with an image in docker/build.
+    seed: The seed of the random number generator, so that repositories can be compared.
+    """
+
+    rng = random.Random(seed)
+    base_roles = max(1, int(roles * BASE_ROLES_PER_ROLE))
+
+    for number in range(roles):
+        role_dir = os.path.join(path, ROLES_DIR, role_name(number))
+
+        dependencies = []
+        if number >= base_roles:
+            dependencies.append(rng.randrange(base_roles))
+            dependencies.extend(rng.randrange(number) for _ in range(rng.randint(0, 3)))
+
+        write_yaml(os.path.join(role_dir, "meta", "main.yml"),
+                   ["dependencies:" + ("" if dependencies else " []")] +
+                   ["  - %s" % role_name(dependency) for dependency in sorted(set(dependencies))])
+
+        tasks = [
+            "- name: install packages",
+            "  apt:",
+            "    name: \"{{ packages }}\"",
+            "  tags: [install]",
+            "- include: deploy.yml tags=deploy",
+        ]
+        if number > base_roles and rng.random() < 0.1:
+            tasks.extend([
+                "- name: include a role",
+                "  include_role:",
+                "    name: %s" % role_name(rng.randrange(number)),
+            ])
+        write_yaml(os.path.join(role_dir, "tasks", "main.yml"), tasks)
+        write_yaml(os.path.join(role_dir, "tasks", "deploy.yml"), ["- name: deploy", "  command: /bin/true"])
+        write_yaml(os.path.join(role_dir, "tasks", "devstack.yml"), ["- name: devstack", "  command: /bin/true"])
+        write_yaml(os.path.join(role_dir, "defaults", "main.yml"), ["%s_version: master" % role_name(number)])
+
+    def play_roles():
+        # playbooks mostly use the application roles, which come last
+        return sorted({role_name(rng.randrange(roles // 2, roles)) for _ in range(rng.randint(1, 5))})
+
+    for number in range(aws_plays):
+        write_yaml(os.path.join(path, AWS_PLAYS_DIR, "aws_%05d.yml" % number),
+                   ["- name: play %d" % number, "  hosts: all", "  roles:"] + ["    - %s" % role for role in play_roles()])
+
+    for number in range(docker_plays):
+        image = "image_%05d" % number
+        write_yaml(os.path.join(path, DOCKER_PLAYS_DIR, "%s.yml" % image),
+                   ["- name: %s" % image, "  hosts: all", "  roles:"] +
+                   ["    - role: %s" % role for role in play_roles()])
+
+        dockerfile = os.path.join(path, parsefiles.DOCKER_BUILD_DIR, image, "Dockerfile")
+        os.makedirs(os.path.dirname(dockerfile))
+        with open(dockerfile, "w") as docker_file:
+            docker_file.write("ARG BASE_IMAGE_TAG=latest\nFROM edxops/image_00000:${BASE_IMAGE_TAG}\n")
+
+    change_set = set()
+    for _ in range(CHANGE_SET_SIZE):
+        role = role_name(rng.randrange(roles))
+        change_set.add(os.path.join(ROLES_DIR, role, rng.choice(["tasks/main.yml", "tasks/devstack.yml",
+                                                                  "defaults/main.yml", "templates/new.j2"])))
+
+    return change_set
+
+
+def measure(func, repeat):
+    """Returns func's result, its best wall time over repeat runs and its peak traced memory."""
+    wall_time = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        wall_time = elapsed if wall_time is None else min(wall_time, elapsed)
+
+    tracemalloc.start()
+    func()
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return result, wall_time, peak_memory
+
+
+def benchmark_size(roles, repeat, jobs):
+    """Measures every analyzer step on a repository with the given number of roles."""
+    aws_plays = int(roles * AWS_PLAYS_PER_ROLE)
+    docker_plays = max(1, int(roles * DOCKER_PLAYS_PER_ROLE))
+    results = []
+
+    workdir = tempfile.mkdtemp(prefix="parsefiles_benchmark.")
+    try:
+        start = time.perf_counter()
+        change_set = generate_repo(workdir, roles, aws_plays, docker_plays)
+        generation_time = time.perf_counter() - start
+
+        cache_file = os.path.join(workdir, ".build", "parsefiles_cache.json")
+        dirs = ([ROLES_DIR], [AWS_PLAYS_DIR], [DOCKER_PLAYS_DIR])
+
+        def cold_cache():
+            if os.path.exists(cache_file):
+                os.remove(cache_file)
+            return parsefiles.build_graph(workdir, *dirs, cache_file=cache_file, jobs=jobs)
+
+        graph = None
+        changed_roles = dependent_roles = None
+        steps = [
+            ("build_graph (no cache)", lambda: parsefiles.build_graph(workdir, *dirs, jobs=jobs)),
+            ("build_graph (cold cache)", cold_cache),
+            ("build_graph (warm cache)", lambda: parsefiles.build_graph(workdir, *dirs, cache_file=cache_file, jobs=jobs)),
+            ("change_set_to_roles", lambda: parsefiles.change_set_to_roles(change_set, workdir, [ROLES_DIR],
+                                                                           [AWS_PLAYS_DIR], graph)),
+            ("get_dependencies", lambda: parsefiles.get_dependencies(changed_roles, graph)),
+            ("get_docker_plays", lambda: parsefiles.get_docker_plays(dependent_roles, graph)),
+            ("get_affected_docker_plays", lambda: parsefiles.get_affected_docker_plays(changed_roles, graph)),
+        ]
+
+        for step, func in steps:
+            result, wall_time, peak_memory = measure(func, repeat)
+
+            if step.startswith("build_graph"):
+                graph = result
+            elif step == "change_set_to_roles":
+                changed_roles = result
+            elif step == "get_dependencies":
+                dependent_roles = result
+
+            results.append({
+                "roles": roles,
+                "aws_plays": aws_plays,
+                "docker_plays": docker_plays,
+                "step": step,
+                "wall_time_seconds": round(wall_time, 6),
+                "peak_memory_bytes": peak_memory,
+                "result_size": len(result) if isinstance(result, set) else result.number_of_edges(),
+            })
+
+        print("generated %d roles in %.1fs" % (roles, generation_time), file=sys.stderr)
+    finally:
+        shutil.rmtree(workdir)
+
+    return results
+
+
+def print_results(results):
+    print("%8s %-27s %12s %14s %12s" % ("roles", "step", "wall time", "peak memory", "result size"))
+    for result in results:
+        print("%8d %-27s %11.4fs %13.2fM %12d" % (
+            result["roles"], result["step"], result["wall_time_seconds"],
+            result["peak_memory_bytes"] / 1024.0 / 1024.0, result["result_size"]))
+
+
+def arg_parse():
+    parser = argparse.ArgumentParser(description="Benchmark util/parsefiles.py on synthetic repositories.")
+    parser.add_argument("--sizes", default="150,1500,15000",
+                        help="comma separated numbers of roles (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="runs of every step, of which the fastest is reported (default: %(default)s)")
+    parser.add_argument("--jobs", type=int, default=1,
+                        help="processes build_graph parses files with (default: %(default)s)")
+    parser.add_argument("--output", help="file the results are written to as JSON")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = arg_parse()
+
+    # as in CI, where parsefiles.py runs without --verbose
+    logging.disable(logging.WARNING)
+
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        results.extend(benchmark_size(size, args.repeat, args.jobs))
+
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump({"repeat": args.repeat, "jobs": args.jobs, "results": results}, output, indent=2, sort_keys=True)